@@ -0,0 +1,127 @@
+"""
+Compare storing the history of parameters with paramgui.Container.update_history()
+(one row of a table for all parameters) against the original implementation
+(one Python list for each parameter) and against one growable array for each
+parameter, and check that all give the same history.
+
+For each implementation it reports:
+- the time per trial of update_history (which includes reading the widgets),
+- the time to read the widgets alone (the same for all implementations),
+- the memory used by the history,
+- the time to get the history of all parameters as arrays (needed each time
+  the data is saved, e.g. after every trial when saving each trial).
+
+Run with: QT_QPA_PLATFORM=offscreen python benchmark_history.py
+"""
+
+import time
+import tracemalloc
+import numpy as np
+from qtpy import QtWidgets
+from taskontrol import paramgui
+from taskontrol import utils
+
+N_NUMERIC = 40
+N_MENUS = 20
+N_TRIALS = 5000
+
+
+def update_history_lists(params, history):
+    """Original implementation of update_history() (one list for each parameter)."""
+    for key in params._paramsToKeepHistory:
+        try:
+            history[key].append(params[key].get_value())
+        except KeyError:  # If the key does not exist yet (e.g. first trial)
+            history[key] = [params[key].get_value()]
+
+
+def update_history_arrays(params, history):
+    """One utils.GrowableArray for each parameter (checking the type of each value)."""
+    for key in params._paramsToKeepHistory:
+        value = params[key].get_value()
+        paramHistory = history.get(key)
+        if paramHistory is None:
+            isInt = params[key].get_type() == 'menu' or isinstance(value, (int, np.integer))
+            paramHistory = utils.GrowableArray(dtype=int if isInt else float,
+                                               capacity=paramgui.HISTORY_CAPACITY)
+            history[key] = paramHistory
+        elif paramHistory.dtype.kind != 'f' and not isinstance(value, (int, np.integer)):
+            paramHistory = paramHistory.astype(float)
+            history[key] = paramHistory
+        paramHistory.append(value)
+
+
+def make_params():
+    params = paramgui.Container()
+    for indp in range(N_NUMERIC):
+        value = indp if indp % 2 else 0.5*indp
+        params['numeric{}'.format(indp)] = paramgui.NumericParam('N', value=value, group='g')
+    for indp in range(N_MENUS):
+        params['menu{}'.format(indp)] = paramgui.MenuParam('M', ['a', 'b', 'c'], value=1,
+                                                           group='g')
+    return params
+
+
+def time_per_trial(params, update):
+    """Return the time (sec) per trial, changing some values every trial."""
+    elapsed = 0
+    for trial in range(N_TRIALS):
+        params['numeric1'].set_value(trial)
+        params['numeric2'].set_value(0.25*trial)
+        params['menu0'].set_value(trial % 3)
+        startTime = time.perf_counter()
+        update()
+        elapsed += time.perf_counter()-startTime
+    return elapsed/N_TRIALS
+
+
+def history_as_arrays(history):
+    """Return the history of each parameter as an array (as passed to the HDF5 writer)."""
+    return {key: np.asarray(history[key][:N_TRIALS]) for key in history}
+
+
+def main():
+    app = QtWidgets.QApplication([])
+    params = make_params()
+    readWidgets = lambda: [params[key].get_value() for key in params._paramsToKeepHistory]
+    readTime = time_per_trial(params, readWidgets)
+    results = {}
+    histories = {}
+    for name in ['lists', 'arrays', 'table']:
+        measures = []
+        for traceMemory in [False, True]:
+            params = make_params()
+            history = {}
+            if name == 'lists':
+                update = lambda: update_history_lists(params, history)
+            elif name == 'arrays':
+                update = lambda: update_history_arrays(params, history)
+            else:
+                update = params.update_history
+                history = params.history
+            if traceMemory:  # Tracing makes everything slower, so time is measured before
+                tracemalloc.start()
+                time_per_trial(params, update)
+                measures.append(tracemalloc.get_traced_memory()[0])
+                tracemalloc.stop()
+            else:
+                measures.append(time_per_trial(params, update))
+                startTime = time.perf_counter()
+                histories[name] = history_as_arrays(history)
+                measures.append(time.perf_counter()-startTime)
+        results[name] = measures
+    for name in ['arrays', 'table']:
+        for key, values in histories['lists'].items():
+            assert np.array_equal(values, histories[name][key]), (name, key)
+            assert values.dtype.kind == histories[name][key].dtype.kind, (name, key)
+    print('{} parameters, {} trials (history is the same for all)'.format(
+        N_NUMERIC+N_MENUS, N_TRIALS))
+    print('Reading the widgets: {:0.1f} us/trial'.format(1e6*readTime))
+    print('          update_history     memory    history as arrays')
+    for name, (perTrial, toArrays, memory) in results.items():
+        print('{:8s} {:8.1f} us/trial {:8.0f} kB {:10.0f} us'.format(
+            name, 1e6*perTrial, memory/1e3, 1e6*toArrays))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Compare the time to create sounds (chord, toneCloud, toneTrain) with
+soundclient.create_soundwave() against the original implementation
+(which added one tone at a time), and check that both give the same waveform.
+The time of chord is dominated by computing the sine of each component, so it is
+not faster; it is included to check that its waveform has not changed.
+
+It also compares creating sounds in single precision (float32) against double
+precision (float64), checking that waveforms without random components are the
+same within float32 tolerance.
+
+Run with: python benchmark_soundwave.py
+"""
+
+import time
+import numpy as np
+from taskontrol.plugins import soundclient
+
+SAMPLING_RATE = 192000
+NREPEATS = 5
+SEED = 1
+
+
+def reference_soundwave(soundParams, samplingRate=44100, nChannels=2):
+    """Original implementation of create_soundwave() for chord, toneCloud and toneTrain."""
+    risetime = soundParams.setdefault('fadein', soundclient.RISETIME)
+    falltime = soundParams.setdefault('fadeout', soundclient.FALLTIME)
+    timeVec = np.arange(0, soundParams['duration'], 1/samplingRate)
+    soundAmp = np.tile(soundParams['amplitude'], nChannels)
+    if soundParams['type']=='chord':
+        freqEachComp = np.logspace(np.log10(soundParams['frequency']/soundParams['factor']),
+                                   np.log10(soundParams['frequency']*soundParams['factor']),
+                                   soundParams['ntones'])
+        soundWave = np.zeros(len(timeVec))
+        compAmp = 1/np.sqrt(soundParams['ntones'])
+        for indcomp, freqThisComp in enumerate(freqEachComp):
+            soundWave += compAmp * np.sin(2*np.pi*freqThisComp*timeVec)
+    elif soundParams['type']=='toneCloud':
+        nFreq = soundParams['nFreq']
+        freqEachTone = np.logspace(np.log10(soundParams['freqRange'][0]),
+                                   np.log10(soundParams['freqRange'][1]),
+                                   soundParams['nFreq'])
+        toneTimeVec = np.arange(0, soundParams['toneDuration'], 1/samplingRate)
+        allFreqTime = np.outer(freqEachTone, toneTimeVec)
+        waveEachTone = np.sin(2*np.pi*allFreqTime)
+        nSamplesPerTone = waveEachTone.shape[1]
+        toneFallTime = 0.001
+        toneFallVec = np.linspace(1, 0, round(samplingRate * toneFallTime))
+        if len(toneFallVec)>0:
+            waveEachTone[:, -len(toneFallVec):] *= toneFallVec
+        toneOnsets = np.arange(0, soundParams['duration'], soundParams['toneOnsetAsync'])
+        toneOnsetsInds = (toneOnsets*samplingRate).astype(int)
+        nTones = np.sum((toneOnsetsInds+nSamplesPerTone) < len(timeVec))
+        nFreqInTargetRange = nFreq//3
+        pTarget = (1 + 2*abs(soundParams['strength'])/100) / 3
+        if soundParams['strength']>0:
+            targetFreqInds = np.arange(nFreq-nFreqInTargetRange, nFreq)
+        else:
+            targetFreqInds = np.arange(0, nFreqInTargetRange)
+        pNonTargetTone = (1-pTarget)/(nFreq-len(targetFreqInds))
+        pEachFreq = np.tile(pNonTargetTone, nFreq)
+        pEachFreq[targetFreqInds] = pTarget/len(targetFreqInds)
+        nTonesEachFreq = np.random.multinomial(nTones, pEachFreq)
+        toneSequenceSorted = np.repeat(np.arange(nFreq), nTonesEachFreq)
+        toneSequence = np.random.permutation(toneSequenceSorted)
+        soundWave = np.zeros(len(timeVec))
+        for toneInd in range(nTones):
+            onsetSample = toneOnsetsInds[toneInd]
+            waveThisTone = waveEachTone[toneSequence[toneInd], :]
+            soundWave[onsetSample:onsetSample+nSamplesPerTone] += waveThisTone
+    elif soundParams['type']=='toneTrain':
+        toneTimeVec = np.arange(0, soundParams['toneDuration'], 1/samplingRate)
+        waveEachTone = np.sin(2*np.pi*soundParams['frequency']*toneTimeVec)
+        toneRiseFallTime = 0.001
+        toneRiseVec = np.linspace(0, 1, round(samplingRate * toneRiseFallTime))
+        toneFallVec = np.linspace(1, 0, round(samplingRate * toneRiseFallTime))
+        if len(toneRiseVec)>0:
+            waveEachTone[0:len(toneRiseVec)] *= toneRiseVec
+            waveEachTone[-len(toneFallVec):] *= toneFallVec
+        toneOnsetAsync = 1/soundParams['rate']
+        toneOnsets = np.arange(0, soundParams['duration'], toneOnsetAsync)
+        toneOnsetsInds = (toneOnsets*samplingRate).astype(int)
+        soundWave = np.zeros(len(timeVec))
+        for onsetSample in toneOnsetsInds:
+            offsetSample = min(onsetSample+len(toneTimeVec), len(timeVec))
+            soundWave[onsetSample:offsetSample] += waveEachTone
+    soundWave = soundclient.apply_rise_fall(soundWave, samplingRate, risetime, falltime)
+    soundWave = soundAmp[:,np.newaxis] * np.tile(soundWave,(nChannels,1))
+    return timeVec, soundWave
+
+
+def time_function(func, soundParams, **kwargs):
+    """Return the waveform and the best time (sec) to create it (same random state each time)."""
+    elapsed = []
+    for repeat in range(NREPEATS):
+        np.random.seed(SEED)
+        tStart = time.perf_counter()
+        timeVec, soundWave = func(dict(soundParams), SAMPLING_RATE, **kwargs)
+        elapsed.append(time.perf_counter()-tStart)
+    return soundWave, min(elapsed)
+
+
+def within_float32_tolerance(wave32, wave64):
+    """Return True if the float32 waveform equals the float64 one within float32 precision."""
+    tolerance = 8*np.finfo(np.float32).eps*np.max(np.abs(wave64))
+    return np.allclose(wave32, wave64, rtol=0, atol=tolerance)
+
+
+if __name__ == '__main__':
+    sounds = {
+        'chord (12 tones, 1 s)': {'type':'chord', 'frequency':8000, 'factor':1.2,
+                                  'ntones':12, 'duration':1.0, 'amplitude':0.1},
+        'toneCloud (2 s)': {'type':'toneCloud', 'duration':2.0, 'amplitude':0.1, 'nFreq':16,
+                            'freqRange':[4000, 40000], 'toneDuration':0.03,
+                            'toneOnsetAsync':0.005, 'strength':50},
+        'toneCloud (10 s, dense)': {'type':'toneCloud', 'duration':10.0, 'amplitude':0.1,
+                                    'nFreq':32, 'freqRange':[4000, 40000],
+                                    'toneDuration':0.03, 'toneOnsetAsync':0.001,
+                                    'strength':-80},
+        'toneTrain (2 s, 20 Hz)': {'type':'toneTrain', 'frequency':6000, 'rate':20,
+                                   'toneDuration':0.02, 'duration':2.0, 'amplitude':0.1},
+    }
+    print('{:<26} {:>12} {:>12} {:>8}  {}'.format('Sound', 'Original(ms)', 'Current(ms)',
+                                                  'Speedup', 'Same output'))
+    for name, soundParams in sounds.items():
+        refWave, refTime = time_function(reference_soundwave, soundParams)
+        newWave, newTime = time_function(soundclient.create_soundwave, soundParams)
+        sameOutput = np.array_equal(refWave, newWave)
+        print('{:<26} {:>12.1f} {:>12.1f} {:>7.1f}x  {}'.format(name, 1e3*refTime, 1e3*newTime,
+                                                              refTime/newTime, sameOutput))
+
+    soundsPrecision = {
+        'tone (1 s)': {'type':'tone', 'frequency':8000, 'duration':1.0, 'amplitude':0.1},
+        'chord (12 tones, 1 s)': sounds['chord (12 tones, 1 s)'],
+        'FM (2 s)': {'type':'FM', 'frequencyStart':2000, 'frequencyEnd':20000,
+                     'duration':2.0, 'amplitude':0.1},
+        'toneCloud (2 s)': sounds['toneCloud (2 s)'],
+        'noise (10 s)': {'type':'noise', 'duration':10.0, 'amplitude':0.1},
+        'AM (10 s)': {'type':'AM', 'duration':10.0, 'amplitude':0.1, 'modDepth':50,
+                      'modFrequency':8},
+    }
+    print()
+    print('{:<26} {:>12} {:>12} {:>8} {:>9}  {}'.format('Sound', 'float64(ms)', 'float32(ms)',
+                                                       'Speedup', 'Size(MB)', 'Within tol'))
+    for name, soundParams in soundsPrecision.items():
+        wave64, time64 = time_function(soundclient.create_soundwave, soundParams)
+        wave32, time32 = time_function(soundclient.create_soundwave, soundParams,
+                                       dtype=np.float32)
+        if soundParams['type'] in soundclient.STOCHASTIC_SOUND_TYPES and \
+           soundParams['type'] != 'toneCloud':
+            withinTolerance = 'n/a (random)'
+        else:
+            withinTolerance = within_float32_tolerance(wave32, wave64)
+        print('{:<26} {:>12.1f} {:>12.1f} {:>7.1f}x {:>4.1f}/{:<4.1f}  {}'.format(
+            name, 1e3*time64, 1e3*time32, time64/time32, wave64.nbytes/1e6,
+            wave32.nbytes/1e6, withinTolerance))
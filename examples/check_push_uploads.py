@@ -0,0 +1,197 @@
+'''
+Check that programs can be uploaded while the state machine pushes events,
+and that push mode survives stray replies and stops cleanly after read errors.
+
+This script does not need a state machine: it uses a mock serial port that
+replies to LOAD_PROGRAM and PATCH_PROGRAM, and that pushes packets of events
+(as statemachine.ino version 0.9) while push mode is enabled.
+'''
+
+import struct
+import threading
+import time
+import numpy as np
+from taskontrol import smclient
+
+PUSH_INTERVAL = 0.002  # Time (sec) between pushed packets
+N_UPLOADS = 200
+
+
+class MockStateMachine(object):
+    '''Serial port connected to a (very simplified) state machine server.'''
+    def __init__(self):
+        self.timeout = smclient.SERIAL_TIMEOUT
+        self.inBuffer = bytearray()
+        self.outBuffer = bytearray()
+        self.lock = threading.Condition()
+        self.pushEvents = False
+        self.nPushed = 0
+        self.nPrograms = 0
+        self.running = True
+        self.pushThread = threading.Thread(target=self._push_loop, daemon=True)
+        self.pushThread.start()
+
+    def _send(self, data):
+        with self.lock:
+            self.outBuffer += data
+            self.lock.notify_all()
+
+    def _push_loop(self):
+        while self.running:
+            time.sleep(PUSH_INTERVAL)
+            with self.lock:
+                if self.pushEvents:
+                    serverTime = int(1e3*time.perf_counter()) & 0xffffffff
+                    events = np.zeros(1, dtype=smclient.EVENTS_WIRE_DTYPE)
+                    events['time'] = serverTime
+                    packet = (smclient.opcode['EVENTS_PUSH'] + struct.pack('<L', serverTime) +
+                              struct.pack(smclient.EVENTS_COUNT_FORMAT, len(events)) +
+                              events.tobytes())
+                    self.outBuffer += packet
+                    self.nPushed += 1
+                    self.lock.notify_all()
+
+    def _process_commands(self):
+        '''Execute all complete commands in the input buffer.'''
+        while self.inBuffer:
+            command = bytes(self.inBuffer[:1])
+            if command in (smclient.opcode['RUN'], smclient.opcode['STOP']):
+                length = 1
+            elif command in (smclient.opcode['FORCE_STATE'], smclient.opcode['SET_EVENTS_PUSH']):
+                length = 2
+            elif command in (smclient.opcode['LOAD_PROGRAM'], smclient.opcode['PATCH_PROGRAM']):
+                if len(self.inBuffer) < 3:
+                    return
+                length = 3 + struct.unpack('<H', self.inBuffer[1:3])[0] + 2
+            else:
+                raise ValueError('Command {} not supported by the mock server.'.format(command))
+            if len(self.inBuffer) < length:
+                return
+            message = bytes(self.inBuffer[:length])
+            del self.inBuffer[:length]
+            if command==smclient.opcode['SET_EVENTS_PUSH']:
+                with self.lock:
+                    self.pushEvents = bool(message[1])
+                    if not self.pushEvents:
+                        self.outBuffer += smclient.opcode['OK']
+                        self.lock.notify_all()
+            elif command in (smclient.opcode['LOAD_PROGRAM'], smclient.opcode['PATCH_PROGRAM']):
+                data = message[3:-2]
+                checksum = struct.unpack('<H', message[-2:])[0]
+                if checksum == (sum(data) & 0xffff):
+                    self.nPrograms += 1
+                    self._send(smclient.opcode['OK'])
+                else:
+                    self._send(smclient.opcode['ERROR'] + b'Program not valid.\r\n')
+
+    def write(self, data):
+        self.inBuffer += data
+        self._process_commands()
+
+    def read(self, size=1):
+        deadline = time.perf_counter() + self.timeout
+        with self.lock:
+            while len(self.outBuffer) < size and time.perf_counter() < deadline:
+                self.lock.wait(deadline-time.perf_counter())
+            data = bytes(self.outBuffer[:size])
+            del self.outBuffer[:size]
+        return data
+
+    def readline(self):
+        line = b''
+        while not line.endswith(b'\n'):
+            oneByte = self.read(1)
+            if not oneByte:
+                break
+            line += oneByte
+        return line
+
+    def flushInput(self):
+        with self.lock:
+            del self.outBuffer[:]
+
+    def inject(self, data):
+        '''Send data as if it came from the server (e.g., an incomplete packet).'''
+        self._send(data)
+
+    def close(self):
+        self.running = False
+
+
+def check_uploads_in_push_mode():
+    mock = MockStateMachine()
+    client = smclient.StateMachineClient(connectnow=False)
+    client.ser = mock
+    client.serverVersion = (0, 9)
+    nInputs = 2
+    nActions = 2*nInputs + 1
+    nStates = 8
+    stateMatrix = np.tile(np.arange(nActions) % nStates, (nStates, 1))
+    stateOutputs = np.zeros((nStates, 3), dtype=int)
+    stateTimers = np.ones(nStates)
+    nEventsReceived = [0]
+    def count_events(serverTime, events):
+        nEventsReceived[0] += len(events)
+
+    client.start_events_push(count_events)
+    for indu in range(N_UPLOADS):
+        stateTimers[indu % nStates] = 0.001*indu
+        if indu % 2:
+            client.patch_program([indu % nStates], stateMatrix[:1], stateOutputs[:1], [0],
+                                 stateTimers[indu % nStates:indu % nStates+1])
+        else:
+            client.load_program(nInputs, stateMatrix, stateOutputs, None, stateTimers)
+        time.sleep(PUSH_INTERVAL/2)
+    assert mock.nPrograms == N_UPLOADS, 'Some programs were not uploaded.'
+    assert client.in_push_mode(), 'The events reader stopped during the uploads.'
+
+    # -- A rejected program raises an error without stopping the events reader --
+    badMessage = bytearray(smclient.build_program(nInputs, stateMatrix, stateOutputs, None,
+                                                  stateTimers))
+    badMessage[-1] ^= 0xff
+    try:
+        client.send_program_message(bytes(badMessage))
+        raise AssertionError('A corrupted program was accepted.')
+    except IOError:
+        pass
+    assert client.in_push_mode(), 'The events reader stopped after an error.'
+
+    nPushedBefore = mock.nPushed
+    time.sleep(20*PUSH_INTERVAL)
+    assert mock.nPushed > nPushedBefore, 'The server stopped pushing events.'
+    client.stop_events_push()
+    assert not client.in_push_mode(), 'The events reader did not stop.'
+    assert nEventsReceived[0] == mock.nPushed, 'Some pushed events were not received.'
+
+    # -- Uploads still work (reading the reply directly) after push mode --
+    client.load_program(nInputs, stateMatrix, stateOutputs, None, stateTimers)
+
+    # -- A stray OK (e.g., from an upload that timed out) does not stop push mode --
+    client.start_events_push(count_events)
+    mock.inject(smclient.opcode['OK'])
+    time.sleep(20*PUSH_INTERVAL)
+    assert client.in_push_mode(), 'A stray OK stopped the events reader.'
+    client.stop_events_push()
+    assert not client.in_push_mode(), 'The events reader did not stop.'
+
+    # -- An incomplete packet stops the reader and reports the error --
+    errors = []
+    client.start_events_push(count_events, errors.append)
+    time.sleep(5*PUSH_INTERVAL)
+    with mock.lock:
+        mock.pushEvents = False
+        mock.outBuffer += smclient.opcode['EVENTS_PUSH'] + b'\x01\x02'
+        mock.lock.notify_all()
+    time.sleep(2*smclient.SERIAL_TIMEOUT)
+    assert not client.in_push_mode(), 'The events reader did not stop after an error.'
+    assert len(errors) == 1, 'The error callback was not called.'
+    client.stop_events_push()  # Aborts push mode, since the reader already stopped
+    assert client.eventsReader is None
+    client.load_program(nInputs, stateMatrix, stateOutputs, None, stateTimers)
+    mock.close()
+    print('OK: {} uploads while receiving {} pushed packets.'.format(N_UPLOADS,
+                                                                    nEventsReceived[0]))
+
+
+if __name__ == '__main__':
+    check_uploads_in_push_mode()
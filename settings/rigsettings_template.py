@@ -27,6 +27,7 @@ EMULATOR_VERBOSE = True
 #: Serial port for the state machine.
 STATE_MACHINE_PORT = '/dev/arduinoDueProgramming'
 #STATE_MACHINE_PORT = '/dev/ttyACM0'
+#STATE_MACHINE_PORT = 'auto'  # Probe all serial ports to find the state machine
 
 #: Serial port for triggering sounds.
 SOUND_TRIGGER_PORT = '/dev/arduinoDueNative'
@@ -43,6 +44,14 @@ WHEEL_SENSOR_PORT = None
 SOUND_SERVER = 'pygame'
 #SOUND_SERVER = 'jack'
 
+#: Mix all sounds into one pair of jack ports (instead of two ports for each sound),
+#: playing up to SOUND_MAX_VOICES sounds at the same time.
+SOUND_JACK_MIXER = False
+SOUND_MAX_VOICES = 8
+
+#: Number of processes creating sounds in advance (see SoundClient.prepare_sounds).
+SOUND_PREPARE_PROCESSES = 2
+
 #: Type of sound card (if using jack). Find this name by running: aplay -l
 SOUND_CARD_NAME = 'STX'
 #SOUND_CARD_NAME = 'DX'
@@ -58,6 +67,14 @@ SPEAKER_CALIBRATION_CHORD = None
 SPEAKER_CALIBRATION_NOISE = None
 #SPEAKER_CALIBRATION_NOISE = '/home/jarauser/src/taskontrol/settings/speaker_calibration_noise.h5'
 
+#: Create waveforms in single precision (float32), which uses half the memory.
+SOUND_SINGLE_PRECISION = False
+
+#: Maximum memory (bytes) for waveforms kept to avoid creating the same sound again.
+SOUND_CACHE_MAX_BYTES = 256*1024**2
+#: Directory to also save created waveforms (so they are reused across sessions).
+SOUND_CACHE_DIR = None
+
 #: Settings for sending sync signals through one channel of the sound card
 SOUND_SYNC_CHANNEL = None
 #SOUND_SYNC_CHANNEL = 0
@@ -70,6 +87,24 @@ SYNC_SIGNAL_FREQUENCY = 500
 DATA_DIR = '/data/behavior/'
 REMOTE_DIR = None #'/mnt/jarahubdata/'
 
+#: Save data files with narrow dtypes and compressed datasets.
+COMPACT_DATA_FILES = False
+
+#: Write data files (and send them to the repository) without blocking the GUI.
+SAVE_IN_BACKGROUND = False
+
+#: Save each trial as it ends (to a temporary file renamed when saving the data).
+SAVE_EACH_TRIAL = False
+
+#: Let other processes read the file while trials are saved (HDF5 SWMR mode).
+SAVE_EACH_TRIAL_SWMR = False
+
+#: Minimum time (sec) between writes when saving each trial (0 to write every trial).
+SAVE_EACH_TRIAL_INTERVAL = 0
+
+#: Add each saved file to the catalog of sessions in DATA_DIR (see taskontrol.catalog).
+UPDATE_CATALOG = False
+
 DEFAULT_PARAMSFILE = './params.py'
 
 
@@ -38,11 +38,17 @@ FIXME:
 #define REPORT_EXTRA_TIMERS   0x1c
 #define SET_SERIAL_OUTPUTS    0x1d
 #define REPORT_SERIAL_OUTPUTS 0x1e
+#define GET_EVENTS_BINARY     0x1f
+#define SET_EVENTS_PUSH       0x20
+#define EVENTS_PUSH           0x21  // Header of packets pushed by the server
+#define GET_STATUS            0x22
+#define LOAD_PROGRAM          0x23
+#define PATCH_PROGRAM         0x24
 
 #define TEST                 0xee
 #define ERROR                0xff
 
-#define VERSION        "0.3"
+#define VERSION        "0.9"
 
 #define MAXNEVENTS 512
 #define MAXNSTATES 256
@@ -50,6 +56,11 @@ FIXME:
 #define MAXNINPUTS  8
 #define MAXNOUTPUTS  16
 #define MAXNACTIONS 2*MAXNINPUTS + 1 + MAXNEXTRATIMERS
+#define EVENTNBYTES 6  // Bytes per event in binary format: time(4), code(1), nextState(1)
+#define PUSH_HEARTBEAT 100  // Max time (ms) between pushed packets when in push mode
+// Max size of a LOAD_PROGRAM message: sizes(4), then for each state: transitions,
+// outputs, serial output(1), timer(4), and for each extra timer: duration(4), trigger(1)
+#define MAXNPROGRAMBYTES (4 + MAXNSTATES*(MAXNACTIONS + MAXNOUTPUTS + 5) + 5*MAXNEXTRATIMERS)
 
 // NOTE: inputPins needs to be consistent with MAXNINPUTS
 unsigned int inputPins[] = {53,52,51,50, 49,48,47,46};
@@ -102,6 +113,17 @@ unsigned long stateTimerValue = 0;
 unsigned long extraTimersValues[MAXNEXTRATIMERS];
 boolean activeExtraTimers[MAXNEXTRATIMERS];
 
+// Buffer for sending all events in one write: nEvents(2) and EVENTNBYTES per event
+unsigned char eventsBuffer[2 + MAXNEVENTS*EVENTNBYTES];
+
+// Buffer for receiving the whole program (see LOAD_PROGRAM) before applying it
+unsigned char programBuffer[MAXNPROGRAMBYTES];
+unsigned int nProgramBytes; // Size of the last message stored in programBuffer
+
+// Push mode: send events to the client as soon as they happen (see SET_EVENTS_PUSH)
+boolean pushEvents = false;
+unsigned long lastPushTime = 0;
+
 
 // For debugging purposes //
 void blink(int ntimes) {
@@ -115,9 +137,12 @@ void blink(int ntimes) {
 }
 
 void establishConnection() {
+  // Reply soon after CONNECT arrives (the client resends it until it gets OK).
+  // A short wait between checks avoids spinning at full speed while idle,
+  // and is much shorter than the first wait of the client (10 ms).
   while(1) {
     if ((Serial.available()>0) && (Serial.read()==CONNECT)) break;
-    else delay(300);
+    else delay(1);
   }
   Serial.write(OK);
 }
@@ -257,6 +282,45 @@ void update_state_machine() {
   }
 }
 
+// -- Send all events as one binary block and clear the list of events --
+// Format: nEvents (uint16), then for each event: time (uint32), code (int8), nextState (uint8)
+// All values are little endian.
+void send_events_binary() {
+  unsigned int nBytes = 0;
+  unsigned long thisEventTime;
+  eventsBuffer[nBytes++] = nEvents & 0xff;
+  eventsBuffer[nBytes++] = (nEvents >> 8) & 0xff;
+  for (inde=0; inde < nEvents; inde++) {
+    thisEventTime = eventsTime[inde];
+    eventsBuffer[nBytes++] = thisEventTime & 0xff;
+    eventsBuffer[nBytes++] = (thisEventTime >> 8) & 0xff;
+    eventsBuffer[nBytes++] = (thisEventTime >> 16) & 0xff;
+    eventsBuffer[nBytes++] = (thisEventTime >> 24) & 0xff;
+    eventsBuffer[nBytes++] = (char) eventsCode[inde];
+    eventsBuffer[nBytes++] = nextState[inde];
+  }
+  Serial.write(eventsBuffer, nBytes);
+  nEvents=0;
+}
+
+// -- Send an unsigned long (4 bytes) in little endian order (LSB first) --
+void write_uint32_serial(unsigned long value) {
+  unsigned char valueBytes[4];
+  int ind;
+  for (ind=0; ind<4; ind++) {
+    valueBytes[ind] = (value >> (8*ind)) & 0xff;
+  }
+  Serial.write(valueBytes, 4);
+}
+
+// -- Send a packet with the server time and all new events (push mode) --
+void push_events() {
+  lastPushTime = millis();
+  Serial.write(EVENTS_PUSH);
+  write_uint32_serial(lastPushTime);
+  send_events_binary();
+}
+
 unsigned long read_uint32_serial() {
   // Read four bytes and combine them (little endian order, LSB first)
   unsigned long value=0;
@@ -271,14 +335,156 @@ unsigned long read_uint32_serial() {
 }
 
 
+unsigned int read_uint16_serial() {
+  // Read two bytes and combine them (little endian order, LSB first)
+  unsigned int value=0;
+  int ind;
+  for (ind=0; ind<2; ind++)
+  {
+    while (!Serial.available()) {}  // Wait for data
+    serialByte = Serial.read();
+    value = ((unsigned int) serialByte << (8*ind)) | value;
+  }
+  return value;
+}
+
+unsigned long uint32_from_buffer(unsigned char *buffer) {
+  // Combine four bytes from a buffer (little endian order, LSB first)
+  return ((unsigned long) buffer[0]) | ((unsigned long) buffer[1] << 8) |
+    ((unsigned long) buffer[2] << 16) | ((unsigned long) buffer[3] << 24);
+}
+
+// -- Receive a message (size, data, checksum) for LOAD_PROGRAM or PATCH_PROGRAM --
+// The data is stored in programBuffer. Returns false if it does not fit or is corrupted.
+boolean receive_program_message() {
+  unsigned int indb, checksum;
+  nProgramBytes = read_uint16_serial();
+  checksum = 0;
+  for (indb=0; indb<nProgramBytes; indb++) {
+    while (!Serial.available()) {}  // Wait for data
+    serialByte = Serial.read();
+    checksum = (checksum + serialByte) & 0xffff;
+    if (indb < MAXNPROGRAMBYTES) {
+      programBuffer[indb] = serialByte;
+    }
+  }
+  return (nProgramBytes <= MAXNPROGRAMBYTES) && (checksum == read_uint16_serial());
+}
+
+// -- Apply a program (sizes, matrix, outputs, timers) stored in programBuffer --
+// Returns false (and changes nothing) if the sizes are not valid.
+boolean apply_program(unsigned int nBytes) {
+  unsigned int pos = 0;
+  unsigned int indRow,indCol;
+  unsigned char newNinputs, newNoutputs, newNextraTimers, newNstates, newNactions;
+  newNinputs = programBuffer[pos++];
+  newNoutputs = programBuffer[pos++];
+  newNextraTimers = programBuffer[pos++];
+  newNstates = programBuffer[pos++];
+  newNactions = 2*newNinputs + 1 + newNextraTimers;
+  if ((newNinputs > MAXNINPUTS) || (newNoutputs > MAXNOUTPUTS) ||
+      (newNextraTimers > MAXNEXTRATIMERS) ||
+      (nBytes != 4 + newNstates*(newNactions+newNoutputs+5) + 5*newNextraTimers)) {
+    return false;
+  }
+  nInputs = newNinputs;
+  nOutputs = newNoutputs;
+  nExtraTimers = newNextraTimers;
+  nStates = newNstates;
+  nActions = newNactions;
+  for (indRow=0;indRow<nStates;indRow++) {
+    for (indCol=0;indCol<nActions;indCol++) {
+      stateMatrix[indRow][indCol] = programBuffer[pos++];
+    }
+  }
+  for (indRow=0;indRow<nStates;indRow++) {
+    for (indCol=0;indCol<nOutputs;indCol++) {
+      stateOutputs[indRow][indCol] = programBuffer[pos++];
+    }
+  }
+  for (inds=0; inds<nStates; inds++) {
+    serialOutputs[inds] = programBuffer[pos++];
+  }
+  for (inds=0; inds<nStates; inds++) {
+    stateTimers[inds] = uint32_from_buffer(&programBuffer[pos]);
+    pos += 4;
+  }
+  for (indt=0; indt<nExtraTimers; indt++) {
+    extraTimers[indt] = uint32_from_buffer(&programBuffer[pos]);
+    pos += 4;
+  }
+  for (indt=0; indt<nExtraTimers; indt++) {
+    triggerStateEachExtraTimer[indt] = programBuffer[pos++];
+  }
+  sizesSetFlag = true;
+  return true;
+}
+
+// -- Replace some states and extra timers with the patch stored in programBuffer --
+// Returns false (and changes nothing) if the patch does not match the current sizes.
+boolean apply_program_patch(unsigned int nBytes) {
+  unsigned int pos, indr, indCol, stateBytes;
+  unsigned char nPatchedStates, nPatchedTimers;
+  stateBytes = 1 + nActions + nOutputs + 5;  // Index, transitions, outputs, serial, timer
+  // -- Check sizes and indices before changing anything --
+  if (nBytes < 2) {
+    return false;
+  }
+  nPatchedStates = programBuffer[0];
+  pos = 1 + nPatchedStates*stateBytes;
+  if (pos >= nBytes) {
+    return false;
+  }
+  nPatchedTimers = programBuffer[pos];
+  if (nBytes != pos + 1 + 6*nPatchedTimers) {
+    return false;
+  }
+  for (indr=0; indr<nPatchedStates; indr++) {
+    if (programBuffer[1 + indr*stateBytes] >= nStates) {
+      return false;
+    }
+  }
+  for (indr=0; indr<nPatchedTimers; indr++) {
+    if (programBuffer[pos + 1 + 6*indr] >= nExtraTimers) {
+      return false;
+    }
+  }
+  // -- Apply the patch --
+  pos = 1;
+  for (indr=0; indr<nPatchedStates; indr++) {
+    inds = programBuffer[pos++];
+    for (indCol=0;indCol<nActions;indCol++) {
+      stateMatrix[inds][indCol] = programBuffer[pos++];
+    }
+    for (indCol=0;indCol<nOutputs;indCol++) {
+      stateOutputs[inds][indCol] = programBuffer[pos++];
+    }
+    serialOutputs[inds] = programBuffer[pos++];
+    stateTimers[inds] = uint32_from_buffer(&programBuffer[pos]);
+    pos += 4;
+  }
+  pos++;  // Skip the number of extra timers
+  for (indr=0; indr<nPatchedTimers; indr++) {
+    indt = programBuffer[pos++];
+    extraTimers[indt] = uint32_from_buffer(&programBuffer[pos]);
+    pos += 4;
+    triggerStateEachExtraTimer[indt] = programBuffer[pos++];
+  }
+  return true;
+}
+
 void loop(){
   //digitalWrite(ledPin, LOW);  // DEBUG
   if (runningState) {
       execute_cycle();
   }
+  if (pushEvents && ((nEvents>0) || (millis()-lastPushTime >= PUSH_HEARTBEAT))) {
+      push_events();
+  }
   while (Serial.available()>0) {
     serialByte = Serial.read();
     switch(serialByte) {
+      case CONNECT:  // Repeated CONNECT during the handshake, or client reconnecting
       case TEST_CONNECTION: {
 	Serial.write(OK);
 	break;
@@ -439,6 +645,44 @@ void loop(){
 	nEvents=0;
 	break;
       }
+      case GET_EVENTS_BINARY: {
+	send_events_binary();
+	break;
+      }
+      case LOAD_PROGRAM: {
+	if (receive_program_message() && apply_program(nProgramBytes)) {
+	  Serial.write(OK);
+	}
+	else {
+	  Serial.write(ERROR);
+	  Serial.println("Program not valid.");
+	}
+	break;
+      }
+      case PATCH_PROGRAM: {
+	if (receive_program_message() && apply_program_patch(nProgramBytes)) {
+	  Serial.write(OK);
+	}
+	else {
+	  Serial.write(ERROR);
+	  Serial.println("Program patch not valid.");
+	}
+	break;
+      }
+      case GET_STATUS: {
+	write_uint32_serial(millis());
+	Serial.write(currentState);
+	send_events_binary();
+	break;
+      }
+      case SET_EVENTS_PUSH: {
+	while (!Serial.available()) {}  // Wait for data
+	pushEvents = Serial.read();
+	if (!pushEvents) {
+	  Serial.write(OK);  // Tells the client no more packets will be pushed
+	}
+	break;
+      }
       case GET_CURRENT_STATE: {
 	Serial.write(currentState);
 	break;
@@ -1,11 +1,21 @@
 """
 A framework for developing behavioral experiments.
 
+catalog
+-------
+.. automodule:: taskontrol.catalog
+   :members:
+
 dispatcher
 ----------
 .. automodule:: taskontrol.dispatcher
    :members:
 
+export
+------
+.. automodule:: taskontrol.export
+   :members:
+
 paramgui
 --------
 .. automodule:: taskontrol.paramgui
@@ -16,6 +26,11 @@ savedata
 .. automodule:: taskontrol.savedata
    :members:
 
+sessionreader
+-------------
+.. automodule:: taskontrol.sessionreader
+   :members:
+
 smclient
 --------
 .. automodule:: taskontrol.smclient
@@ -0,0 +1,323 @@
+"""
+Catalog of the sessions saved in a data directory.
+
+The catalog is an SQLite database (stored in the data directory) with one row
+per session file (subject, paradigm, date, hostname, number of trials, etc)
+and a summary of the parameters of each session, so sessions can be found
+without opening every data file. It is updated when SaveData saves a file
+(if created with updatedb=True) and it can be rebuilt by scanning the data
+directory in parallel.
+
+Example:
+    with catalog.Catalog(datadir) as cat:
+        cat.rebuild()
+        filenames = cat.find(subject='test001', paradigm='2afc', minTrials=300)
+"""
+
+import os
+import re
+import sqlite3
+import concurrent.futures
+import numpy as np
+from . import sessionreader
+
+CATALOG_FILENAME = 'catalog.sqlite'
+DATA_FILE_EXT = '.h5'
+DB_TIMEOUT = 10.0  # Time (sec) to wait for other processes that are writing to the catalog
+
+# -- Names of data files (see savedata.SaveData._make_filename) --
+FILENAME_PATTERN = re.compile(r'^(?P<subject>.+?)_(?P<paradigm>.+)_' +
+                              r'(?P<date>\d{8})(?P<suffix>[a-z]*)\.h5$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    filename TEXT PRIMARY KEY,
+    experimenter TEXT,
+    subject TEXT,
+    paradigm TEXT,
+    date TEXT,
+    suffix TEXT,
+    hostname TEXT,
+    nTrials INTEGER,
+    fileSize INTEGER,
+    fileMtime REAL
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    filename TEXT REFERENCES sessions(filename) ON DELETE CASCADE,
+    name TEXT,
+    firstValue REAL,
+    lastValue REAL,
+    minValue REAL,
+    maxValue REAL,
+    PRIMARY KEY (filename, name)
+);
+CREATE INDEX IF NOT EXISTS sessionsSubject ON sessions(subject, paradigm, date);
+CREATE INDEX IF NOT EXISTS sessionsParadigm ON sessions(paradigm, date);
+CREATE INDEX IF NOT EXISTS parametersName ON parameters(name);
+"""
+
+SESSION_COLUMNS = ['filename', 'experimenter', 'subject', 'paradigm', 'date', 'suffix',
+                   'hostname', 'nTrials', 'fileSize', 'fileMtime']
+
+
+def parse_filename(filename):
+    """
+    Return a dictionary with the subject, paradigm, date and suffix in the name of a data file
+    (empty if the name does not follow the pattern used by SaveData).
+    """
+    nameParts = FILENAME_PATTERN.match(os.path.basename(filename))
+    return nameParts.groupdict() if nameParts else {}
+
+
+def session_info(datadir, filename):
+    """
+    Read the metadata of one session from its data file.
+
+    Args:
+        datadir (str): data root directory.
+        filename (str): path of the data file relative to datadir.
+    Returns:
+        info (dict): values for each of SESSION_COLUMNS.
+        params (list): tuples (name, firstValue, lastValue, minValue, maxValue) for each
+            numeric variable in resultsData.
+    """
+    fullpath = os.path.join(datadir, filename)
+    fileStat = os.stat(fullpath)
+    relativePath = os.path.dirname(filename)
+    info = dict.fromkeys(SESSION_COLUMNS)
+    info.update(filename=filename, fileSize=fileStat.st_size, fileMtime=fileStat.st_mtime)
+    # -- Files are saved in datadir/experimenter/subject/ or datadir/subject/ --
+    if os.path.dirname(relativePath):
+        info['experimenter'] = os.path.dirname(relativePath)
+    info.update(parse_filename(filename))
+    params = []
+    with sessionreader.SessionReader(fullpath, memmap=False) as session:
+        for key in ['experimenter', 'subject', 'hostname']:
+            if key in session.sessionData and session.sessionData[key]:
+                info[key] = session.sessionData[key]
+        info['nTrials'] = session.nTrials
+        for key in session.resultsData:
+            values = session.resultsData[key]
+            if np.ndim(values) != 1 or len(values) == 0 or values.dtype.kind not in 'biuf':
+                continue
+            params.append((key, float(values[0]), float(values[-1]),
+                           float(np.min(values)), float(np.max(values))))
+    return (info, params)
+
+
+def _session_info_or_error(datadir, filename):
+    """Run session_info(), returning the error message (instead of raising it) if it fails."""
+    try:
+        return session_info(datadir, filename)
+    except Exception as exc:  # pylint: disable=broad-except
+        return str(exc)
+
+
+def find_data_files(datadir):
+    """Return the paths (relative to datadir) of all data files in datadir."""
+    filenames = []
+    for dirpath, dirnames, files in os.walk(datadir):
+        for oneFile in files:
+            if oneFile.endswith(DATA_FILE_EXT):  # Journal files (.h5.part) are not included
+                filenames.append(os.path.relpath(os.path.join(dirpath, oneFile), datadir))
+    return sorted(filenames)
+
+
+class Catalog(object):
+    """
+    SQLite catalog of the sessions in a data directory.
+    """
+    def __init__(self, datadir, dbfile=None):
+        """
+        Args:
+            datadir (str): data root directory.
+            dbfile (str): catalog file. If none given, CATALOG_FILENAME in datadir is used.
+        """
+        self.datadir = datadir
+        if dbfile is None:
+            dbfile = os.path.join(datadir, CATALOG_FILENAME)
+        self.dbfile = dbfile
+        self.connection = sqlite3.connect(dbfile, timeout=DB_TIMEOUT)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(SCHEMA)
+
+    def _relative_path(self, filename):
+        """Return the path of a data file relative to datadir."""
+        if os.path.isabs(filename):
+            filename = os.path.relpath(filename, self.datadir)
+        return os.path.normpath(filename)
+
+    def _store(self, info, params):
+        """Add (or replace) one session in the catalog. The caller must commit."""
+        placeholders = ','.join(['?']*len(SESSION_COLUMNS))
+        self.connection.execute('DELETE FROM parameters WHERE filename=?', (info['filename'],))
+        self.connection.execute('INSERT OR REPLACE INTO sessions ({0}) VALUES ({1})'.format(
+            ','.join(SESSION_COLUMNS), placeholders), [info[col] for col in SESSION_COLUMNS])
+        self.connection.executemany('INSERT INTO parameters VALUES (?,?,?,?,?,?)',
+                                    [(info['filename'],)+oneParam for oneParam in params])
+
+    def is_current(self, filename):
+        """Return True if the catalog has a session and its file has not changed since then."""
+        filename = self._relative_path(filename)
+        row = self.connection.execute('SELECT fileSize, fileMtime FROM sessions ' +
+                                      'WHERE filename=?', (filename,)).fetchone()
+        if row is None:
+            return False
+        fileStat = os.stat(os.path.join(self.datadir, filename))
+        return (row['fileSize'] == fileStat.st_size) and (row['fileMtime'] == fileStat.st_mtime)
+
+    def update(self, filename, force=False):
+        """
+        Add one data file to the catalog (or update it if it changed).
+
+        Args:
+            filename (str): full path or path relative to datadir.
+            force (bool): if True, read the file even if it has not changed.
+        """
+        filename = self._relative_path(filename)
+        if not force and self.is_current(filename):
+            return
+        (info, params) = session_info(self.datadir, filename)
+        with self.connection:
+            self._store(info, params)
+
+    def remove(self, filename):
+        """Remove one data file from the catalog."""
+        with self.connection:
+            self.connection.execute('DELETE FROM sessions WHERE filename=?',
+                                    (self._relative_path(filename),))
+
+    def rebuild(self, nProcesses=None, force=False):
+        """
+        Scan the data directory and update the catalog.
+
+        Files are read by a pool of processes. Files that have not changed since they
+        were added are skipped (unless force=True), and sessions whose files no longer
+        exist are removed.
+
+        Args:
+            nProcesses (int): number of processes. If none given, one per CPU.
+        Returns:
+            errors (dict): error message for each file that could not be read.
+        """
+        filenames = find_data_files(self.datadir)
+        storedFiles = set(row['filename'] for row in
+                          self.connection.execute('SELECT filename FROM sessions'))
+        with self.connection:
+            self.connection.executemany('DELETE FROM sessions WHERE filename=?',
+                                        [(oneFile,) for oneFile in
+                                         storedFiles.difference(filenames)])
+        if not force:
+            filenames = [oneFile for oneFile in filenames if not self.is_current(oneFile)]
+        errors = {}
+        if not filenames:
+            return errors
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nProcesses) as executor:
+            results = executor.map(_session_info_or_error, [self.datadir]*len(filenames),
+                                   filenames, chunksize=16)
+            with self.connection:
+                for filename, result in zip(filenames, results):
+                    if isinstance(result, str):
+                        errors[filename] = result
+                    else:
+                        self._store(*result)
+        return errors
+
+    def find(self, subject=None, paradigm=None, experimenter=None, dateRange=None,
+             minTrials=None, columns=('filename',)):
+        """
+        Find sessions that match all the given conditions.
+
+        Args:
+            dateRange (tuple): first and last dates (inclusive) as strings 'YYYYMMDD'.
+            minTrials (int): minimum number of trials.
+            columns (tuple): columns (from SESSION_COLUMNS) to return.
+        Returns:
+            sessions (list): values of the columns for each session (sorted by date),
+                or only the filenames if columns=('filename',).
+        """
+        conditions = []
+        values = []
+        for column, value in [('subject', subject), ('paradigm', paradigm),
+                              ('experimenter', experimenter)]:
+            if value is not None:
+                conditions.append('{0}=?'.format(column))
+                values.append(value)
+        if dateRange is not None:
+            conditions.append('date BETWEEN ? AND ?')
+            values.extend(dateRange)
+        if minTrials is not None:
+            conditions.append('nTrials>=?')
+            values.append(minTrials)
+        return self.query(conditions, values, columns)
+
+    def find_by_parameter(self, name, minValue=None, maxValue=None, columns=('filename',)):
+        """
+        Find sessions where all values of a parameter are within [minValue, maxValue].
+        """
+        conditions = ['filename IN (SELECT filename FROM parameters WHERE name=?']
+        values = [name]
+        if minValue is not None:
+            conditions[0] += ' AND minValue>=?'
+            values.append(minValue)
+        if maxValue is not None:
+            conditions[0] += ' AND maxValue<=?'
+            values.append(maxValue)
+        conditions[0] += ')'
+        return self.query(conditions, values, columns)
+
+    def query(self, conditions, values, columns=('filename',)):
+        """
+        Return sessions that match a list of SQL conditions (with '?' for each value).
+        """
+        for column in columns:
+            if column not in SESSION_COLUMNS:
+                raise ValueError('"{0}" is not a column of the catalog.'.format(column))
+        sql = 'SELECT {0} FROM sessions'.format(','.join(columns))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY date, suffix, filename'
+        rows = self.connection.execute(sql, values).fetchall()
+        if tuple(columns) == ('filename',):
+            return [row['filename'] for row in rows]
+        return [tuple(row) for row in rows]
+
+    def parameters(self, filename):
+        """Return the summary (first, last, min, max) of each parameter of one session."""
+        rows = self.connection.execute('SELECT name, firstValue, lastValue, minValue, ' +
+                                       'maxValue FROM parameters WHERE filename=?',
+                                       (self._relative_path(filename),))
+        return {row['name']: tuple(row)[1:] for row in rows}
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def update_catalog(datadir, filename):
+    """Add one data file to the catalog of datadir (creating the catalog if needed)."""
+    with Catalog(datadir) as cat:
+        cat.update(filename, force=True)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    if len(sys.argv) < 2:
+        print('Usage: python -m taskontrol.catalog DATADIR')
+        sys.exit(1)
+    tstart = time.time()
+    with Catalog(sys.argv[1]) as cat:
+        errors = cat.rebuild()
+        print('Catalog has {0} sessions ({1:0.1f} sec).'.format(len(cat), time.time()-tstart))
+    for filename, message in errors.items():
+        print('Error reading {0}: {1}'.format(filename, message))
@@ -11,8 +11,10 @@ has been prepared and ready to start.
 from qtpy import QtCore
 from qtpy import QtGui
 from qtpy import QtWidgets
+import time
 import numpy as np
 from . import rigsettings
+from . import utils
 
 
 DEFAULT_PREPARE_NEXT = 0  # State to prepare next trial
@@ -21,6 +23,52 @@ N_OUTPUTS = len(rigsettings.OUTPUTS)
 
 BUTTON_COLORS = {'start': 'limegreen', 'stop': 'red'}
 
+EVENTS_CHUNK_ROWS = 4096  # Rows per chunk when saving events
+
+EVENTS_DTYPE = np.dtype([('eventTime', np.float64),
+                         ('eventCode', np.int16),
+                         ('nextState', np.int16)])
+
+
+class EventsLog(utils.GrowableArray):
+    """
+    Array with all events (eventTime, eventCode, nextState) of a session.
+
+    Indexing returns views of a structured array, so each event can still
+    be accessed as eventsLog[ind][0], eventsLog[ind][1], eventsLog[ind][2].
+    """
+    def __init__(self, capacity=4096):
+        super().__init__(dtype=EVENTS_DTYPE, capacity=capacity)
+
+    def extend(self, newEvents):
+        """
+        Append events given as an array of size [nEvents,3] or a list of lists.
+        """
+        if len(newEvents) == 0:
+            return
+        newEvents = np.asarray(newEvents)
+        if newEvents.dtype.names is not None:
+            super().extend(newEvents)
+            return
+        nNew = len(newEvents)
+        self.reserve(self._size+nNew)
+        newSlice = slice(self._size, self._size+nNew)
+        for indcol, fieldName in enumerate(EVENTS_DTYPE.names):
+            self._buffer[fieldName][newSlice] = newEvents[:, indcol]
+        self._size += nNew
+
+    def column(self, fieldName):
+        """Return a view of one column: 'eventTime', 'eventCode' or 'nextState'."""
+        return self.data[fieldName]
+
+    def as_matrix(self, start=0, stop=None):
+        """Return events from start to stop as a float array of size [nEvents,3]."""
+        eventsView = self.data[start:stop]
+        eventsMatrix = np.empty((len(eventsView), 3))
+        for indcol, fieldName in enumerate(EVENTS_DTYPE.names):
+            eventsMatrix[:, indcol] = eventsView[fieldName]
+        return eventsMatrix
+
 
 class Dispatcher(QtCore.QObject):
     """
@@ -28,7 +76,8 @@ class Dispatcher(QtCore.QObject):
     trial-structured paradigm and the state machine.
 
     It emits the following signals:
-    timerTic        : at every tic of the dispatcher timer.
+    timerTic        : at every tic of the dispatcher timer (or every time events
+                      are received, when the dispatcher is event-driven).
                       It sends: serverTime, currentState, eventCount, currentTrial
     prepareNextTrial: whenever one of the prepare-next-trial-states is reached.
                       It sends: 'nextTrial'
@@ -41,9 +90,11 @@ class Dispatcher(QtCore.QObject):
     timerTic = QtCore.Signal(float, int, int, int)
     prepareNextTrial = QtCore.Signal(int)
     logMessage = QtCore.Signal(str)
+    eventsReceived = QtCore.Signal(float, object)  # Emitted by the events reader thread
+    eventsPushFailed = QtCore.Signal(str)  # Emitted by the events reader thread
 
     def __init__(self, parent=None, serverType='dummy', connectnow=True, interval=0.3,
-                 nInputs=N_INPUTS, nOutputs=N_OUTPUTS, gui=True):
+                 nInputs=N_INPUTS, nOutputs=N_OUTPUTS, gui=True, eventdriven=False):
         """
         Args:
             parent (QObject)
@@ -53,6 +104,9 @@ class Dispatcher(QtCore.QObject):
             nInputs (int): number of inputs of the system.
             nOutputs (int): number of output of the system.
             gui (bool): whether to create a dispatcher graphical interface.
+            eventdriven (bool): whether the state machine should push events as they
+                happen instead of being polled every 'interval'. This is only available
+                for the 'arduino_due' server. Other servers always use polling.
         """
         super(Dispatcher, self).__init__(parent)
 
@@ -74,6 +128,17 @@ class Dispatcher(QtCore.QObject):
         self.nOutputs = nOutputs
         self.isConnected = False
         self.statemachine = smclient.StateMachineClient(connectnow=False)
+        self.useStatusSnapshot = False  # Get time, state and events in one transaction
+        self.queryLatency = utils.LatencyHistogram()  # Duration of each query to the server
+        self.useLoadProgram = False  # Send matrix, outputs and timers in one transaction
+        self.uploadDuration = utils.LatencyHistogram(maxLatency=10.0)  # Time to send each matrix
+        self.usePatchProgram = False  # Send only the states that changed since the last upload
+        self.uploadedProgram = None  # Arrays of the last program sent (to find what changed)
+        self.lastUploadBytes = 0  # Size of the last program sent (if using LOAD_PROGRAM)
+        self.uploadBytesThisTrial = 0  # Bytes sent while preparing the current trial
+        self.uploadBytesEachTrial = utils.GrowableArray(dtype=int)  # Bytes sent for each trial
+        self.eventDrivenRequested = eventdriven
+        self.eventDriven = False  # Set by connect_to_sm() if the server supports push mode
 
         if connectnow:
             self.connect_to_sm()  # Connect to state machine
@@ -83,15 +148,22 @@ class Dispatcher(QtCore.QObject):
         self.currentState = 0   # State of the state machine
         self.eventCount = 0     # Number of events so far
         self.currentTrial = -1  # Current trial (first trial will be 0)
-        self.lastEvents = []    # List of lists with info about last events
-        self.eventsMat = []     # List of lists with info about all events
+        self.lastEvents = []    # Array with info about last events
+        self.eventsMat = EventsLog()  # Array with info about all events
         self.indexLastEventEachTrial = []  # index of last event for each trial
+        # Index of each event that entered one of the prepare-next-trial states
+        self.indexPrepareNextEvents = utils.GrowableArray(dtype=int)
+        self.lastTrialBorderIndex = -1  # Last of indexPrepareNextEvents already handled
 
         # -- Create timer --
         self.interval = interval  # Polling interval (sec)
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.timeout)
 
+        # -- Receive events pushed by the state machine (instead of polling) --
+        self.eventsReceived.connect(self.process_pushed_events)
+        self.eventsPushFailed.connect(self.fall_back_to_polling)
+
         # -- Create GUI --
         if gui:
             self.widget = DispatcherGUI(model=self)
@@ -107,6 +179,19 @@ class Dispatcher(QtCore.QObject):
         """
         self.statemachine.connect()
         self.statemachine.set_sizes(self.nInputs, self.nOutputs, 0)  # No extraTimers by default
+        self.useStatusSnapshot = (hasattr(self.statemachine, 'supports') and
+                                  self.statemachine.supports('statusSnapshot'))
+        self.useLoadProgram = (hasattr(self.statemachine, 'supports') and
+                               self.statemachine.supports('loadProgram'))
+        self.usePatchProgram = (self.useLoadProgram and
+                                self.statemachine.supports('patchProgram'))
+        self.eventDriven = (self.eventDrivenRequested and
+                            hasattr(self.statemachine, 'supports') and
+                            self.statemachine.supports('eventsPush'))
+        if self.eventDrivenRequested and not self.eventDriven:
+            print('WARNING: the state machine server does not support push mode. ' +
+                  'Polling it instead.')
+        self.uploadedProgram = None
         self.isConnected = True
 
     def reset_state_matrix(self):
@@ -132,14 +217,14 @@ class Dispatcher(QtCore.QObject):
                                stateMatrix.get_serial_outputs(),
                                stateMatrix.get_state_timers(),
                                stateMatrix.get_extra_timers(),
-                               stateMatrix.get_extra_triggers())
+                               stateMatrix.get_extra_triggers(),
+                               uploadCache=stateMatrix.uploadCache)
 
     def _set_state_matrix(self, stateMatrix, stateOutputs, serialOutputs, stateTimers,
-                          extraTimers=None, extraTriggers=None):
+                          extraTimers=None, extraTriggers=None, uploadCache=None):
         """
-        Send state transition matrix, outputs and timers to server, given python lists.
-
-        Inputs must be python lists (2D), not numpy arrays.
+        Send state transition matrix, outputs and timers to server, given python lists
+        or numpy arrays.
 
         Args:
             stateMatrix: [nStates][nActions]  (where nActions is 2*nInputs+1+nExtraTimers)
@@ -149,9 +234,20 @@ class Dispatcher(QtCore.QObject):
             stateTimers: [nStates] (in sec)
             extraTimers: [nExtratimers] duration of each extra-timer in sec.
             extraTriggers: [nExtratimers] state that triggers each extra-timer.
+            uploadCache: dict to store data computed for uploading this matrix,
+                      which is reused if the same matrix is uploaded again.
         """
         # -- Set prepare next trial states --
-        if self.isConnected:
+        if self.isConnected and self.useLoadProgram:
+            uploadStart = time.perf_counter()
+            if extraTimers is None:
+                extraTimers, extraTriggers = [], []
+            self.lastUploadBytes = self._upload_program(stateMatrix, stateOutputs, serialOutputs,
+                                                        stateTimers, extraTimers, extraTriggers,
+                                                        uploadCache)
+            self.uploadBytesThisTrial += self.lastUploadBytes
+            self.uploadDuration.add(time.perf_counter()-uploadStart)
+        elif self.isConnected:
             if extraTimers is not None:
                 nExtraTimers = len(extraTimers)
                 self.statemachine.set_sizes(self.nInputs, self.nOutputs, nExtraTimers)
@@ -160,12 +256,95 @@ class Dispatcher(QtCore.QObject):
                 self.statemachine.set_extra_triggers(extraTriggers)
             self.statemachine.set_state_matrix(stateMatrix)
             self.statemachine.set_state_outputs(stateOutputs)
-            if serialOutputs:
+            if serialOutputs is not None:
                 self.statemachine.set_serial_outputs(serialOutputs)
             self.statemachine.set_state_timers(stateTimers)
         else:
             print('Call to setStateMatrix, but the client is not connected.\n')
 
+    def _upload_program(self, stateMatrix, stateOutputs, serialOutputs, stateTimers,
+                        extraTimers, extraTriggers, uploadCache=None):
+        """
+        Send a program to the server, patching only the states and extra timers
+        that changed since the last upload (when sizes have not changed).
+
+        If uploadCache (a dict) is given, the arrays of the program and the message
+        for LOAD_PROGRAM are taken from it (or stored in it), so they are not computed
+        again for the same matrix. Patches are not stored, since they depend on the
+        program uploaded before.
+
+        Returns:
+            nBytes (int): number of bytes sent.
+        """
+        nStates = len(stateMatrix)
+        if serialOutputs is None:
+            serialOutputs = np.zeros(nStates, dtype=int)
+        cacheKey = ('program', self.nInputs)
+        if uploadCache is not None and cacheKey in uploadCache:
+            program = uploadCache[cacheKey]
+        else:
+            program = self._program_arrays(stateMatrix, stateOutputs, serialOutputs,
+                                           stateTimers, extraTimers, extraTriggers)
+            if uploadCache is not None:
+                uploadCache[cacheKey] = program
+        previous = self.uploadedProgram
+        self.uploadedProgram = None  # In case the upload fails
+        if self.usePatchProgram and previous is program:
+            changedStates = changedTimers = []  # The same matrix was uploaded last time
+        elif (self.usePatchProgram and previous is not None and
+              all(previous[key].shape == program[key].shape for key in program)):
+            changedStates = np.flatnonzero(np.any(program['matrix'] != previous['matrix'], axis=1) |
+                                           np.any(program['outputs'] != previous['outputs'], axis=1) |
+                                           (program['serial'] != previous['serial']) |
+                                           (program['timersMs'] != previous['timersMs']))
+            changedTimers = np.flatnonzero((program['extraTimersMs'] != previous['extraTimersMs']) |
+                                           (program['extraTriggers'] != previous['extraTriggers']))
+        else:
+            changedStates = np.arange(nStates)
+            changedTimers = np.arange(len(extraTimers))
+        if len(changedStates) == 0 and len(changedTimers) == 0:
+            nBytes = 0
+        elif len(changedStates) < nStates:
+            nBytes = self.statemachine.patch_program(changedStates,
+                                                     program['matrix'][changedStates],
+                                                     program['outputs'][changedStates],
+                                                     program['serial'][changedStates],
+                                                     program['timers'][changedStates],
+                                                     changedTimers,
+                                                     program['extraTimers'][changedTimers],
+                                                     program['extraTriggers'][changedTimers])
+        else:
+            messageKey = ('loadMessage', self.nInputs)
+            message = uploadCache.get(messageKey) if uploadCache is not None else None
+            if message is None:
+                from taskontrol import smclient  # Only this client supports LOAD_PROGRAM
+                message = smclient.build_program(self.nInputs, stateMatrix, stateOutputs,
+                                                 serialOutputs, stateTimers,
+                                                 extraTimers, extraTriggers)
+                if uploadCache is not None:
+                    uploadCache[messageKey] = message
+            nBytes = self.statemachine.load_program(self.nInputs, stateMatrix, stateOutputs,
+                                                    serialOutputs, stateTimers,
+                                                    extraTimers, extraTriggers, message=message)
+        self.uploadedProgram = program
+        return nBytes
+
+    def _program_arrays(self, stateMatrix, stateOutputs, serialOutputs, stateTimers,
+                        extraTimers, extraTriggers):
+        """
+        Convert a program to arrays, with timers also in milliseconds (as sent to the server).
+        """
+        nStates = len(stateMatrix)
+        program = {'matrix': np.array(stateMatrix, dtype=int),
+                   'outputs': np.array(stateOutputs, dtype=int).reshape(nStates, -1),
+                   'serial': np.array(serialOutputs, dtype=int),
+                   'timers': np.array(stateTimers, dtype=float),
+                   'extraTimers': np.array(extraTimers, dtype=float),
+                   'extraTriggers': np.array(extraTriggers, dtype=int)}
+        program['timersMs'] = (1e3*program['timers']).astype(int)
+        program['extraTimersMs'] = (1e3*program['extraTimers']).astype(int)
+        return program
+
     def _set_prepare_next_trial_states(self, prepareNextTrialStatesAsStrings, statesDict):
         """
         Defines the list of states from which the state machine returns control
@@ -182,6 +361,8 @@ class Dispatcher(QtCore.QObject):
         Tell the state machine that it can jump to state 1 and start new trial.
         """
         self.currentTrial += 1
+        self.uploadBytesEachTrial.append(self.uploadBytesThisTrial)
+        self.uploadBytesThisTrial = 0
         self.statemachine.force_state(1)
         self.preparingNextTrial = False
 
@@ -192,9 +373,49 @@ class Dispatcher(QtCore.QObject):
         self.query_state_machine()
         self.timerTic.emit(self.serverTime, self.currentState, self.eventCount, self.currentTrial)
         if self.currentState in self.prepareNextTrialStates:
-            self.preparingNextTrial = True
-            self.update_trial_borders()
-            self.prepareNextTrial.emit(self.currentTrial+1)
+            self._start_preparing_next_trial()
+
+    @QtCore.Slot(float, object)
+    def process_pushed_events(self, serverTime, newEvents):
+        """
+        Run every time the state machine pushes events (when event-driven).
+
+        The next trial is prepared only when one of the new events entered a
+        prepare-next-trial state, so a packet sent before the state machine
+        received the request to start the trial does not trigger it again.
+        """
+        self.serverTime = serverTime
+        nPrepareNext = self.add_events(newEvents)
+        self.timerTic.emit(self.serverTime, self.currentState, self.eventCount, self.currentTrial)
+        if nPrepareNext and (self.currentState in self.prepareNextTrialStates):
+            self._start_preparing_next_trial()
+
+    def _events_pushed(self, serverTime, newEvents):
+        """
+        Called from the events reader thread. The signal passes the data to the Qt thread.
+        """
+        self.eventsReceived.emit(serverTime, newEvents)
+
+    def _events_push_failed(self, error):
+        """Called from the events reader thread if it stopped because of an error."""
+        self.eventsPushFailed.emit(str(error))
+
+    @QtCore.Slot(str)
+    def fall_back_to_polling(self, errorMessage):
+        """
+        Stop push mode (after the events reader failed) and poll the state machine instead.
+        Events pushed while the error happened may be lost.
+        """
+        self.logMessage.emit('Receiving events failed ({0}). '.format(errorMessage) +
+                             'Polling the state machine instead.')
+        self.eventDriven = False
+        self.statemachine.abort_events_push()
+        self.timer.start(int(1e3*self.interval))  # timer takes interval in ms
+
+    def _start_preparing_next_trial(self):
+        self.preparingNextTrial = True
+        self.update_trial_borders()
+        self.prepareNextTrial.emit(self.currentTrial+1)
 
     def get_state(self):
         """
@@ -205,7 +426,8 @@ class Dispatcher(QtCore.QObject):
     @QtCore.Slot()
     def resume(self):
         # --- Start timer ---
-        self.timer.start(int(1e3*self.interval))  # timer takes interval in ms
+        if not self.eventDriven:
+            self.timer.start(int(1e3*self.interval))  # timer takes interval in ms
         # -- Start state machine --
         if self.isConnected:
             self.statemachine.run()
@@ -214,6 +436,9 @@ class Dispatcher(QtCore.QObject):
             # this is also emitted when timeout() encounters end of trial
             # self.prepareNextTrial.emit(self.currentTrial+1)
             self.timeout()
+            if self.eventDriven:
+                self.statemachine.start_events_push(self._events_pushed,
+                                                    self._events_push_failed)
         else:
             print('The dispatcher is not connected to the state machine server.')
 
@@ -223,6 +448,8 @@ class Dispatcher(QtCore.QObject):
         self.timer.stop()
         # -- Stop state machine --
         if self.isConnected:
+            if self.eventDriven and self.statemachine.eventsReader is not None:
+                self.statemachine.stop_events_push()
             self.statemachine.stop()
             self.statemachine.force_state(0)
             for indout in range(self.nOutputs):
@@ -236,34 +463,66 @@ class Dispatcher(QtCore.QObject):
         Request events information to the state machine.
         """
         if self.isConnected:
-            self.serverTime = self.statemachine.get_time()
-            self.lastEvents = self.statemachine.get_events()
-            if len(self.lastEvents) > 0:
-                self.eventsMat.extend(self.lastEvents)
-                self.currentState = self.eventsMat[-1][2]
-                self.eventCount = len(self.eventsMat)
-                # FIXME: this may fail if eventsMat is empty on the first call
+            queryStart = time.perf_counter()
+            if self.useStatusSnapshot:
+                (self.serverTime, serverState, newEvents) = self.statemachine.get_status()
+            else:
+                self.serverTime = self.statemachine.get_time()
+                newEvents = self.statemachine.get_events()
+            self.queryLatency.add(time.perf_counter()-queryStart)
+            self.add_events(newEvents)
+            if self.useStatusSnapshot:
+                self.currentState = serverState
+
+    def add_events(self, newEvents):
+        """
+        Append new events to the log and update the current state.
+        Returns the number of new events that entered a prepare-next-trial state.
+        """
+        self.lastEvents = newEvents
+        if len(newEvents) == 0:
+            return 0
+        firstNewEvent = len(self.eventsMat)
+        self.eventsMat.extend(newEvents)
+        self.currentState = int(self.eventsMat[-1]['nextState'])
+        self.eventCount = len(self.eventsMat)
+        return self.find_prepare_next_events(firstNewEvent)
+
+    def find_prepare_next_events(self, firstNewEvent):
+        """
+        Store the index of new events that entered one of the prepare-next-trial states.
+        Only events from firstNewEvent onwards are checked.
+        Returns the number of events found.
+        """
+        newStates = self.eventsMat.column('nextState')[firstNewEvent:]
+        newInds = np.flatnonzero(np.isin(newStates, self.prepareNextTrialStates))
+        if len(newInds):
+            self.indexPrepareNextEvents.extend(newInds+firstNewEvent)
+        return len(newInds)
 
     def update_trial_borders(self):
         """
-        Find last index of last trial.
-        It looks for state zero, which corresponds to the last state no each trial.
-        The first event of all is also state zero, but this one is ignored.
+        Store the index of the last event of the trial that just ended.
+        This is the last event that entered one of the prepare-next-trial states.
+        The first event of all is also a prepare-next-trial state, but this one is ignored.
+        An event already handled is not stored again (if no new one arrived since).
         """
-        # FIXME: slow way to find end of trial
-        if self.currentTrial >= 0:   # & self.eventCount>0:
-            for inde in range(self.eventCount-1, -1, -1):  # This will count from n to 0
-                if self.eventsMat[inde][2] == DEFAULT_PREPARE_NEXT:
-                    self.indexLastEventEachTrial.append(inde)
-                    break
+        if len(self.indexPrepareNextEvents):
+            indexLastEvent = int(self.indexPrepareNextEvents[-1])
+            if indexLastEvent == self.lastTrialBorderIndex:
+                return
+            self.lastTrialBorderIndex = indexLastEvent
+            if self.currentTrial >= 0:
+                self.indexLastEventEachTrial.append(indexLastEvent)
         # WARNING: make sure this method is not called before the events
         #          at the end of the trials are sent to the client/dispatcher
-        # FIXME: this function has not been tested with more than one state
-        #        in prepareNextTrialStates.
 
-    def events_one_trial(self, trialID):
+    def events_one_trial(self, trialID, structured=False):
         """
-        Return events for one trial as a numpy array.
+        Return events for one trial as a numpy array of size [nEvents,3].
+
+        If structured=True, it returns instead a view (not a copy) of the events log
+        as a structured array with fields 'eventTime', 'eventCode', 'nextState'.
         """
         # if trialID<0: eventsThisTrial = np.empty((0,3)) # NOTE: hardcoded size
         indLast = self.indexLastEventEachTrial[-1]
@@ -271,30 +530,48 @@ class Dispatcher(QtCore.QObject):
             indPrev = 0
         else:
             indPrev = self.indexLastEventEachTrial[-2]
-        # -- Include the state 0 at the beginning of the trial --
-        # eventsThisTrial = self.eventsMat[indPrev:indLast+1] # eventsMat is a list
         # -- Do not include the state 0 at the beginning of the trial --
-        eventsThisTrial = self.eventsMat[indPrev+1:indLast+1]  # eventsMat is a list
-        return np.array(eventsThisTrial)
-        # FIXME: this seems inefficient because eventsMat is an array and we
-        #        need only a set of trials. Do we need to convert the whole thing?
+        if structured:
+            return self.eventsMat[indPrev+1:indLast+1]
+        else:
+            return self.eventsMat.as_matrix(indPrev+1, indLast+1)
 
     def append_to_file(self, h5file, currentTrial=None):
         """
         Add events information to an open HDF5 file.
         At this point, it ignores the value of 'currentTrial'.
+        If the file already has some events (see append_trial_to_file),
+        only the rest of the events are added.
         """
         if not (self.indexLastEventEachTrial):
             raise UserWarning('WARNING: No trials have been completed. No events were saved.')
-        eventsGroup = h5file.create_group('/events')  # Events that ocurred during the session
-        eventsMatrixAsArray = np.array(self.eventsMat)
-        eventsGroup.create_dataset('eventTime', dtype=float, data=eventsMatrixAsArray[:,0])
-        eventsGroup.create_dataset('eventCode', dtype=int, data=eventsMatrixAsArray[:,1])
-        eventsGroup.create_dataset('nextState', dtype=int, data=eventsMatrixAsArray[:,2])
-        eventsGroup.create_dataset('indexLastEventEachTrial', dtype=int,
-                                   data=np.array(self.indexLastEventEachTrial))
+        return self.append_trial_to_file(h5file, currentTrial)
+
+    def append_trial_to_file(self, h5file, currentTrial=None):
+        """
+        Add events not yet stored in an open HDF5 file.
+        In journal files, datasets are extendable, so this can be called after every trial.
+        """
+        eventsGroup = h5file.require_group('/events')  # Events that ocurred during the session
+        if utils.is_compact_layout(h5file):
+            eventsDtypes = [('eventTime', np.float64), ('eventCode', np.int16),
+                            ('nextState', np.int16)]
+        else:
+            eventsDtypes = [('eventTime', float), ('eventCode', int), ('nextState', int)]
+        for fieldName, dtype in eventsDtypes:
+            utils.append_new_rows(eventsGroup, fieldName, self.eventsMat.column(fieldName),
+                                  dtype=dtype, chunkrows=EVENTS_CHUNK_ROWS)
+        utils.append_new_rows(eventsGroup, 'indexLastEventEachTrial',
+                              np.array(self.indexLastEventEachTrial, dtype=int))
         return eventsGroup
 
+    def file_snapshot(self, currentTrial=None):
+        """
+        Return a copy of the events, which can be saved by another thread (see SaveData)
+        while new events are added.
+        """
+        return EventsSnapshot(self.eventsMat, self.indexLastEventEachTrial)
+
     def die(self):
         """
         Make sure timer stops when user closes the dispatcher.
@@ -307,6 +584,17 @@ class Dispatcher(QtCore.QObject):
             self.statemachine.close()
 
 
+class EventsSnapshot(object):
+    """Events copied by Dispatcher.file_snapshot(), saved like a Dispatcher."""
+    def __init__(self, eventsMat, indexLastEventEachTrial):
+        self.eventsMat = EventsLog(capacity=max(len(eventsMat), 1))
+        self.eventsMat.extend(eventsMat.data.copy())
+        self.indexLastEventEachTrial = list(indexLastEventEachTrial)
+
+    append_to_file = Dispatcher.append_to_file
+    append_trial_to_file = Dispatcher.append_trial_to_file
+
+
 class DispatcherGUI(QtWidgets.QGroupBox):
     """
     Graphical interface for the dispatcher.
@@ -0,0 +1,229 @@
+"""
+Export sessions to columnar (Parquet) files for analyses across many sessions.
+
+Each session is converted into two tables, saved with partitions by subject and date:
+``outdir/trials/subject=S/date=YYYYMMDD/SESSION.parquet``
+(one row per trial, one column per variable in resultsData) and
+``outdir/events/subject=S/date=YYYYMMDD/SESSION.parquet``
+(one row per event, with columns eventTime, eventCode, nextState and trial).
+Menu labels (resultsLabels) and sessionData are stored in the metadata of the trials table.
+
+This module requires pyarrow (which is only imported when exporting or loading data).
+
+Example:
+    export.export_sessions(datadir, outdir)
+    trials = export.dataset(outdir, 'trials').to_table(filter=...)
+"""
+
+import os
+import json
+import concurrent.futures
+import numpy as np
+from . import catalog
+from . import sessionreader
+
+TABLES = ['trials', 'events']
+PARQUET_EXT = '.parquet'
+PARQUET_COMPRESSION = 'zstd'
+UNKNOWN_PARTITION = 'unknown'  # Subject/date for files with names not created by SaveData
+
+
+def _import_pyarrow():
+    """Import pyarrow (only when needed, since other modules do not depend on it)."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.dataset
+    except ImportError:
+        raise ImportError('Exporting sessions requires the package pyarrow ' +
+                          '(pip install pyarrow).')
+    return pyarrow
+
+
+def output_filenames(outdir, filename):
+    """
+    Return the path of the output file for each table of a data file.
+
+    Args:
+        outdir (str): root directory of the exported tables.
+        filename (str): path of the data file (full or relative to the data directory).
+    Returns:
+        outputs (dict): full path for each name in TABLES.
+    """
+    nameParts = catalog.parse_filename(filename)
+    subject = nameParts.get('subject', UNKNOWN_PARTITION)
+    date = nameParts.get('date', UNKNOWN_PARTITION)
+    sessionName = os.path.splitext(os.path.basename(filename))[0]
+    return {table: os.path.join(outdir, table, 'subject='+subject, 'date='+date,
+                                sessionName+PARQUET_EXT) for table in TABLES}
+
+
+def is_exported(datafile, outdir):
+    """Return True if all tables of a data file exist and are newer than the data file."""
+    dataMtime = os.path.getmtime(datafile)
+    for outputFile in output_filenames(outdir, datafile).values():
+        if not os.path.exists(outputFile) or os.path.getmtime(outputFile) < dataMtime:
+            return False
+    return True
+
+
+def _standard_dtype(values):
+    """
+    Return values as int64 or float64, so columns have the same type in files saved
+    with any layout (Parquet encoding already makes small integers take little space).
+    """
+    if values.dtype.kind in 'biu':
+        return values.astype(np.int64)
+    return values.astype(np.float64)
+
+
+def session_tables(datafile):
+    """
+    Read the trials and events of one session.
+
+    Variables in resultsData with one value per trial become columns of the trials table
+    (all truncated to the number of values of the shortest one).
+
+    Returns:
+        tables (dict): a pyarrow.Table for each name in TABLES.
+    """
+    pa = _import_pyarrow()
+    sessionName = os.path.splitext(os.path.basename(datafile))[0]
+    paradigm = catalog.parse_filename(datafile).get('paradigm', '')
+    with sessionreader.SessionReader(datafile, memmap=False) as session:
+        trialColumns = {}
+        for key in sorted(session.resultsData):
+            values = session.resultsData[key]
+            if np.ndim(values) == 1 and values.dtype.kind in 'biuf':
+                trialColumns[key] = _standard_dtype(values)
+        nTrials = min([len(values) for values in trialColumns.values()] or [0])
+        trialsTable = pa.table(dict([('trial', np.arange(nTrials))] +
+                                    [(key, values[:nTrials])
+                                     for key, values in trialColumns.items()]))
+        labels = {}
+        for key in session.resultsLabels:
+            labels[key] = {label: int(value) for label, value
+                           in session.resultsLabels[key].items() if isinstance(label, str)}
+        sessionData = {key: str(session.sessionData[key]) for key in session.sessionData
+                       if np.ndim(session.sessionData[key]) == 0}
+        metadata = {'resultsLabels': json.dumps(labels), 'sessionData': json.dumps(sessionData)}
+        eventsColumns = {}
+        for key in sessionreader.EVENTS_FIELDS:
+            if key in session.events:
+                eventsColumns[key] = _standard_dtype(session.events[key])
+        if 'indexLastEventEachTrial' in session.events and eventsColumns:
+            nEvents = len(eventsColumns[sessionreader.EVENTS_FIELDS[0]])
+            eventsColumns['trial'] = np.searchsorted(session.events['indexLastEventEachTrial'],
+                                                     np.arange(nEvents))
+        eventsTable = pa.table(eventsColumns)
+    tables = {'trials': trialsTable.replace_schema_metadata(metadata), 'events': eventsTable}
+    for table in TABLES:
+        tables[table] = tables[table].append_column(
+            'session', pa.array([sessionName]*tables[table].num_rows).dictionary_encode())
+        tables[table] = tables[table].append_column(
+            'paradigm', pa.array([paradigm]*tables[table].num_rows).dictionary_encode())
+    return tables
+
+
+def export_session(datafile, outdir, force=False):
+    """
+    Export one session (unless it has already been exported and force=False).
+
+    Each table is written to a temporary file and then renamed, so a conversion that
+    did not finish is not considered done.
+
+    Returns:
+        exported (bool): True if the session was exported, False if it was skipped.
+    """
+    if not force and is_exported(datafile, outdir):
+        return False
+    pa = _import_pyarrow()
+    tables = session_tables(datafile)
+    for table, outputFile in output_filenames(outdir, datafile).items():
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+        tmpFile = outputFile + '.tmp'
+        pa.parquet.write_table(tables[table], tmpFile, compression=PARQUET_COMPRESSION)
+        os.replace(tmpFile, outputFile)
+    return True
+
+
+def _export_session_or_error(datafile, outdir, force):
+    """Run export_session(), returning the error message (instead of raising it) if it fails."""
+    try:
+        return export_session(datafile, outdir, force)
+    except Exception as exc:  # pylint: disable=broad-except
+        return str(exc)
+
+
+def export_sessions(datadir, outdir, filenames=None, nProcesses=None, force=False):
+    """
+    Export sessions from a data directory using a pool of processes.
+
+    Args:
+        datadir (str): data root directory.
+        outdir (str): root directory of the exported tables.
+        filenames (list): paths relative to datadir (for example, from catalog.Catalog.find).
+            If none given, all data files in datadir are exported.
+        nProcesses (int): number of processes. If none given, one per CPU.
+        force (bool): if True, export sessions even if they were already exported.
+    Returns:
+        nExported (int): number of sessions exported (not counting the ones skipped).
+        errors (dict): error message for each file that could not be exported.
+    """
+    _import_pyarrow()
+    if filenames is None:
+        filenames = catalog.find_data_files(datadir)
+    datafiles = [os.path.join(datadir, filename) for filename in filenames]
+    if not force:
+        datafiles = [datafile for datafile in datafiles if not is_exported(datafile, outdir)]
+    nExported = 0
+    errors = {}
+    if not datafiles:
+        return (nExported, errors)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nProcesses) as executor:
+        results = executor.map(_export_session_or_error, datafiles, [outdir]*len(datafiles),
+                               [force]*len(datafiles), chunksize=8)
+        for datafile, result in zip(datafiles, results):
+            if isinstance(result, str):
+                errors[os.path.relpath(datafile, datadir)] = result
+            else:
+                nExported += result
+    return (nExported, errors)
+
+
+def dataset(outdir, table='trials', unifySchemas=False):
+    """
+    Return a pyarrow.dataset.Dataset with one table from all exported sessions.
+
+    The columns 'subject' and 'date' come from the partitions, so filters on them
+    only read the files of the matching sessions.
+
+    Args:
+        table (str): one of TABLES.
+        unifySchemas (bool): if True, include columns from all sessions (not only from
+            the first one), which requires reading the schema of every file.
+    """
+    pa = _import_pyarrow()
+    partitioning = pa.dataset.partitioning(pa.schema([('subject', pa.string()),
+                                                      ('date', pa.string())]), flavor='hive')
+    tableDir = os.path.join(outdir, table)
+    tableDataset = pa.dataset.dataset(tableDir, format='parquet', partitioning=partitioning)
+    if unifySchemas:
+        schemas = [fragment.physical_schema for fragment in tableDataset.get_fragments()]
+        schema = pa.unify_schemas(schemas + [partitioning.schema])
+        tableDataset = pa.dataset.dataset(tableDir, format='parquet', schema=schema,
+                                          partitioning=partitioning)
+    return tableDataset
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    if len(sys.argv) < 3:
+        print('Usage: python -m taskontrol.export DATADIR OUTDIR')
+        sys.exit(1)
+    tstart = time.time()
+    (nExported, errors) = export_sessions(sys.argv[1], sys.argv[2])
+    print('Exported {0} sessions ({1:0.1f} sec).'.format(nExported, time.time()-tstart))
+    for filename, message in errors.items():
+        print('Error exporting {0}: {1}'.format(filename, message))
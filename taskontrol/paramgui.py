@@ -16,6 +16,7 @@ from qtpy import QtCore
 from qtpy import QtWidgets
 #import imp
 import importlib
+import collections.abc
 import numpy as np  # To be able to save strings with np.string_()
 import signal
 import sys
@@ -25,12 +26,32 @@ from . import utils
 from . import rigsettings
 
 
+HISTORY_CAPACITY = 1024  # Number of trials allocated initially for the history of each parameter
+
+
 class Container(dict):
+    """
+    Dictionary of parameters, which also keeps the history of their values.
+
+    The history of all parameters (with history enabled) is stored in a table with
+    one row per trial and one field per parameter (int for menus and integer values,
+    float otherwise), so each trial appends a single row (see update_history).
+    self.history[key] is a view of the column of one parameter, so
+    self.history[key][trial] and slices of it work like on numpy arrays.
+
+    The history of string parameters is stored as int codes. Each string is added
+    once to self.stringCodes[key] (a dictionary {string:code}), which is saved
+    in resultsLabels like the items of menu parameters.
+    """
     def __init__(self):
         super(Container, self).__init__()
         self._groups = {}
         self._paramsToKeepHistory = []
-        self.history = {}
+        self._historyGetters = []  # Function that returns the value to store, for each param
+        self._historyTable = None  # utils.GrowableArray (structured) created by update_history
+        self._intFields = []  # Index of the fields of numeric params stored as int
+        self.history = HistoryView(self)
+        self.stringCodes = {}
 
     def __setitem__(self, paramName, paramInstance):
         # -- Check if there is already a parameter with that name --
@@ -51,10 +72,12 @@ class Container(dict):
             self._groups[groupName] = [paramName]
         # -- Append name of parameter to list of params to keep history --
         if historyEnabled:
-            try:
-                self._paramsToKeepHistory.append(paramName)
-            except KeyError:  # If group does not exist yet
-                self._paramsToKeepHistory = [paramName]
+            self._paramsToKeepHistory.append(paramName)
+            if paramInstance.get_type() == 'string':
+                self._historyGetters.append(lambda: self._string_code(paramName,
+                                                                      paramInstance.get_value()))
+            else:
+                self._historyGetters.append(paramInstance.get_value)
 
         # -- Add paramInstance to Container --
         dict.__setitem__(self, paramName, paramInstance)
@@ -74,15 +97,60 @@ class Container(dict):
         return groupBox
 
     def update_history(self, lastTrial=None):
-        """Append the value of each parameter (to track) for this trial."""
-        for key in self._paramsToKeepHistory:
-            try:
-                self.history[key].append(self[key].get_value())
-            except KeyError:  # If the key does not exist yet (e.g. first trial)
-                self.history[key] = [self[key].get_value()]
-            if lastTrial is not None:
-                msg = 'The length of the history does not match the number of trials.'
-                assert len(self.history[key])==lastTrial+1, msg
+        """
+        Append the value of each parameter (to track) for this trial, as one row
+        of the history table.
+
+        The table is created on the first trial. It is created again (copying the
+        trials already stored) if parameters were added, or if a numeric parameter
+        stored as int gets a value that is not an int (its field becomes float).
+        """
+        row = [get_value() for get_value in self._historyGetters]
+        table = self._historyTable
+        if table is None or len(row) != len(table.dtype.names):
+            table = self._new_history_table(row)
+        elif self._intFields and not all([type(row[ind]) is int for ind in self._intFields]):
+            table = self._new_history_table(row)
+        table.append(tuple(row))
+        if lastTrial is not None:
+            msg = 'The length of the history does not match the number of trials.'
+            assert len(table)==lastTrial+1, msg
+
+    def _new_history_table(self, row):
+        """
+        Create the history table (given the values of this trial), copying the trials
+        already stored. Fields of parameters added after the first trial are zero
+        for the earlier trials.
+        """
+        oldTable = self._historyTable
+        fields = []
+        for key, value in zip(self._paramsToKeepHistory, row):
+            if self[key].get_type() in ['menu', 'string']:
+                dtype = int
+            elif (oldTable is not None and key in oldTable.dtype.names and
+                  oldTable.dtype[key].kind == 'f'):
+                dtype = float
+            elif isinstance(value, (int, np.integer)):
+                dtype = int
+            else:
+                dtype = float
+            fields.append((key, dtype))
+        nTrials = 0 if oldTable is None else len(oldTable)
+        table = utils.GrowableArray(dtype=fields, capacity=max(HISTORY_CAPACITY, 2*nTrials))
+        if nTrials:
+            oldRows = np.zeros(nTrials, dtype=table.dtype)
+            for key in oldTable.dtype.names:
+                oldRows[key] = oldTable.data[key]
+            table.extend(oldRows)
+        self._intFields = [ind for ind, (key, dtype) in enumerate(fields)
+                           if dtype is int and self[key].get_type() == 'numeric']
+        self._historyTable = table
+        return table
+
+    def _string_code(self, key, value):
+        """Return the code of a string value of a parameter (adding new strings to the table)."""
+        codes = self.stringCodes.setdefault(key, {})
+        return codes.setdefault(value, len(codes))
 
     def set_values(self, valuesdict):
         """Set the value of many parameters at once.
@@ -121,47 +189,176 @@ class Container(dict):
         """
         Append parameters' history to an HDF5 file.
         It truncates data to the trial before currentTrial, because currentTrial has not ended.
+        If the file already has the history of some trials (see append_trial_to_file),
+        only the rest of the trials are added.
         """
-        dataParent = 'resultsData'      # Parameters from each trial
         itemsParent = 'resultsLabels'   # Items in menu parameters
         sessionParent = 'sessionData'   # Parameters for the whole session
-        # descriptionAttr = 'Description'
-        # FIXME: the contents of description should not be the label, but the
-        #        description of the parameter (including its units)
-        trialDataGroup = h5file.require_group(dataParent)
+        trialDataGroup = self.append_trial_to_file(h5file, currentTrial)
         menuItemsGroup = h5file.require_group(itemsParent)
         sessionDataGroup = h5file.require_group(sessionParent)
 
         # -- Append date/time and hostname --
+        for key in ['hostname', 'date']:
+            if key in sessionDataGroup:
+                del sessionDataGroup[key]
         dset = sessionDataGroup.create_dataset('hostname', data=socket.gethostname())
         dateAndTime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
         dset = sessionDataGroup.create_dataset('date', data=dateAndTime)
 
         # -- Append all other parameters --
         for key, item in self.items():
-            # -- Store parameters with history --
             if item.history_enabled():
-                if key not in self.history:
-                    raise ValueError('No history was recorded for "{0}". '.format(key) +
-                                     'Did you use paramgui.Container.update_history() correctly?')
-                dset = trialDataGroup.create_dataset(key, data=self.history[key][:currentTrial])
-                dset.attrs['Description'] = item.get_label()
-                if item.get_type() == 'numeric':
-                    dset.attrs['Units'] = item.get_units()
                 # FIXME: not very ObjectOriented to use getType
                 #        the object should be able to save itself
-                if item.get_type() == 'menu':
+                if item.get_type() == 'menu' and key not in menuItemsGroup:
                     menuList = item.get_items()
                     menuDict = dict(zip(menuList, range(len(menuList))))
                     utils.append_dict_to_HDF5(menuItemsGroup, key, menuDict)
-                    dset.attrs['Description'] = '{} menu items'.format(item.get_label())
             else:  # -- Store parameters without history (Session parameters) --
                 if item.get_type() == 'string':
+                    if key in sessionDataGroup:
+                        del sessionDataGroup[key]
                     dset = sessionDataGroup.create_dataset(key, data=np.string_(item.get_value()))
                 else:
+                    if key in trialDataGroup:
+                        del trialDataGroup[key]
                     dset = trialDataGroup.create_dataset(key, data=item.get_value())
                 dset.attrs['Description'] = item.get_label()
 
+    def append_trial_to_file(self, h5file, currentTrial):
+        """
+        Add the history of trials (up to currentTrial-1) not yet stored in an HDF5 file.
+        In journal files, datasets are extendable, so this can be called after every trial.
+        """
+        dataParent = 'resultsData'      # Parameters from each trial
+        # descriptionAttr = 'Description'
+        # FIXME: the contents of description should not be the label, but the
+        #        description of the parameter (including its units)
+        trialDataGroup = h5file.require_group(dataParent)
+        menuItemsGroup = h5file.require_group('resultsLabels')
+        compact = utils.is_compact_layout(h5file)
+        for key, item in self.items():
+            # -- Store parameters with history --
+            if item.history_enabled():
+                if key not in self.history:
+                    raise ValueError('No history was recorded for "{0}". '.format(key) +
+                                     'Did you use paramgui.Container.update_history() correctly?')
+                dtype = None
+                if compact and item.get_type() == 'menu':
+                    dtype = utils.smallest_int_dtype([0, len(item.get_items())-1])
+                (dset, created) = utils.append_new_rows(trialDataGroup, key,
+                                                        self.history[key][:currentTrial],
+                                                        dtype=dtype)
+                if created:
+                    dset.attrs['Description'] = item.get_label()
+                    if item.get_type() == 'numeric':
+                        dset.attrs['Units'] = item.get_units()
+                    if item.get_type() == 'menu':
+                        dset.attrs['Description'] = '{} menu items'.format(item.get_label())
+                    if item.get_type() == 'string':
+                        dset.attrs['Description'] = '{} string codes'.format(item.get_label())
+                # -- Menu items are saved with the first trial, so files being written
+                #    (see SaveData.start_journal) can be read with their labels --
+                if item.get_type() == 'menu' and key not in menuItemsGroup:
+                    menuList = item.get_items()
+                    menuDict = dict(zip(menuList, range(len(menuList))))
+                    utils.append_dict_to_HDF5(menuItemsGroup, key, menuDict)
+                if item.get_type() == 'string':
+                    self._append_string_codes(h5file, menuItemsGroup, key)
+        return trialDataGroup
+
+    def _append_string_codes(self, h5file, menuItemsGroup, key):
+        """
+        Save the table of strings of a parameter (again, if new strings were added).
+        In files open in SWMR mode (where objects cannot be created), strings added after
+        the first trial are only saved by append_to_file.
+        """
+        codes = self.stringCodes[key]
+        if key in menuItemsGroup:
+            if len(menuItemsGroup[key]) == len(codes) or getattr(h5file, 'swmr_mode', False):
+                return
+            del menuItemsGroup[key]
+        utils.append_dict_to_HDF5(menuItemsGroup, key, codes)
+
+    def file_snapshot(self, currentTrial):
+        """
+        Return a copy of the parameters and their history (up to currentTrial-1),
+        which can be saved by another thread (see SaveData) without reading the widgets.
+        """
+        snapshot = ContainerSnapshot()
+        for key, item in self.items():
+            snapshot[key] = FrozenParam(item)
+            if key in self.history:
+                snapshot.history[key] = np.array(self.history[key][:currentTrial])
+        snapshot.stringCodes = {key: dict(codes) for key, codes in self.stringCodes.items()}
+        return snapshot
+
+
+class FrozenParam(object):
+    """Values of a parameter (at the time it was created), with the same getters."""
+    def __init__(self, param):
+        self._type = param.get_type()
+        self._historyEnabled = param.history_enabled()
+        self._label = param.get_label()
+        self._value = param.get_value()
+        self._units = param.get_units() if self._type == 'numeric' else None
+        self._items = list(param.get_items()) if self._type == 'menu' else None
+
+    def get_type(self):
+        return self._type
+
+    def history_enabled(self):
+        return self._historyEnabled
+
+    def get_label(self):
+        return self._label
+
+    def get_value(self):
+        return self._value
+
+    def get_units(self):
+        return self._units
+
+    def get_items(self):
+        return self._items
+
+
+class ContainerSnapshot(dict):
+    """Parameters copied by Container.file_snapshot(), saved like a Container."""
+    def __init__(self):
+        super().__init__()
+        self.history = {}
+        self.stringCodes = {}
+
+    append_to_file = Container.append_to_file
+    append_trial_to_file = Container.append_trial_to_file
+    _append_string_codes = Container._append_string_codes
+
+
+class HistoryView(collections.abc.Mapping):
+    """
+    Read-only dictionary with the history of each parameter of a Container.
+    Each item is a view (not a copy) of one column of the history table.
+    """
+    def __init__(self, container):
+        self._container = container
+
+    def _names(self):
+        table = self._container._historyTable
+        return () if table is None else table.dtype.names
+
+    def __getitem__(self, key):
+        if key not in self._names():
+            raise KeyError(key)
+        return self._container._historyTable.data[key]
+
+    def __iter__(self):
+        return iter(self._names())
+
+    def __len__(self):
+        return len(self._names())
+
 
 class ParamGroupLayout(QtWidgets.QGridLayout):
     """Layout for group of parameters."""
@@ -209,14 +406,11 @@ class GenericParam(QtWidgets.QWidget):
 
 
 class StringParam(GenericParam):
-    def __init__(self, labelText='', value='', group=None,
+    def __init__(self, labelText='', value='', group=None, history=False,
                  labelWidth=80, enabled=True, parent=None):
         super().__init__(labelText, value, group,
-                         history=False, labelWidth=labelWidth,  parent=parent)
+                         history=history, labelWidth=labelWidth,  parent=parent)
         self._type = 'string'
-        if self._historyEnabled:
-            raise ValueError('Keeping a history for string parameters is not supported.\n' +
-                             'When creating the instance use: history=False')
 
         # -- Define graphical interface --
         self.editWidget = QtWidgets.QLineEdit()
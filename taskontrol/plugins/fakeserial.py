@@ -0,0 +1,117 @@
+"""
+Channel for sound triggers when using the state machine emulator.
+
+The emulator (smemulator) writes one byte for each serial output of a state
+(as the state machine does through its serial port) to a named pipe (FIFO),
+and the sound client waits for these bytes with select(), so triggers are
+received as soon as they are written, without polling.
+
+The reader has the same read() method as serial.Serial, so the sound client
+can use it in place of the serial port.
+
+NOTE: named pipes are only available on Linux and macOS.
+"""
+
+import os
+import stat
+import select
+import tempfile
+
+FAKE_SERIAL_PATH = os.path.join(tempfile.gettempdir(), 'taskontrol_fakeserial.fifo')
+READ_TIMEOUT = 0.1  # Time (sec) that read() waits for data (as serial.Serial timeout)
+
+
+def create_fifo(path=FAKE_SERIAL_PATH):
+    """
+    Create the named pipe (replacing any other type of file with the same name).
+
+    Returns:
+        created (bool): False if the named pipe already existed.
+    """
+    if os.path.exists(path):
+        if stat.S_ISFIFO(os.stat(path).st_mode):
+            return False
+        os.remove(path)
+    os.mkfifo(path)
+    return True
+
+
+class FakeSerialReader(object):
+    """
+    Receive triggers sent by FakeSerialWriter (used by the sound client).
+
+    The named pipe is removed by close() if it was created by the reader.
+    """
+    def __init__(self, path=FAKE_SERIAL_PATH, timeout=READ_TIMEOUT):
+        self.createdFifo = create_fifo(path)
+        self.path = path
+        self.timeout = timeout
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # -- Keep the pipe open for writing, so it does not report end-of-file
+        #    (and select() does not return) while no emulator is connected --
+        self.dummyWriter = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def read(self, size=1):
+        """
+        Wait for data (up to timeout sec) and return up to size bytes
+        (empty if no data arrived).
+        """
+        (readable, writable, failed) = select.select([self.fd], [], [], self.timeout)
+        if not readable:
+            return b''
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            return b''
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        os.close(self.dummyWriter)
+        self.fd = None
+        self.dummyWriter = None
+        if self.createdFifo:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class FakeSerialWriter(object):
+    """
+    Send triggers to FakeSerialReader (used by the state machine emulator).
+
+    The pipe is opened when the first trigger is sent. Triggers sent while
+    no sound client is reading are discarded.
+    """
+    def __init__(self, path=FAKE_SERIAL_PATH):
+        create_fifo(path)
+        self.path = path
+        self.fd = None
+
+    def write(self, value):
+        """
+        Send one byte.
+
+        Returns:
+            sent (bool): False if there is no sound client reading the triggers.
+        """
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:  # ENXIO: no process has the pipe open for reading
+                return False
+        try:
+            os.write(self.fd, bytes([value]))
+        except BrokenPipeError:  # The sound client closed the pipe
+            self.close()
+            return False
+        except BlockingIOError:  # The pipe is full (the sound client is not reading)
+            return False
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
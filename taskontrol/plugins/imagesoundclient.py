@@ -64,12 +64,12 @@ import time
 import threading
 import traceback
 import numpy as np
-import tempfile
 import wave
 import serial
 import scipy.io.wavfile
 import scipy.signal
 from taskontrol import rigsettings
+from taskontrol.plugins import fakeserial
 from screeninfo import get_monitors
 if rigsettings.SOUND_SERVER=='jack':
     import jack
@@ -86,8 +86,6 @@ if rigsettings.STATE_MACHINE_TYPE=='arduino_due':
 elif rigsettings.STATE_MACHINE_TYPE=='emulator':
     #from taskontrol.plugins import smemulator
     SERIAL_TRIGGER = False
-    TEMP_DIR = tempfile.gettempdir()
-    FAKE_SERIAL = 'fakeserial.txt'
 else:
     raise ValueError('STATE_MACHINE_TYPE not recognized.')
 
@@ -713,7 +711,7 @@ class SoundClient(threading.Thread):
         set_system_volume(rigsettings.SOUND_VOLUME_LEVEL)
         self.serialtrigger = serialtrigger
         self.ser = None
-        self._stop = threading.Event()
+        self._stopRequested = threading.Event()
         self.soundServerType = servertype
 
         if self.soundServerType=='jack':
@@ -733,9 +731,8 @@ class SoundClient(threading.Thread):
         if self.serialtrigger:
             self.init_serial()
         else:
-            fakeSerialFullPath = os.path.join(TEMP_DIR, FAKE_SERIAL)
-            #if not os.path.isfile(fakeSerialFullPath):
-            open(fakeSerialFullPath, 'w').close() # Create empty file
+            # -- Triggers from the emulator (read in the same way as from the serial port) --
+            self.ser = fakeserial.FakeSerialReader(timeout=SERIAL_TIMEOUT)
             
         self.sounds = self.soundServer.sounds  # Gives access to sounds info
         self.daemon = True  # The program exits when only daemon threads are left.
@@ -748,37 +745,18 @@ class SoundClient(threading.Thread):
         '''Execute thread'''
         try:
             #1/0
-            if self.serialtrigger:
-                while not self._stop.is_set():
-                    onechar = self.ser.read(1)
-                    if onechar:
-                        soundID = ord(onechar)
-                        if soundID==STOP_ALL_SOUNDS:
-                            self.stop_all()
-                        elif soundID<MAX_NSOUNDS:
-                            self.play_sound(soundID)
-                        elif soundID>=MAX_NSOUNDS and soundID<(MAX_NSOUNDS+MAX_NIMAGES):
-                            self.show_image(soundID)
-                        else:
-                            raise ValueError('Sound ID {} not recognized.'.format(soundID))
-            else:
-                '''Fake serial mode'''
-                fakeSerial = open(os.path.join(TEMP_DIR, FAKE_SERIAL), 'r')
-                while not self._stop.is_set():
-                    oneval = fakeSerial.read(1)
-                    time.sleep(0.01)
-                    if len(oneval):
-                        soundID = ord(oneval)
-                        if soundID==STOP_ALL_SOUNDS:
-                            self.stop_all()
-                        elif soundID<MAX_NSOUNDS:
-                            self.play_sound(soundID)
-                        elif soundID>=MAX_NSOUNDS and soundID<(MAX_NSOUNDS+MAX_NIMAGES):
-                            self.show_image(soundID)
-                        else:
-                            raise ValueError('Sound ID {} not recognized.'.format(soundID))
-                        # if fakeSerial:
-                        #     fakeSerial.close()
+            while not self._stopRequested.is_set():
+                onechar = self.ser.read(1)
+                if onechar:
+                    soundID = ord(onechar)
+                    if soundID==STOP_ALL_SOUNDS:
+                        self.stop_all()
+                    elif soundID<MAX_NSOUNDS:
+                        self.play_sound(soundID)
+                    elif soundID>=MAX_NSOUNDS and soundID<(MAX_NSOUNDS+MAX_NIMAGES):
+                        self.show_image(soundID)
+                    else:
+                        raise ValueError('Sound ID {} not recognized.'.format(soundID))
         except Exception as exc:
             #print(traceback.format_exc())
             #print('[soundclient.py] An error occurred in the sound client thread. {}'.format(exc))
@@ -829,12 +807,14 @@ class SoundClient(threading.Thread):
         
     def shutdown(self):
         '''Stop thread loop and shutdown pyo sound server'''
-        self._stop.set() # Set flag to stop thread (checked on the thread loop).
+        self._stopRequested.set() # Set flag to stop thread (checked on the thread loop).
         if self.is_alive():
-            time.sleep(0.001)
+            self.join(2*SERIAL_TIMEOUT)  # Wait for the last read before closing the port
         self.stop_all()
         self.soundServer.shutdown()
         self.ImageServer.shutdown()
+        if self.ser is not None and not self.is_alive():
+            self.ser.close()
 
 """
 if __name__ == "__main__":
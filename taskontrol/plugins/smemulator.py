@@ -11,11 +11,10 @@ __created__ = '2013-09-23'
 import time
 import numpy as np
 import datetime
-import os
-import tempfile
 from qtpy import QtCore
 from qtpy import QtWidgets
 from .. import rigsettings
+from . import fakeserial
 
 MAXNEVENTS = 512
 MAXNSTATES = 256
@@ -26,9 +25,6 @@ MAXNACTIONS = 2*MAXNINPUTS + 1 + MAXNEXTRATIMERS
 
 VERBOSE = rigsettings.EMULATOR_VERBOSE
 
-TEMP_DIR = tempfile.gettempdir()
-FAKE_SERIAL = 'fakeserial.txt'
-
 #buttonsStrings = ['C','L','R','W']
 buttonsStrings = len(rigsettings.INPUTS)*[None]
 for key,item in rigsettings.INPUTS.items(): buttonsStrings[item]=key
@@ -186,7 +182,7 @@ class StateMachineClient(QtCore.QObject):
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.execute_cycle)
 
-        self.fakeSerial = open(os.path.join(TEMP_DIR, FAKE_SERIAL),'w')
+        self.fakeSerial = fakeserial.FakeSerialWriter()  # Sound triggers for the sound client
         self.emuGUI = EmulatorGUI()
 
     def send_reset(self):
@@ -364,8 +360,7 @@ class StateMachineClient(QtCore.QObject):
 
     def emulate_serial_output(self, serialout):
         if serialout:
-            self.fakeSerial.write(chr(serialout))
-            self.fakeSerial.flush()
+            self.fakeSerial.write(serialout)
 
     def update_state_machine(self):
         while(self.eventsToProcess>0):
@@ -46,19 +46,26 @@ TO DO:
 import os
 import sys
 import time
+import json
+import hashlib
+import collections
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
 import threading
 import traceback
 import numpy as np
-import tempfile
 import wave
 import serial
 import scipy.io.wavfile
 import scipy.signal
 #from .. import rigsettings
 from taskontrol import rigsettings
+from taskontrol import utils
+from taskontrol.plugins import fakeserial
 if rigsettings.SOUND_SERVER=='jack':
     import jack
-    import queue
 elif rigsettings.SOUND_SERVER=='pygame':
     import pygame
 elif rigsettings.SOUND_SERVER=='pyo':
@@ -72,8 +79,6 @@ if rigsettings.STATE_MACHINE_TYPE=='arduino_due':
 elif rigsettings.STATE_MACHINE_TYPE=='emulator':
     #from taskontrol.plugins import smemulator
     SERIAL_TRIGGER = False
-    TEMP_DIR = tempfile.gettempdir()
-    FAKE_SERIAL = 'fakeserial.txt'
 else:
     raise ValueError('STATE_MACHINE_TYPE not recognized.')
 
@@ -89,6 +94,29 @@ STOP_ALL_SOUNDS = 128  # SoundID to stop all sounds
 RISETIME = 0.002
 FALLTIME = 0.002
 
+# Precision of waveforms created by the sound servers (jack uses float32 samples)
+SOUND_DTYPE = np.float32 if getattr(rigsettings, 'SOUND_SINGLE_PRECISION', False) else np.float64
+
+CHANNEL_NAMES = ['L', 'R']  # Suffix of the JACK port for each channel
+# Mix all sounds into one pair of JACK ports, playing at most SOUND_MAX_VOICES at once
+SOUND_JACK_MIXER = getattr(rigsettings, 'SOUND_JACK_MIXER', False)
+SOUND_MAX_VOICES = getattr(rigsettings, 'SOUND_MAX_VOICES', 8)
+JACK_LATENCY_LOG_SIZE = 1024  # Number of trigger latencies stored by SoundServerJack
+
+# -- Waveform cache (see WaveformCache) --
+SOUND_CACHE_MAX_BYTES = getattr(rigsettings, 'SOUND_CACHE_MAX_BYTES', 256*1024**2)
+SOUND_CACHE_DIR = getattr(rigsettings, 'SOUND_CACHE_DIR', None)
+# Sound types that are different every time (unless soundParams includes a 'seed')
+STOCHASTIC_SOUND_TYPES = ['noise', 'AM', 'fadingNoise', 'toneCloud']
+
+# -- Number of processes creating sounds for SoundClient.prepare_sounds() --
+SOUND_PREPARE_PROCESSES = getattr(rigsettings, 'SOUND_PREPARE_PROCESSES', 2)
+# Sound types loaded by the sound server itself (not synthesized by create_soundwave)
+SERVER_LOADED_SOUND_TYPES = ['pygameFile']
+# Workers are not forked from the paradigm (which has Qt and sound threads running)
+PREPARE_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() \
+                       else 'spawn'
+
 randomGen = np.random.default_rng()
 
 def set_system_volume(volumeLevel=None):
@@ -103,19 +131,62 @@ def set_system_volume(volumeLevel=None):
         print('Set sound volume to {0}%'.format(volumeLevel))
 
 
-def apply_rise_fall(waveform, samplingRate, riseTime, fallTime):
+def apply_rise_fall(waveform, samplingRate, riseTime, fallTime, inplace=False):
+    """
+    Return the waveform with linear ramps at the beginning and the end.
+    If inplace=True, only the samples of the ramps are modified (in the given array).
+    """
     nSamplesRise = round(samplingRate * riseTime)
     nSamplesFall = round(samplingRate * fallTime)
     riseVec = np.linspace(0, 1, nSamplesRise)
     fallVec = np.linspace(1, 0, nSamplesFall)
-    newWaveform = waveform.copy()
+    newWaveform = waveform if inplace else waveform.copy()
     if (len(newWaveform)>nSamplesRise) and (len(waveform)>nSamplesFall):
         newWaveform[:nSamplesRise] *= riseVec
         newWaveform[-nSamplesFall:] *= fallVec
     return newWaveform
 
 
-def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
+def white_noise(randomGen, nSamples, dtype=np.float64):
+    """
+    Return uniform white noise in [-1,1).
+    For float32, samples are drawn directly in single precision (which is faster, but
+    gives a different noise than float64 for the same seed).
+    """
+    if np.dtype(dtype) == np.float32:
+        noise = randomGen.random(nSamples, dtype=np.float32)
+        noise *= 2
+        noise -= 1
+        return noise
+    return randomGen.uniform(-1, 1, nSamples)
+
+
+def add_tones(soundWave, onsetsInds, waveEachTone, toneSequence):
+    """
+    Add tones to a waveform (in place), each one starting at a given sample.
+
+    Tones are added one at a time in order, so overlapping tones give exactly the same
+    result as before, but without the overhead of indexing with numpy scalars.
+    Parts of tones that extend beyond the end of the waveform are ignored.
+
+    Args:
+        soundWave (np.ndarray): 1D waveform to which tones are added.
+        onsetsInds (np.ndarray): sample where each tone starts.
+        waveEachTone (np.ndarray): [nTypesOfTones, nSamplesPerTone] waveform of each tone.
+        toneSequence (np.ndarray): index (row of waveEachTone) of each tone to add.
+    """
+    nSamplesPerTone = waveEachTone.shape[1]
+    nSamplesTotal = len(soundWave)
+    eachTone = list(waveEachTone)  # Rows as separate arrays (faster than indexing each time)
+    for onsetSample, toneInd in zip(onsetsInds.tolist(), toneSequence.tolist()):
+        samplesThisTone = soundWave[onsetSample:onsetSample+nSamplesPerTone]
+        if onsetSample+nSamplesPerTone <= nSamplesTotal:
+            np.add(samplesThisTone, eachTone[toneInd], out=samplesThisTone)
+        else:
+            samplesThisTone += eachTone[toneInd][:len(samplesThisTone)]
+
+
+def create_soundwave(soundParams, samplingRate=44100, nChannels=2, dtype=np.float64):
     """
     Create a sound waveform give parameters.
 
@@ -123,6 +194,9 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
         soundParams (dict): a dictionary defining sound parameters. See details below.
         samplingRate (float): sampling rate for the waveform.
         nChannels (int): number of channels. Usually 2, for stereo sound.
+        dtype (np.dtype): np.float64 or np.float32 for the waveform. With float32, noise is
+            created in single precision, while phases of sinusoids are still calculated
+            in double precision (to be accurate for long sounds).
     Returns:
         timeVec (np.ndarray): array with timestamps
         soundWave (np.ndarray): array with waveform amplitude at each time point.
@@ -163,9 +237,18 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
             'rate' (how many tones per second in the train)
             'toneDuration' duration of each individual tone.
             Note that 'duration' refers to the duration of the whole train.
+
+    Sound types with random components (STOCHASTIC_SOUND_TYPES) accept the parameter
+    'seed', to create the same waveform every time.
     """
     risetime = soundParams.setdefault('fadein', RISETIME)   # Set if not specified
     falltime = soundParams.setdefault('fadeout', FALLTIME)  # Set if not specified
+    if soundParams.get('seed') is not None:
+        soundRandomGen = np.random.default_rng(soundParams['seed'])
+        legacyRandomGen = np.random.RandomState(soundParams['seed'])
+    else:
+        soundRandomGen = randomGen
+        legacyRandomGen = np.random  # The module functions use the global random state
     if soundParams['type']!='fromfile':
         timeVec = np.arange(0, soundParams['duration'], 1/samplingRate)
     if isinstance(soundParams['amplitude'],list) or \
@@ -186,14 +269,15 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
         for indcomp, freqThisComp in enumerate(freqEachComp):
             soundWave += compAmp * np.sin(2*np.pi*freqThisComp*timeVec)
     elif soundParams['type']=='noise':
-        soundWave = randomGen.uniform(-1,1,len(timeVec))
+        soundWave = white_noise(soundRandomGen, len(timeVec), dtype)
     elif soundParams['type']=='AM':
         modFactor = soundParams['modDepth']/100.0 if 'modDepth' in soundParams else 1.0
         multTerm = modFactor*0.5
         addTerm = (1-modFactor*0.5)
         modFreq = soundParams['modFrequency']
-        envelope = addTerm + multTerm*np.sin(2*np.pi*modFreq*timeVec + np.pi/2)
-        carrier = randomGen.uniform(-1,1,len(timeVec))
+        modTimeVec = timeVec.astype(dtype, copy=False)  # Modulation is slow, precision is enough
+        envelope = addTerm + multTerm*np.sin(2*np.pi*modFreq*modTimeVec + np.pi/2)
+        carrier = white_noise(soundRandomGen, len(timeVec), dtype)
         soundWave = envelope*carrier
     elif soundParams['type']=='AMtone':
         modFactor = soundParams['modDepth']/100.0 if 'modDepth' in soundParams else 1.0
@@ -212,8 +296,8 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
     elif soundParams['type']=='fadingNoise':
         ampStart = soundParams['amplitudeStart']
         ampEnd = soundParams['amplitudeEnd']
-        envelope = np.linspace(ampStart, ampEnd, len(timeVec))
-        carrier = randomGen.uniform(-1,1,len(timeVec))
+        envelope = np.linspace(ampStart, ampEnd, len(timeVec), dtype=dtype)
+        carrier = white_noise(soundRandomGen, len(timeVec), dtype)
         soundWave = envelope*carrier
     elif soundParams['type']=='toneCloud':
         nFreq = soundParams['nFreq']
@@ -246,15 +330,11 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
         pNonTargetTone = (1-pTarget)/(nFreq-len(targetFreqInds))   
         pEachFreq = np.tile(pNonTargetTone, nFreq)
         pEachFreq[targetFreqInds] = pTarget/len(targetFreqInds)
-        nTonesEachFreq = np.random.multinomial(nTones, pEachFreq)
+        nTonesEachFreq = legacyRandomGen.multinomial(nTones, pEachFreq)
         toneSequenceSorted = np.repeat(np.arange(nFreq), nTonesEachFreq)
-        toneSequence = np.random.permutation(toneSequenceSorted)
-        sampleRange = nSamplesPerTone
+        toneSequence = legacyRandomGen.permutation(toneSequenceSorted)
         soundWave = np.zeros(len(timeVec))
-        for toneInd in range(nTones):
-            onsetSample = toneOnsetsInds[toneInd]
-            waveThisTone = waveEachTone[toneSequence[toneInd], :]
-            soundWave[onsetSample:onsetSample+nSamplesPerTone] += waveThisTone
+        add_tones(soundWave, toneOnsetsInds[:nTones], waveEachTone, toneSequence)
     elif soundParams['type']=='toneTrain':
         toneTimeVec = np.arange(0, soundParams['toneDuration'], 1/samplingRate)
         waveEachTone = np.sin(2*np.pi*soundParams['frequency']*toneTimeVec)
@@ -269,9 +349,8 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
         toneOnsets = np.arange(0, soundParams['duration'], toneOnsetAsync)
         toneOnsetsInds = (toneOnsets*samplingRate).astype(int)
         soundWave = np.zeros(len(timeVec))
-        for onsetSample in toneOnsetsInds:
-            offsetSample = min(onsetSample+len(toneTimeVec), len(timeVec))
-            soundWave[onsetSample:offsetSample] += waveEachTone
+        add_tones(soundWave, toneOnsetsInds, waveEachTone[np.newaxis, :],
+                  np.zeros(len(toneOnsetsInds), dtype=int))
     elif soundParams['type']=='fromfile':
         '''
         # -- The version with wave+struct does not work yet --
@@ -298,11 +377,241 @@ def create_soundwave(soundParams, samplingRate=44100, nChannels=2):
     else:
         raise ValueError("Sound type '{}' not recognized.".format(soundParams['type']))
     
-    soundWave = apply_rise_fall(soundWave, samplingRate, risetime, falltime)
-    soundWave = soundAmp[:,np.newaxis] * np.tile(soundWave,(nChannels,1))
+    # -- The waveform was created here, so ramps and gains can modify it without copies --
+    soundWave = soundWave.astype(dtype, copy=False)
+    apply_rise_fall(soundWave, samplingRate, risetime, falltime, inplace=True)
+    soundWave = soundAmp.astype(dtype)[:,np.newaxis] * soundWave
     return timeVec, soundWave
 
 
+class WaveformCache(object):
+    """
+    Cache of waveforms created by create_soundwave(), so sounds that are set
+    again (for example, on every trial) are only synthesized once.
+
+    Waveforms are identified by a hash of their (normalized) parameters, sampling rate
+    and number of channels. For 'fromfile' sounds, the size and modification time of the
+    file are also included. Recently used waveforms are kept in memory (up to maxBytes),
+    and, if cacheDir is given, they are also saved there as .npy files which are
+    memory-mapped when needed again (also by later sessions).
+    Sounds of types in STOCHASTIC_SOUND_TYPES are only cached if they include a 'seed'.
+    Cached waveforms are read-only.
+    """
+    def __init__(self, maxBytes=SOUND_CACHE_MAX_BYTES, cacheDir=SOUND_CACHE_DIR):
+        self.maxBytes = maxBytes
+        self.cacheDir = cacheDir
+        self.waveforms = collections.OrderedDict()  # Ordered from least to most recently used
+        self.nBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cacheDir is not None and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    @staticmethod
+    def is_cacheable(soundParams):
+        """Return True if the sound is the same every time it is created."""
+        return (soundParams['type'] not in STOCHASTIC_SOUND_TYPES) or \
+            (soundParams.get('seed') is not None)
+
+    @staticmethod
+    def key(soundParams, samplingRate, nChannels, dtype=np.float64):
+        """Return the hash that identifies a waveform."""
+        params = dict(soundParams)
+        params.setdefault('fadein', RISETIME)
+        params.setdefault('fadeout', FALLTIME)
+        amplitude = np.array(params['amplitude'], dtype=float)
+        if amplitude.ndim == 0:
+            amplitude = np.tile(amplitude, nChannels)
+        params['amplitude'] = amplitude
+        if params['type'] == 'fromfile':
+            fileStat = os.stat(params['filename'])
+            params['fileStat'] = [fileStat.st_size, fileStat.st_mtime]
+        for key, value in params.items():
+            if isinstance(value, np.ndarray):
+                params[key] = value.tolist()
+            elif isinstance(value, np.generic):
+                params[key] = value.item()
+        keyString = json.dumps([params, float(samplingRate), int(nChannels),
+                                np.dtype(dtype).str], sort_keys=True, default=str)
+        return hashlib.sha1(keyString.encode()).hexdigest()
+
+    def create_soundwave(self, soundParams, samplingRate=44100, nChannels=2, dtype=np.float64):
+        """
+        Return the same as create_soundwave() (creating the waveform only if needed).
+        """
+        if not self.is_cacheable(soundParams):
+            return create_soundwave(soundParams, samplingRate, nChannels, dtype)
+        soundParams.setdefault('fadein', RISETIME)   # Set if not specified (as create_soundwave)
+        soundParams.setdefault('fadeout', FALLTIME)
+        waveKey = self.key(soundParams, samplingRate, nChannels, dtype)
+        soundWave = self.get(waveKey)
+        if soundWave is None:
+            self.misses += 1
+            timeVec, soundWave = create_soundwave(soundParams, samplingRate, nChannels, dtype)
+            soundWave.flags.writeable = False
+            self.put(waveKey, soundWave, save=True)
+        else:
+            self.hits += 1
+            timeVec = np.arange(soundWave.shape[1])/samplingRate
+        return timeVec, soundWave
+
+    def _filename(self, waveKey):
+        return os.path.join(self.cacheDir, waveKey+'.npy')
+
+    def get(self, waveKey):
+        """Return a cached waveform (or None if it is not in the cache)."""
+        with self.lock:
+            if waveKey in self.waveforms:
+                self.waveforms.move_to_end(waveKey)
+                return self.waveforms[waveKey]
+        if self.cacheDir is not None and os.path.isfile(self._filename(waveKey)):
+            soundWave = np.load(self._filename(waveKey), mmap_mode='r')
+            self.put(waveKey, soundWave)
+            return soundWave
+        return None
+
+    def put(self, waveKey, soundWave, save=False):
+        """Add a waveform to the cache (and save it to cacheDir if save=True)."""
+        if save and self.cacheDir is not None:
+            tmpFilename = self._filename(waveKey)+'.tmp.npy'
+            np.save(tmpFilename, soundWave)
+            os.replace(tmpFilename, self._filename(waveKey))
+        if soundWave.nbytes > self.maxBytes:
+            return
+        with self.lock:
+            if waveKey in self.waveforms:
+                self.nBytes -= self.waveforms.pop(waveKey).nbytes
+            self.waveforms[waveKey] = soundWave
+            self.nBytes += soundWave.nbytes
+            while self.nBytes > self.maxBytes:
+                (oldKey, oldWave) = self.waveforms.popitem(last=False)
+                self.nBytes -= oldWave.nbytes
+
+    def clear(self):
+        """Remove all waveforms from memory (files in cacheDir are kept)."""
+        with self.lock:
+            self.waveforms.clear()
+            self.nBytes = 0
+
+
+waveformCache = WaveformCache()
+
+
+def _init_prepare_process():
+    """Seed the random generators of a worker process, so each one creates different noise."""
+    global randomGen
+    randomGen = np.random.default_rng()
+    np.random.seed()
+
+
+def _create_shared_soundwave(soundParams, samplingRate, nChannels, dtype):
+    """
+    Create a waveform (in a worker process of SoundClient.prepare_sounds) and store it
+    in a new block of shared memory, which the main process reads and releases.
+
+    Returns:
+        name (str): name of the shared memory block.
+        shape (tuple): shape of the waveform.
+        dtype (str): data type of the waveform.
+    """
+    timeVec, soundWave = create_soundwave(soundParams, samplingRate, nChannels, dtype)
+    sharedMem = shared_memory.SharedMemory(create=True, size=max(soundWave.nbytes, 1))
+    sharedWave = np.ndarray(soundWave.shape, dtype=soundWave.dtype, buffer=sharedMem.buf)
+    sharedWave[...] = soundWave
+    del sharedWave
+    sharedMem.close()
+    return (sharedMem.name, soundWave.shape, soundWave.dtype.str)
+
+
+def _read_shared_soundwave(name, shape, dtype):
+    """Copy a waveform from shared memory and release the shared memory block."""
+    sharedMem = shared_memory.SharedMemory(name=name)
+    try:
+        soundWave = np.ndarray(shape, dtype=dtype, buffer=sharedMem.buf).copy()
+    finally:
+        sharedMem.close()
+        sharedMem.unlink()
+    return soundWave
+
+
+class PreparedSounds(object):
+    """
+    Set of sounds being created in a pool of processes (see SoundClient.prepare_sounds).
+
+    Waveforms are read from shared memory as soon as each one is ready,
+    so shared memory is released even if the set is never activated.
+    Sounds in SERVER_LOADED_SOUND_TYPES are not sent to the pool; their waveform
+    is None and the sound server loads them (in this process) when activated.
+    """
+    def __init__(self, batch, samplingRate, nChannels, dtype):
+        self.params = batch       # Dictionary of soundParams for each soundID
+        self.samplingRate = samplingRate
+        self.nChannels = nChannels
+        self.dtype = dtype
+        self.futures = {}         # Each entry should be: soundID:concurrent.futures.Future
+        self.waveforms = {}       # Each entry should be: soundID:soundWave
+        self.lock = threading.Lock()
+
+    def submit(self, executor):
+        """Start creating the sounds that are not already in waveformCache."""
+        for soundID, soundParams in self.params.items():
+            if soundParams['type'] in SERVER_LOADED_SOUND_TYPES:
+                self.waveforms[soundID] = None
+                continue
+            # -- Set here (as create_soundwave does) since workers only change their copy --
+            soundParams.setdefault('fadein', RISETIME)
+            soundParams.setdefault('fadeout', FALLTIME)
+            if waveformCache.is_cacheable(soundParams):
+                soundWave = waveformCache.get(waveformCache.key(soundParams, self.samplingRate,
+                                                                self.nChannels, self.dtype))
+                if soundWave is not None:
+                    self.waveforms[soundID] = soundWave
+                    continue
+            future = executor.submit(_create_shared_soundwave, soundParams,
+                                     self.samplingRate, self.nChannels, self.dtype)
+            future.add_done_callback(lambda future, soundID=soundID:
+                                     self._collect(soundID, future, raiseError=False))
+            self.futures[soundID] = future
+
+    def _collect(self, soundID, future, raiseError=True):
+        """Read the waveform of one sound from shared memory (only the first time)."""
+        if future.cancelled() or future.exception() is not None:
+            if raiseError:
+                future.result()
+            return
+        with self.lock:
+            if soundID in self.waveforms:
+                return
+            soundWave = _read_shared_soundwave(*future.result())
+            soundParams = self.params[soundID]
+            if waveformCache.is_cacheable(soundParams):
+                soundWave.flags.writeable = False
+                waveformCache.put(waveformCache.key(soundParams, self.samplingRate,
+                                                    self.nChannels, self.dtype), soundWave)
+            self.waveforms[soundID] = soundWave
+
+    def done(self):
+        """Return True if all sounds have been created (or failed)."""
+        return all(future.done() for future in self.futures.values())
+
+    def wait(self, timeout=None):
+        """
+        Wait until all sounds are created.
+
+        Returns:
+            waveforms (dict): the waveform of each soundID.
+        Raises:
+            concurrent.futures.TimeoutError: if sounds are not ready after timeout (sec).
+        """
+        (done, notDone) = concurrent.futures.wait(self.futures.values(), timeout)
+        if notDone:
+            raise concurrent.futures.TimeoutError('{} sounds are not ready.'.format(len(notDone)))
+        for soundID, future in self.futures.items():
+            self._collect(soundID, future)
+        return self.waveforms
+
+
 class SoundContainer(object):
     def __init__(self, soundParams, soundObj, soundWave, samplingRate):
         self.params = soundParams  # Sound parameters dictionary
@@ -318,21 +627,67 @@ class SoundContainer(object):
     def get_duration(self):
         return self.wave.shape[1]/self.fs
     
+class JackStream(object):
+    """
+    Playback state of one stream of SoundServerJack (a sound ID, or a voice in mixer mode).
+
+    The waveform is a contiguous float32 array [nChannels, nSamples] read by the
+    JACK process callback from position 'cursor'. Other threads only change
+    attributes (which is atomic in Python), so no locks are needed. Each time a
+    stream is started or stopped its 'generation' is incremented, and the callback
+    does not write back 'cursor' or 'playing' if the generation changed while it
+    was rendering the block (so the new start or stop is not undone).
+    """
+    __slots__ = ['ports', 'buffers', 'wave', 'cursor', 'playing', 'loop', 'gain',
+                 'soundID', 'startCount', 'triggerFrame', 'generation']
+
+    def __init__(self, nChannels, ports=()):
+        self.ports = ports                   # JACK output port for each channel (if any)
+        self.buffers = [None]*len(ports)     # Port buffers for the current block
+        self.wave = np.zeros((nChannels, 0), dtype=np.float32)
+        self.cursor = 0
+        self.playing = False
+        self.loop = False
+        self.gain = 1.0
+        self.soundID = None
+        self.startCount = 0                  # Order in which voices started (mixer mode)
+        self.triggerFrame = None             # JACK frame time when play was requested
+        self.generation = 0                  # Number of times started or stopped
+
+
 class SoundServerJack(object):
-    def __init__(self, risetime=RISETIME, falltime=FALLTIME):
+    """
+    Sound server that writes waveforms directly to JACK output ports.
+
+    Each stream plays from a preallocated waveform using a read cursor, so the
+    real-time process callback does not use queues or locks, and it does not copy
+    or allocate sample data (it only creates views of the port buffers and waveforms).
+
+    By default, each sound ID has its own pair of JACK ports. In mixer mode, there is
+    only one pair of ports, and sounds are played by up to maxVoices voices which are
+    added together in the callback (if all voices are busy, the oldest one is reused).
+    """
+    def __init__(self, risetime=RISETIME, falltime=FALLTIME, mixer=SOUND_JACK_MIXER,
+                 maxVoices=SOUND_MAX_VOICES):
         self.sounds = {} # Each entry should be: index:SoundContainer()
         self.riseTime = risetime
         self.fallTime = falltime
-        
-        self.playingEvent = {}  # Stores a threading.Event() for each stream
-        self.loopFlag = {}
-        self.queueDict = {}     # Stores a queue for each stream
-        self.preloadingThreads = {}  # Stores threads for preloading each stream
+        self.mixer = mixer
+
+        self.streams = {}        # Stores a JackStream for each sound ID (except in mixer mode)
+        self.activeStreams = ()  # Streams processed by the callback (replaced, never modified)
+        self.gains = {}          # Gain for each sound ID (see set_gain)
+        self.nXruns = 0
+        self.nVoicesStarted = 0
+        # -- Frames between play_sound() and the block where the sound starts --
+        self.latencyLog = np.zeros(JACK_LATENCY_LOG_SIZE, dtype=np.int64)
+        self.nLatencies = 0
         self.jackClient = jack.Client('tkJackClient')
         self.blocksize = self.jackClient.blocksize
         self.samplingRate = self.jackClient.samplerate
         self.jackClient.set_xrun_callback(self._jack_xrun)
         self.jackClient.set_shutdown_callback(self._jack_shutdown)
+        self.jackClient.set_blocksize_callback(self._jack_blocksize)
         self.jackClient.set_process_callback(self._jack_process)
         self.targetPorts = self.jackClient.get_ports(is_physical=True,
                                                      is_input=True, is_audio=True)
@@ -342,163 +697,222 @@ class SoundServerJack(object):
         self.nChannels = 2 # FIXME: hardcoded for the moment
         if len(self.targetPorts)>2:
             print('WARNING! the sound card has more than two channels.')
+        if self.mixer:
+            self.mixerStream = JackStream(self.nChannels, self._register_ports('mix'))
+            self.voices = tuple(JackStream(self.nChannels) for ind in range(maxVoices))
+            self.mixBuffer = np.zeros(self.blocksize, dtype=np.float32)
         self.jackClient.activate()
 
-    class PreloadQueue(threading.Thread):
-        def __init__(self, soundObj, soundQueue, blocksize):
-            super().__init__()
-            self.soundObj = soundObj
-            self.soundQueue = soundQueue
-            self.bsize = blocksize
-            self.daemon = True  # The program exits when only daemon threads are left.
-        def run(self):
-            nBlocks = self.soundObj.shape[1]//self.bsize
-            for ind in range(nBlocks):
-                data = self.soundObj[:, ind*self.bsize:(ind+1)*self.bsize]
-                self.soundQueue.put(data)
-    
-    def port(self, streamID, channel):
-        """
-        streamID (int)
-        channel (str): 'L' or 'R'
-        """
-        baseName = '{}:{}'.format(self.jackClient.name,streamID)
-        return self.jackClient.get_port_by_name(baseName+channel)   
+    def _register_ports(self, baseName):
+        """Register and connect one JACK output port for each channel."""
+        ports = []
+        for channel in CHANNEL_NAMES[:self.nChannels]:
+            ports.append(self.jackClient.outports.register(str(baseName)+channel))
+        for port, targetPort in zip(ports, self.targetPorts):
+            port.connect(targetPort)
+        return ports
 
     def create_stream(self, streamID):
         """
-        Register Jack ports and create queue for a new sound.
+        Register Jack ports for a new sound (only the first time a sound ID is used).
         """
-        # Create a new queue or replace the queue if it already exists.
-        self.queueDict[streamID] = queue.Queue()
-        if streamID not in self.playingEvent:
-            self.playingEvent[streamID] = threading.Event()
-            self.loopFlag[streamID] = False
-            self.jackClient.outports.register(str(streamID)+'L')
-            self.jackClient.outports.register(str(streamID)+'R')
-            portsReady = False
-            while not portsReady:
-                try:
-                    self.port(streamID,'L')
-                    self.port(streamID,'R')
-                    portsReady = True
-                except jack.JackError:
-                    print(traceback.format_exc())
-                    print('Trying again to connect Jack ports.')
-                    time.sleep(0.001)
-            self.port(streamID,'L').connect(self.targetPorts[0])
-            self.port(streamID,'R').connect(self.targetPorts[1])
-
-    '''    
-    def _jack_process(self, frames):
-        for streamID, oneQueue in self.queueDict.items():
-            if self.playingEvent[streamID].is_set():
-                try:
-                    data = oneQueue.get_nowait()
-                    self.port(streamID,'L').get_array()[:] = data[0]
-                    self.port(streamID,'R').get_array()[:] = data[1]
-                except queue.Empty:
-                    self.port(streamID,'L').get_array().fill(0)
-                    self.port(streamID,'R').get_array().fill(0)
-                    self.playingEvent[streamID].clear() # Finished playing stream
-                    self.preload_queue_no_thread(streamID)
-    '''    
+        if streamID in self.streams:
+            return self.streams[streamID]
+        newStream = JackStream(self.nChannels, self._register_ports(streamID))
+        self.streams[streamID] = newStream
+        self.activeStreams = tuple(self.streams.values())
+        return newStream
+
     def _jack_process(self, frames):
-        for streamID, oneQueue in self.queueDict.items():
-            if self.playingEvent[streamID].is_set():
-                try:
-                    data = oneQueue.get_nowait()
-                    self.port(streamID,'L').get_array()[:] = data[0]
-                    self.port(streamID,'R').get_array()[:] = data[1]
-                except queue.Empty:
-                    if self.loopFlag[streamID]:
-                        self.preload_queue(streamID)  # FIXME: which preload to use?
-                    else:
-                        self.port(streamID,'L').get_array().fill(0)
-                        self.port(streamID,'R').get_array().fill(0)
-                        self.playingEvent[streamID].clear() # Finished playing stream
-                        #self.preload_queue_no_thread(streamID) # FIXME: which preload to use?
-                        self.preload_queue(streamID)  # FIXME: which preload to use?
-        
+        if self.mixer:
+            buffers = self._get_buffers(self.mixerStream)
+            for buffer in buffers:
+                buffer.fill(0)
+            for voice in self.voices:
+                if voice.playing:
+                    self._render(voice, buffers, frames, mix=True)
+        else:
+            for stream in self.activeStreams:
+                buffers = self._get_buffers(stream)
+                if stream.playing:
+                    self._render(stream, buffers, frames)
+                else:
+                    for buffer in buffers:
+                        buffer.fill(0)
+
+    @staticmethod
+    def _get_buffers(stream):
+        """Get the buffers of the ports of a stream for the current block."""
+        buffers = stream.buffers
+        for indch, port in enumerate(stream.ports):
+            buffers[indch] = port.get_array()
+        return buffers
+
+    def _render(self, stream, buffers, frames, mix=False):
+        """
+        Write the next block of a stream (multiplied by its gain) to the port buffers,
+        or add it to the buffers if mix=True.
+        """
+        if stream.triggerFrame is not None:
+            self.latencyLog[self.nLatencies % JACK_LATENCY_LOG_SIZE] = \
+                self.jackClient.last_frame_time - stream.triggerFrame
+            self.nLatencies += 1
+            stream.triggerFrame = None
+        generation = stream.generation
+        wave = stream.wave
+        gain = stream.gain
+        nSamples = wave.shape[1]
+        cursor = stream.cursor
+        filled = 0
+        finished = False
+        while filled < frames:
+            nCopy = min(frames-filled, nSamples-cursor)
+            for indch, buffer in enumerate(buffers):
+                if mix:
+                    mixBuffer = self.mixBuffer[:nCopy]
+                    np.multiply(wave[indch, cursor:cursor+nCopy], gain, out=mixBuffer)
+                    buffer[filled:filled+nCopy] += mixBuffer
+                else:
+                    np.multiply(wave[indch, cursor:cursor+nCopy], gain,
+                                out=buffer[filled:filled+nCopy])
+            filled += nCopy
+            cursor += nCopy
+            if cursor >= nSamples:
+                if stream.loop and nSamples > 0:
+                    cursor = 0
+                else:
+                    if not mix:
+                        for buffer in buffers:
+                            buffer[filled:] = 0
+                    finished = True
+                    break
+        # -- Skip the write-back if the stream was restarted or stopped meanwhile --
+        if stream.generation == generation:
+            stream.cursor = cursor
+            if finished:
+                stream.playing = False  # Finished playing stream
+
     def set_sound(self, soundID, soundParams):
         soundObj, soundwave = self.create_sound(soundParams)
         newSound = SoundContainer(soundParams, soundObj, soundwave, self.samplingRate)
         self.sounds[soundID] = newSound
-        self.create_stream(soundID)
-        #self.preload_queue_no_thread(soundID) # FIXME: which preload to use?
-        self.preload_queue(soundID)  # FIXME: which preload to use?
+        if not self.mixer:
+            stream = self.create_stream(soundID)
+            stream.generation += 1
+            stream.playing = False
+            stream.cursor = 0
         return newSound
 
-    def preload_queue(self, soundID):
-        """Preload a sound via a thread. It will not block processing."""
-        self.preloadingThreads[soundID] = self.PreloadQueue(self.sounds[soundID].obj,
-                                                            self.queueDict[soundID],
-                                                            self.blocksize)
-        self.preloadingThreads[soundID].start()
-        
-    def preload_queue_no_thread(self, soundID):
-        """Preload a sound without invoking a thread. It will block processing until done."""
-        soundObj = self.sounds[soundID].obj
-        nBlocks = soundObj.shape[1]//self.blocksize
-        for ind in range(nBlocks):
-            data = soundObj[:, ind*self.blocksize:(ind+1)*self.blocksize]
-            self.queueDict[soundID].put(data)
-        
-    def create_sound(self, soundParams):
-        if 0: #soundParams['type']=='fromfile':
-            pass
-        else:
-            timeVec, soundWave = create_soundwave(soundParams, self.samplingRate, self.nChannels)
-            padSize = soundWave.shape[1]%self.blocksize
-            padArray = np.zeros((self.nChannels, padSize))
-            soundObj = np.hstack((soundWave, padArray))
+    def set_sounds(self, soundsParams, soundWaves):
+        """
+        Set several sounds from waveforms already created, replacing them all at once
+        (sounds already playing continue with their previous waveform).
+        """
+        newSounds = {}
+        for soundID, soundParams in soundsParams.items():
+            soundObj, soundWave = self.create_sound(soundParams, soundWaves[soundID])
+            newSounds[soundID] = SoundContainer(soundParams, soundObj, soundWave,
+                                                self.samplingRate)
+            if not self.mixer:
+                self.create_stream(soundID)
+        self.sounds.update(newSounds)
+        return newSounds
+
+    def create_sound(self, soundParams, soundWave=None):
+        if soundWave is None:
+            timeVec, soundWave = waveformCache.create_soundwave(soundParams, self.samplingRate,
+                                                                 self.nChannels, SOUND_DTYPE)
+        soundObj = np.ascontiguousarray(soundWave, dtype=np.float32)  # Samples for JACK
         return soundObj, soundWave
-    
-    def play_sound(self, soundID):
-        # TicTime = time.time()
-        self.playingEvent[soundID].set()
-        # print('Elapsed Time (triggering): ' + str(time.time()-TicTime))
-        
+
+    def set_gain(self, soundID, gain):
+        """
+        Set the gain (multiplying the waveform) of a sound, including voices
+        already playing it.
+        """
+        self.gains[soundID] = gain
+        for stream in self._streams_playing(soundID):
+            stream.gain = gain
+
+    def _streams_playing(self, soundID):
+        """Return the streams (or voices) assigned to a sound."""
+        if self.mixer:
+            return [voice for voice in self.voices if voice.soundID == soundID]
+        return [self.streams[soundID]]
+
+    def _get_voice(self, soundID):
+        """Return the voice for playing a sound (the one already playing it, a free one,
+        or the one that started first if all are busy)."""
+        for voice in self.voices:
+            if voice.playing and voice.soundID == soundID:
+                return voice
+        for voice in self.voices:
+            if not voice.playing:
+                return voice
+        return min(self.voices, key=lambda voice: voice.startCount)
+
+    def play_sound(self, soundID, loop=False):
+        if self.mixer:
+            stream = self._get_voice(soundID)
+            stream.playing = False
+            stream.soundID = soundID
+        else:
+            stream = self.streams[soundID]
+            stream.playing = False
+        stream.generation += 1
+        stream.wave = self.sounds[soundID].obj
+        stream.cursor = 0
+        stream.loop = loop
+        stream.gain = self.gains.get(soundID, 1.0)
+        self.nVoicesStarted += 1
+        stream.startCount = self.nVoicesStarted
+        stream.triggerFrame = self.jackClient.frame_time
+        stream.playing = True
+
     def loop_sound(self, soundID):
-        self.loopFlag[soundID] = True
-        self.playingEvent[soundID].set()
-        
+        self.play_sound(soundID, loop=True)
+
     def stop_sound(self, soundID):
-        self.loopFlag[soundID] = False
-        if self.playingEvent[soundID].is_set():
-            self.queueDict[soundID] = queue.Queue()  # Get a clean queue
+        for stream in self._streams_playing(soundID):
+            stream.generation += 1
+            stream.loop = False
+            stream.playing = False
 
     def stop_all(self):
-        for soundID in self.sounds:
-            self.stop_sound(soundID)
-    
+        for stream in (self.voices if self.mixer else self.activeStreams):
+            stream.generation += 1
+            stream.loop = False
+            stream.playing = False
+
+    def trigger_latency(self):
+        """
+        Return a utils.LatencyHistogram of the time (sec) from play_sound() until the start
+        of the JACK block where the sound starts (for the last JACK_LATENCY_LOG_SIZE sounds).
+        The sound reaches the output one block (plus the latency of the sound card) later.
+        """
+        latencyHist = utils.LatencyHistogram()
+        nStored = min(self.nLatencies, JACK_LATENCY_LOG_SIZE)
+        for latencyFrames in self.latencyLog[:nStored]:
+            latencyHist.add(max(latencyFrames, 0)/self.samplingRate)
+        return latencyHist
+
     def _print_error(self, *args):
         print(*args, file=sys.stderr)
- 
+
     def _jack_xrun(self, delay):
-        #self._print_error("JACK xrun occured.")
-        pass
-        
+        self.nXruns += 1
+
+    def _jack_blocksize(self, blocksize):
+        """Allocate buffers for a new block size (called by JACK outside the process callback)."""
+        self.blocksize = blocksize
+        if self.mixer and blocksize > len(self.mixBuffer):
+            self.mixBuffer = np.zeros(blocksize, dtype=np.float32)
+
     def _jack_shutdown(self, status, reason):
         self._print_error('JACK shutdown!')
         self._print_error('status:', status)
         self._print_error('reason:', reason)
 
-    def _jack_stop_callback(self,msg=''):
-        print('INSIDE stop callback')
-        if msg:
-            self._print_error(msg)
-        for port in self.jackClient.outports:
-            port.get_array().fill(0)
-        raise jack.CallbackExit
-
-    def _clear_queue(self, q):
-        q.mutex.acquire()
-        q.queue.clear()
-        q.all_tasks_done.notify_all()
-        q.unfinished_tasks = 0
-        q.mutex.release()
-    
     def shutdown(self):
         self.jackClient.deactivate()
         self.jackClient.close()
@@ -525,15 +939,28 @@ class SoundServerPygame(object):
         self.sounds[soundID] = newSound
         return newSound
 
-    def create_sound(self, soundParams):
+    def set_sounds(self, soundsParams, soundWaves):
+        """Set several sounds from waveforms already created, replacing them all at once."""
+        newSounds = {}
+        for soundID, soundParams in soundsParams.items():
+            soundObj, soundWave = self.create_sound(soundParams, soundWaves[soundID])
+            newSounds[soundID] = SoundContainer(soundParams, soundObj, soundWave,
+                                                self.samplingRate)
+        self.sounds.update(newSounds)
+        return newSounds
+
+    def create_sound(self, soundParams, soundWave=None):
         if soundParams['type']=='pygameFile':
             soundObj = pygame.mixer.Sound(soundParams['filename'])
             soundObj.set_volume(soundParams['amplitude'][0])
             print('WARNING! Current implementation using pygame ignores '+\
                   'specified channel for playback!')
-            soundWave = None # FUTURE: I could load the samples here
+            return soundObj, None  # FUTURE: I could load the samples here
         else:
-            timeVec, soundWave = create_soundwave(soundParams, self.samplingRate, self.nChannels)
+            if soundWave is None:
+                timeVec, soundWave = waveformCache.create_soundwave(soundParams,
+                                                                     self.samplingRate,
+                                                                     self.nChannels, SOUND_DTYPE)
             # NOTE: pygame requires C-contiguous arrays of size [nSamples,nChannels]
             #       but this function will return an array of [nChannels,nSamples]
             soundWave = np.ascontiguousarray(soundWave.T)
@@ -573,7 +1000,7 @@ class SoundClient(threading.Thread):
         set_system_volume(rigsettings.SOUND_VOLUME_LEVEL)
         self.serialtrigger = serialtrigger
         self.ser = None
-        self._stop = threading.Event()
+        self._stopRequested = threading.Event()
         self.soundServerType = servertype
 
         if self.soundServerType=='jack':
@@ -594,11 +1021,11 @@ class SoundClient(threading.Thread):
         if self.serialtrigger:
             self.init_serial()
         else:
-            fakeSerialFullPath = os.path.join(TEMP_DIR, FAKE_SERIAL)
-            #if not os.path.isfile(fakeSerialFullPath):
-            open(fakeSerialFullPath, 'w').close() # Create empty file
+            # -- Triggers from the emulator (read in the same way as from the serial port) --
+            self.ser = fakeserial.FakeSerialReader(timeout=SERIAL_TIMEOUT)
             
         self.sounds = self.soundServer.sounds  # Gives access to sounds info
+        self.preparePool = None  # Pool of processes for prepare_sounds() (created when needed)
         self.daemon = True  # The program exits when only daemon threads are left.
         
     def start(self):
@@ -609,29 +1036,14 @@ class SoundClient(threading.Thread):
         '''Execute thread'''
         try:
             #1/0
-            if self.serialtrigger:
-                while not self._stop.is_set():
-                    onechar = self.ser.read(1)
-                    if onechar:
-                        soundID = ord(onechar)
-                        if soundID==STOP_ALL_SOUNDS:
-                            self.stop_all()
-                        else:
-                            self.play_sound(soundID)
-            else:
-                '''Fake serial mode'''
-                fakeSerial = open(os.path.join(TEMP_DIR, FAKE_SERIAL), 'r')
-                while not self._stop.is_set():
-                    oneval = fakeSerial.read(1)
-                    time.sleep(0.01)
-                    if len(oneval):
-                        soundID = ord(oneval)
-                        if soundID==STOP_ALL_SOUNDS:
-                            self.stop_all()
-                        else:
-                            self.play_sound(soundID)
-                        # if fakeSerial:
-                        #     fakeSerial.close()
+            while not self._stopRequested.is_set():
+                onechar = self.ser.read(1)
+                if onechar:
+                    soundID = ord(onechar)
+                    if soundID==STOP_ALL_SOUNDS:
+                        self.stop_all()
+                    else:
+                        self.play_sound(soundID)
         except Exception as exc:
             #print(traceback.format_exc())
             #print('[soundclient.py] An error occurred in the sound client thread. {}'.format(exc))
@@ -658,6 +1070,40 @@ class SoundClient(threading.Thread):
         newSound = self.soundServer.set_sound(soundID, soundParams)
         return newSound
     
+    def prepare_sounds(self, batch):
+        """
+        Start creating a set of sounds in a pool of processes, without waiting for them.
+        Use it, for example, to create the sounds of the next trial while the current
+        trial runs, and then activate_sounds() to replace the current ones.
+
+        Args:
+            batch (dict): soundParams for each soundID.
+        Returns:
+            preparedSounds (PreparedSounds): the set of sounds being created.
+        """
+        if self.preparePool is None:
+            # Workers share the resource tracker, which removes shared memory left by a crash
+            resource_tracker.ensure_running()
+            self.preparePool = concurrent.futures.ProcessPoolExecutor(
+                SOUND_PREPARE_PROCESSES, multiprocessing.get_context(PREPARE_START_METHOD),
+                initializer=_init_prepare_process)
+        preparedSounds = PreparedSounds(batch, self.soundServer.samplingRate,
+                                        self.soundServer.nChannels, SOUND_DTYPE)
+        preparedSounds.submit(self.preparePool)
+        return preparedSounds
+
+    def activate_sounds(self, preparedSounds, timeout=None):
+        """
+        Replace sounds with a set created by prepare_sounds() (waiting for it if needed).
+        All sounds in the set are replaced at once, so a trigger never finds some of the
+        sounds of the set updated and others not.
+
+        Returns:
+            newSounds (dict): the SoundContainer of each soundID.
+        """
+        soundWaves = preparedSounds.wait(timeout)
+        return self.soundServer.set_sounds(preparedSounds.params, soundWaves)
+
     def play_sound(self, soundID):
         self.soundServer.play_sound(soundID)
         
@@ -672,11 +1118,15 @@ class SoundClient(threading.Thread):
         
     def shutdown(self):
         '''Stop thread loop and shutdown pyo sound server'''
-        self._stop.set() # Set flag to stop thread (checked on the thread loop).
+        self._stopRequested.set() # Set flag to stop thread (checked on the thread loop).
         if self.is_alive():
-            time.sleep(0.001)
+            self.join(2*SERIAL_TIMEOUT)  # Wait for the last read before closing the port
         self.stop_all()
+        if self.preparePool is not None:
+            self.preparePool.shutdown(cancel_futures=True)
         self.soundServer.shutdown()
+        if self.ser is not None and not self.is_alive():
+            self.ser.close()
 
 """
 if __name__ == "__main__":
@@ -74,7 +74,14 @@ class Paradigm2AFC(QtWidgets.QMainWindow):
         self.mySidesPlot = sidesplot.SidesPlot(nTrials=120)
 
         # -- Module for saving data --
-        self.saveData = savedata.SaveData(rigsettings.DATA_DIR, remotedir=rigsettings.REMOTE_DIR)
+        self.saveData = savedata.SaveData(rigsettings.DATA_DIR, remotedir=rigsettings.REMOTE_DIR,
+                                          background=getattr(rigsettings,
+                                                             'SAVE_IN_BACKGROUND', False),
+                                          updatedb=getattr(rigsettings, 'UPDATE_CATALOG', False),
+                                          compact=getattr(rigsettings, 'COMPACT_DATA_FILES', False),
+                                          swmr=getattr(rigsettings, 'SAVE_EACH_TRIAL_SWMR', False),
+                                          flushInterval=getattr(rigsettings,
+                                                                'SAVE_EACH_TRIAL_INTERVAL', 0))
 
         # -- Create an empty state matrix --
         self.sm = statematrix.StateMatrix(inputs=rigsettings.INPUTS,
@@ -139,6 +146,9 @@ class Paradigm2AFC(QtWidgets.QMainWindow):
         # -- Connect signals from dispatcher --
         self.dispatcher.prepareNextTrial.connect(self.prepare_next_trial)
         self.dispatcher.timerTic.connect(self._timer_tic)
+        if getattr(rigsettings, 'SAVE_EACH_TRIAL', False):
+            # Connected after prepare_next_trial, so results of the last trial are ready
+            self.dispatcher.prepareNextTrial.connect(self._save_trial)
 
         # -- Connect messenger --
         self.messagebar = paramgui.Messenger()
@@ -180,6 +190,17 @@ class Paradigm2AFC(QtWidgets.QMainWindow):
                               subject=self.params['subject'].get_value(),
                               paradigm=self.name)
 
+    def _save_trial(self, nextTrial):
+        '''Save the trial that just ended to the journal file (see SaveData.start_journal)'''
+        if nextTrial > 0:
+            if self.saveData.journalFile is None:
+                self.saveData.start_journal([self.params, self.dispatcher,
+                                             self.sm, self.results],
+                                            experimenter='',
+                                            subject=self.params['subject'].get_value(),
+                                            paradigm=self.name)
+            self.saveData.journal_trial(nextTrial)
+
     def prepare_next_trial(self, nextTrial):
         pass
 
@@ -191,6 +212,7 @@ class Paradigm2AFC(QtWidgets.QMainWindow):
         '''
         # self.soundClient.shutdown()
         self.dispatcher.die()
+        self.saveData.finish_pending()
         event.accept()
 
 
@@ -206,7 +228,14 @@ class ParadigmGoNoGo(QtWidgets.QMainWindow):
         # self.mySidesPlot = sidesplot.SidesPlot(nTrials=120)
 
         # -- Module for saving data --
-        self.saveData = savedata.SaveData(rigsettings.DATA_DIR, remotedir=rigsettings.REMOTE_DIR)
+        self.saveData = savedata.SaveData(rigsettings.DATA_DIR, remotedir=rigsettings.REMOTE_DIR,
+                                          background=getattr(rigsettings,
+                                                             'SAVE_IN_BACKGROUND', False),
+                                          updatedb=getattr(rigsettings, 'UPDATE_CATALOG', False),
+                                          compact=getattr(rigsettings, 'COMPACT_DATA_FILES', False),
+                                          swmr=getattr(rigsettings, 'SAVE_EACH_TRIAL_SWMR', False),
+                                          flushInterval=getattr(rigsettings,
+                                                                'SAVE_EACH_TRIAL_INTERVAL', 0))
 
         # -- Create an empty state matrix --
         self.sm = statematrix.StateMatrix(inputs=rigsettings.INPUTS,
@@ -268,6 +297,9 @@ class ParadigmGoNoGo(QtWidgets.QMainWindow):
         # -- Connect signals from dispatcher --
         self.dispatcher.prepareNextTrial.connect(self.prepare_next_trial)
         self.dispatcher.timerTic.connect(self._timer_tic)
+        if getattr(rigsettings, 'SAVE_EACH_TRIAL', False):
+            # Connected after prepare_next_trial, so results of the last trial are ready
+            self.dispatcher.prepareNextTrial.connect(self._save_trial)
 
         # -- Connect messenger --
         self.messagebar = paramgui.Messenger()
@@ -306,6 +338,17 @@ class ParadigmGoNoGo(QtWidgets.QMainWindow):
                               subject=self.params['subject'].get_value(),
                               paradigm=self.name)
 
+    def _save_trial(self, nextTrial):
+        '''Save the trial that just ended to the journal file (see SaveData.start_journal)'''
+        if nextTrial > 0:
+            if self.saveData.journalFile is None:
+                self.saveData.start_journal([self.params, self.dispatcher,
+                                             self.sm, self.results],
+                                            experimenter='',
+                                            subject=self.params['subject'].get_value(),
+                                            paradigm=self.name)
+            self.saveData.journal_trial(nextTrial)
+
     def prepare_next_trial(self, nextTrial):
         pass
 
@@ -317,4 +360,5 @@ class ParadigmGoNoGo(QtWidgets.QMainWindow):
         '''
         # self.soundClient.shutdown()
         self.dispatcher.die()
+        self.saveData.finish_pending()
         event.accept()
@@ -6,34 +6,102 @@ import os
 import time
 import h5py
 import sys
+import queue
+import threading
 from qtpy import QtWidgets
 from qtpy import QtGui
 from qtpy import QtCore
 import subprocess
+from . import utils
+from . import catalog
 
 # A file with this name must exist in the remote directory
 REMOTEDIR_VERIFICATION = 'REMOTEDIR.txt'
 
+# Extension added to the data file while trials are being saved (see start_journal)
+JOURNAL_SUFFIX = '.part'
+
+SAVE_QUEUE_SIZE = 4  # Max number of jobs waiting to be processed by the background worker
+UPLOAD_RETRIES = 3  # Number of times to try again if sending to the repository fails
+UPLOAD_RETRY_WAIT = 2.0  # Time (sec) to wait before trying again (doubles each time)
+
+
+class SaveWorker(threading.Thread):
+    """
+    Thread that writes data files and sends them to the repository.
+
+    Jobs are processed in order. Each job is a tuple (function, args).
+    A job equal to None stops the thread. Errors are emitted by the signal 'saveFailed'.
+    """
+    def __init__(self, saveFailed, maxsize=SAVE_QUEUE_SIZE):
+        super().__init__()
+        self.jobs = queue.Queue(maxsize=maxsize)
+        self.saveFailed = saveFailed
+        self.daemon = True  # The program exits when only daemon threads are left.
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            (function, args) = job
+            try:
+                function(*args)
+            except Exception as exc:  # pylint: disable=broad-except
+                self.saveFailed.emit('ERROR while saving data: {0}'.format(exc))
+                print(exc)
+            self.jobs.task_done()
+
 
 class SaveData(QtWidgets.QGroupBox):
     """
     A widget to save data, transfer it to a remote repository, and update the database.
     """
     logMessage = QtCore.Signal(str)
+    saveFailed = QtCore.Signal(str)
 
-    def __init__(self, datadir, remotedir=None, updatedb=False, parent=None):
+    def __init__(self, datadir, remotedir=None, updatedb=False, background=False,
+                 compact=False, compression='gzip', swmr=False, flushInterval=0,
+                 parent=None):
         """
         Args:
             datadir (str): data root directory.
             remotedir (str): remote directory of data repository.
                 If none given it will not send data to repository.
-            updatedb (bool): [not implemented].
+            updatedb (bool): if True, the catalog of datadir is updated (see catalog.Catalog)
+                every time a file is saved.
+            background (bool): if True, files are written to disk and sent to the
+                repository by a separate thread, so the GUI is only blocked while the
+                data is copied (see to_file). Errors are shown in a message box.
+            compact (bool): if True, files are saved with the compact layout
+                (narrow dtypes, compressed datasets, labels as one dataset each).
+            compression (str): compression for the compact layout ('gzip', 'lzf' or None).
+            swmr (bool): if True, the journal file (see start_journal) is written in
+                single-writer/multiple-reader mode, so other processes can read it
+                (see sessionreader.SessionReader) while the session is running.
+            flushInterval (float): minimum time (sec) between writes to the journal file.
+                Trials that end before this time are written together later.
         """
         super(SaveData, self).__init__(parent)
 
         self.datadir = datadir
         self.remotedir = remotedir
+        self.updatedb = updatedb
         self.filename = None
+        self.compact = compact
+        self.compression = compression
+        self.journalFile = None  # Open HDF5 file where each trial is saved when it ends
+        self.journalFilename = None
+        self.journalContainers = []
+        self.swmr = swmr
+        self.flushInterval = flushInterval
+        self.lastJournalFlush = 0  # Time when data was last written to the journal file
+        self.worker = None  # Thread for saving data in the background
+        if background:
+            self.worker = SaveWorker(self.saveFailed)
+            self.worker.start()
+        self.saveFailed.connect(self.show_save_error)
 
         # -- Create graphical objects --
         self.buttonSaveData = QtWidgets.QPushButton("Save data")
@@ -79,20 +147,18 @@ class SaveData(QtWidgets.QGroupBox):
         ``datadir/experimenter/subject/subject_paradigm_YYMMDDa.h5``
           or, is experimenter is empty:
         ``datadir/subject/subject_paradigm_YYMMDDa.h5``
+
+        When saving in the background, each container is copied with its method
+        'file_snapshot' (so widgets are only read by this thread), and the copies are
+        written by the worker. If some container has no 'file_snapshot', the file is
+        written here.
         """
         if filename is not None:
             defaultFileName = filename
         else:
-            if date is None:
-                date = time.strftime('%Y%m%d', time.localtime())
-            dataRootDir = self.datadir
-            fileExt = 'h5'
-            relativePath = os.path.join(experimenter, subject, '')
-            fullDataDir = os.path.join(dataRootDir, relativePath)
-            if not os.path.exists(fullDataDir):
-                os.makedirs(fullDataDir)
-            fileNameOnly = '{0}_{1}_{2}{3}.{4}'.format(subject, paradigm, date, suffix, fileExt)
-            defaultFileName = os.path.join(fullDataDir, fileNameOnly)
+            (relativePath, fileNameOnly) = self._make_filename(experimenter, subject,
+                                                               paradigm, date, suffix)
+            defaultFileName = os.path.join(self.datadir, relativePath, fileNameOnly)
 
         self.logMessage.emit('Saving data...')
 
@@ -116,10 +182,45 @@ class SaveData(QtWidgets.QGroupBox):
         else:
             fname = defaultFileName
 
-        # -- Create data file --
+        uploadArgs = None  # Arguments for send_to_repository()
+        if self.checkSendToRepo.checkState():
+            if self.remotedir:
+                uploadArgs = (relativePath, fileNameOnly, fname)
+            else:
+                self.logMessage.emit('Remote directory has not been defined. ' +
+                                     'Nothing will be sent to repository.')
+
+        # -- Create data file (or add the rest of the data to the journal file) --
         # FIXME: check that the file opened correctly
-        h5file = h5py.File(fname, 'w')
+        if self.journalFile is not None:
+            if self.journalFile.swmr_mode:
+                self._reopen_journal()  # The rest of the data includes new datasets
+            # -- The journal is kept open (if some data is missing) to continue saving trials --
+            success = self._append_containers(self.journalFile, containers, currentTrial)
+            if success:
+                self.stop_journal(fname)
+            else:
+                self.journalFile.flush()
+        elif self.worker is not None and all(hasattr(container, 'file_snapshot')
+                                             for container in containers):
+            # -- Only copying the data blocks the GUI. The worker writes the file --
+            snapshots = [container.file_snapshot(currentTrial) for container in containers]
+            self.submit_job(self._save_in_background, fname, snapshots, currentTrial,
+                            uploadArgs)
+            return
+        else:
+            success = self._write_containers(fname, containers, currentTrial)
 
+        if success:
+            self.filename = fname
+            self.logMessage.emit('Saved data to {0}'.format(fname))
+            self.submit_job(self._after_saving, fname, uploadArgs)
+
+    def _append_containers(self, h5file, containers, currentTrial):
+        """
+        Append the data of each container to an open HDF5 file.
+        Returns False if some container had no data to save (see to_file).
+        """
         success = True
         for container in containers:
             try:
@@ -128,27 +229,167 @@ class SaveData(QtWidgets.QGroupBox):
                 success = False
                 self.logMessage.emit(str(uwarn))
                 print(uwarn)
-            except:  # pylint: disable=bare-except
-                success = False
-                h5file.close()
-                raise
-        h5file.close()
+        return success
 
-        if success:
+    def _write_containers(self, fname, containers, currentTrial):
+        """Create a data file with the data of each container (see _append_containers)."""
+        h5file = self._create_file(fname)
+        try:
+            return self._append_containers(h5file, containers, currentTrial)
+        finally:
+            h5file.close()
+
+    def _save_in_background(self, fname, snapshots, currentTrial, uploadArgs=None):
+        """
+        Write the data copied by to_file() (run by the background worker).
+        The catalog is updated and the file is sent to the repository only if it
+        was written. Errors are shown by show_save_error().
+        """
+        if self._write_containers(fname, snapshots, currentTrial):
             self.filename = fname
             self.logMessage.emit('Saved data to {0}'.format(fname))
-            if self.checkSendToRepo.checkState():
-                if self.remotedir:
-                    self.send_to_repository(relativePath, fileNameOnly)
-                else:
-                    self.logMessage.emit('Remote directory has not been defined. ' +
-                                         'Nothing sent to repository.')
+            self._after_saving(fname, uploadArgs)
+
+    def _after_saving(self, fname, uploadArgs=None):
+        """Update the catalog and send the saved file to the repository (if uploadArgs given)."""
+        if self.updatedb:
+            self.update_catalog(fname)
+        if uploadArgs is not None:
+            self.send_to_repository(*uploadArgs)
+
+    def show_save_error(self, message):
+        """Show an error from the background worker (connected to saveFailed)."""
+        self.logMessage.emit(message)
+        QtWidgets.QMessageBox.warning(self, 'Saving data', message)
+
+    def _create_file(self, fname, **kwargs):
+        """Create an HDF5 file (with the compact layout if requested)."""
+        h5file = h5py.File(fname, 'w', **kwargs)
+        if self.compact:
+            utils.set_compact_layout(h5file, self.compression)
+        return h5file
+
+    def _make_filename(self, experimenter, subject, paradigm, date=None, suffix='a'):
+        """
+        Return the path (relative to datadir) and name of the data file.
+        The directory is created if it does not exist.
+        """
+        if date is None:
+            date = time.strftime('%Y%m%d', time.localtime())
+        fileExt = 'h5'
+        relativePath = os.path.join(experimenter, subject, '')
+        fullDataDir = os.path.join(self.datadir, relativePath)
+        if not os.path.exists(fullDataDir):
+            os.makedirs(fullDataDir)
+        fileNameOnly = '{0}_{1}_{2}{3}.{4}'.format(subject, paradigm, date, suffix, fileExt)
+        return (relativePath, fileNameOnly)
+
+    def start_journal(self, containers, experimenter='', subject='subject',
+                      paradigm='paradigm', date=None, suffix='a'):
+        """
+        Start saving each trial, as it ends, to a temporary file.
 
-    def send_to_repository(self, relativePath, fileNameOnly):
+        The file has the same name as the one created by to_file() plus JOURNAL_SUFFIX.
+        Each call to journal_trial() appends the data from new trials (using the method
+        'append_trial_to_file' of each container), so if the program crashes only the
+        last trial is lost. When to_file() is called, the rest of the data is added
+        and the file is renamed.
+
+        If self.swmr is True, SWMR mode is enabled after the first trial is saved
+        (once all datasets that grow every trial have been created). Other processes
+        can then open the file with h5py.File(filename, 'r', libver='latest', swmr=True).
+
+        Args:
+            containers: a list of objects that have a method 'append_trial_to_file'.
+            Other arguments are the same as for to_file().
+        """
+        if self.journalFile is not None:
+            self.stop_journal()
+        (relativePath, fileNameOnly) = self._make_filename(experimenter, subject,
+                                                           paradigm, date, suffix)
+        self.journalFilename = os.path.join(self.datadir, relativePath,
+                                            fileNameOnly+JOURNAL_SUFFIX)
+        if self.swmr:
+            self.journalFile = self._create_file(self.journalFilename, libver='latest')
+        else:
+            self.journalFile = self._create_file(self.journalFilename)
+        utils.set_extendable_datasets(self.journalFile)
+        self.journalContainers = containers
+        self.lastJournalFlush = 0
+        self.logMessage.emit('Saving each trial to {0}'.format(self.journalFilename))
+
+    def journal_trial(self, currentTrial, force=False):
+        """
+        Save data from trials up to currentTrial-1 that are not yet in the journal file.
+        Nothing is written if less than self.flushInterval sec have passed since the last
+        write (unless force=True).
+        """
+        now = time.time()
+        if not force and (now-self.lastJournalFlush) < self.flushInterval:
+            return
+        for container in self.journalContainers:
+            if hasattr(container, 'append_trial_to_file'):
+                container.append_trial_to_file(self.journalFile, currentTrial)
+        if self.swmr and not self.journalFile.swmr_mode:
+            self.journalFile.swmr_mode = True  # No new objects can be created after this
+        self.journalFile.flush()
+        self.lastJournalFlush = now
+
+    def _reopen_journal(self):
+        """Close the journal file (in SWMR mode) and open it again to add new objects."""
+        self.journalFile.close()
+        self.journalFile = h5py.File(self.journalFilename, 'r+', libver='latest')
+
+    def stop_journal(self, fname=None):
+        """
+        Close the journal file, and rename it to fname (if given).
+        """
+        self.journalFile.close()
+        if fname is not None:
+            os.replace(self.journalFilename, fname)
+        self.journalFile = None
+        self.journalFilename = None
+        self.journalContainers = []
+
+    def submit_job(self, function, *args):
+        """
+        Run function(*args) in the background worker (or now, if there is no worker).
+
+        If the queue of the worker is full, the job is run now, so no data is lost.
+        """
+        if self.worker is not None:
+            try:
+                self.worker.jobs.put_nowait((function, args))
+                return
+            except queue.Full:
+                self.logMessage.emit('Too many saving jobs pending. Saving now.')
+        function(*args)
+
+    def finish_pending(self, timeout=None):
+        """
+        Wait until the background worker has processed all jobs, and stop it.
+        """
+        if self.worker is not None:
+            self.worker.jobs.put(None)
+            self.worker.join(timeout)
+            self.worker = None
+
+    def update_catalog(self, fname):
+        """Add a saved file to the catalog of the data directory."""
+        try:
+            catalog.update_catalog(self.datadir, fname)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.logMessage.emit('The catalog could not be updated: {0}'.format(exc))
+
+    def send_to_repository(self, relativePath, fileNameOnly, localfile=None):
         """
         Send saved data to repository.
+        When using the background worker, it tries again (waiting longer each time)
+        if rsync fails.
         FIXME: The remote subdirectories must exist, otherwise it will fail.
         """
+        if localfile is None:
+            localfile = self.filename
         verificationFile = os.path.join(self. remotedir, REMOTEDIR_VERIFICATION)
         if os.path.exists(verificationFile):
             fullRemoteDir = os.path.join(self. remotedir, relativePath)
@@ -157,11 +398,20 @@ class SaveData(QtWidgets.QGroupBox):
             cmd = 'rsync'
             flag1 = '-ab'
             flag2 = '--no-g'
-            localfile = self.filename
             cmdlist = [cmd, flag1, flag2, localfile, fullRemoteDir]
-            p = subprocess.Popen(cmdlist, shell=False, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            stdout, stderr = p.communicate()
+            nRetries = UPLOAD_RETRIES if self.worker is not None else 0
+            waitTime = UPLOAD_RETRY_WAIT
+            for attempt in range(nRetries+1):
+                p = subprocess.Popen(cmdlist, shell=False, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+                stdout, stderr = p.communicate()
+                if not stderr:
+                    break
+                if attempt < nRetries:
+                    self.logMessage.emit('Sending to repository failed. ' +
+                                         'Trying again in {0} sec.'.format(waitTime))
+                    time.sleep(waitTime)
+                    waitTime *= 2
             if stderr:
                 raise IOError(stderr)
             self.logMessage.emit('Sent data to {0}'.format(fullRemoteDir))
@@ -0,0 +1,249 @@
+"""
+Read data files saved by taskontrol (see savedata.SaveData).
+
+Datasets are only read from disk when they are accessed, so loading one
+variable from many sessions reads only that variable from each file.
+Datasets stored contiguously and without compression (as in files saved by
+older versions of taskontrol) are memory-mapped instead of read.
+Files with the original and the compact layout (see utils.set_compact_layout)
+can be read, as well as journal files written in SWMR mode while a session is
+running (see savedata.SaveData.start_journal), using swmr=True and refresh().
+
+Example:
+    with sessionreader.SessionReader(filename) as session:
+        choice = session.resultsData['choice']
+        eventsTrial5 = session.events_one_trial(5)
+"""
+
+import collections.abc
+import numpy as np
+import h5py
+from . import utils
+
+EVENTS_FIELDS = ['eventTime', 'eventCode', 'nextState']
+
+
+def memmap_dataset(dset):
+    """
+    Return a read-only numpy.memmap of an HDF5 dataset, or None if it cannot be mapped.
+
+    Only datasets stored contiguously, without compression or other filters,
+    and with a fixed-size numeric dtype can be mapped.
+    """
+    if dset.chunks is not None or dset.compression is not None or dset.shape is None:
+        return None
+    if dset.dtype.kind not in 'biuf' or dset.size == 0:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:  # The dataset has not been allocated in the file
+        return None
+    return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype,
+                     offset=offset, shape=dset.shape)
+
+
+def read_dataset(dset, memmap=True):
+    """
+    Return the data of an HDF5 dataset as a numpy array (or a python scalar/string).
+
+    Args:
+        dset (h5py.Dataset): the dataset to read.
+        memmap (bool): if True, memory-map the dataset when possible instead of reading it.
+    """
+    if memmap and dset.ndim > 0:
+        mapped = memmap_dataset(dset)
+        if mapped is not None:
+            return mapped
+    data = dset[()]
+    if isinstance(data, bytes):
+        data = data.decode()
+    return data
+
+
+class LazyGroup(collections.abc.Mapping):
+    """
+    Read-only dictionary of the datasets in an HDF5 group.
+
+    Each dataset is read (or memory-mapped) the first time it is accessed.
+    If swmr=True, datasets are refreshed before they are read, to include data
+    added by the process writing the file.
+    """
+    def __init__(self, h5group, memmap=True, swmr=False):
+        self._group = h5group
+        self._memmap = memmap and not swmr
+        self._swmr = swmr
+        self._data = {}
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            self._data[key] = read_dataset(self.dataset(key), self._memmap)
+        return self._data[key]
+
+    def dataset(self, key):
+        """Return the h5py.Dataset of one item (without reading it)."""
+        dset = self._group[key]
+        if not isinstance(dset, h5py.Dataset):
+            raise KeyError('"{0}" is not a dataset.'.format(key))
+        if self._swmr:
+            dset.refresh()
+        return dset
+
+    def refresh(self):
+        """Forget data already loaded, so it is read again when accessed."""
+        self._data.clear()
+
+    def __iter__(self):
+        return iter(self._group)
+
+    def __len__(self):
+        return len(self._group)
+
+    def attrs(self, key):
+        """Return the attributes (e.g., Description, Units) of one dataset."""
+        return dict(self._group[key].attrs)
+
+    def __repr__(self):
+        groupName = getattr(self._group, 'name', '')
+        return '<LazyGroup {0} ({1} datasets, {2} loaded)>'.format(groupName, len(self),
+                                                                 len(self._data))
+
+
+class LabelsGroup(collections.abc.Mapping):
+    """
+    Read-only dictionary of label dictionaries (e.g., resultsLabels, stateMatrix names).
+
+    Each dictionary maps labels to values and values to labels (see utils.dict_from_HDF5),
+    and it is read the first time it is accessed.
+    """
+    def __init__(self, h5group):
+        self._group = h5group
+        self._data = {}
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            self._data[key] = utils.dict_from_HDF5(self._group[key])
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._group)
+
+    def __len__(self):
+        return len(self._group)
+
+
+class SessionReader(object):
+    """
+    Lazy access to the data of a session saved by taskontrol.
+
+    Attributes:
+        resultsData: dictionary of arrays with one value per trial.
+        resultsLabels: dictionary of label dictionaries for menu parameters and results.
+        sessionData: dictionary of parameters for the whole session (e.g., subject, date).
+        events: dictionary of arrays 'eventTime', 'eventCode', 'nextState' and
+            'indexLastEventEachTrial'.
+        stateMatrix: dictionary of label dictionaries 'statesNames', 'eventsNames'
+            and 'outputsNames'.
+    """
+    def __init__(self, filename, memmap=True, swmr=False):
+        """
+        Args:
+            filename (str): full path to the HDF5 file.
+            memmap (bool): if True, memory-map datasets when possible instead of reading them.
+            swmr (bool): if True, open a file that is being written in SWMR mode.
+                Call refresh() to see the trials saved after the file was opened.
+        """
+        self.filename = filename
+        self.memmap = memmap
+        self.swmr = swmr
+        if swmr:
+            self.h5file = h5py.File(filename, 'r', libver='latest', swmr=True)
+        else:
+            self.h5file = h5py.File(filename, 'r')
+        self.resultsData = LazyGroup(self._group('resultsData'), memmap, swmr)
+        self.sessionData = LazyGroup(self._group('sessionData'), memmap, swmr)
+        self.events = LazyGroup(self._group('events'), memmap, swmr)
+        self.resultsLabels = LabelsGroup(self._group('resultsLabels'))
+        self.stateMatrix = LabelsGroup(self._group('stateMatrix'))
+
+    def _group(self, groupName):
+        """Return an HDF5 group (an empty dict-like object if the file does not have it)."""
+        return self.h5file.get(groupName, {})
+
+    @property
+    def layoutVersion(self):
+        """Layout of the file (see utils.COMPACT_LAYOUT)."""
+        return int(self.h5file.attrs.get(utils.LAYOUT_ATTR, 1))
+
+    @property
+    def nTrials(self):
+        """Number of trials with saved events."""
+        if 'indexLastEventEachTrial' not in self.events:
+            return 0
+        return len(self.events['indexLastEventEachTrial'])
+
+    def trial_events_range(self, trialIndex):
+        """
+        Return the indexes (first, last+1) of the events of one trial.
+        Following Dispatcher.events_one_trial, the initial state 0 of the session is not included.
+        """
+        indexLastEvent = self.events['indexLastEventEachTrial']
+        if trialIndex == 0:
+            indPrev = 0
+        else:
+            indPrev = indexLastEvent[trialIndex-1]
+        return (int(indPrev)+1, int(indexLastEvent[trialIndex])+1)
+
+    def events_one_trial(self, trialIndex, fields=EVENTS_FIELDS):
+        """
+        Return the events of one trial as a dictionary of arrays (one for each field).
+        Only the events of this trial are read from fields that are not already loaded.
+        """
+        (indFirst, indLast) = self.trial_events_range(trialIndex)
+        eventsThisTrial = {}
+        for field in fields:
+            if field in self.events._data:
+                eventsThisTrial[field] = self.events[field][indFirst:indLast]
+            else:
+                eventsThisTrial[field] = self.events.dataset(field)[indFirst:indLast]
+        return eventsThisTrial
+
+    def refresh(self):
+        """
+        Read again data that may have changed (for files opened with swmr=True).
+
+        Returns:
+            nTrials (int): number of trials with saved events.
+        """
+        for group in [self.resultsData, self.sessionData, self.events]:
+            group.refresh()
+        return self.nTrials
+
+    def close(self):
+        """Close the file. Arrays that were memory-mapped remain valid."""
+        self.h5file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __repr__(self):
+        return '<SessionReader {0}>'.format(self.filename)
+
+
+def read_variable(filenames, varName, groupName='resultsData', memmap=True):
+    """
+    Read one variable from many session files.
+
+    Only that variable is read from each file.
+    Files that do not contain the variable give None.
+
+    Returns:
+        values (list): the data from each file.
+    """
+    values = []
+    for filename in filenames:
+        with SessionReader(filename, memmap=memmap) as session:
+            group = getattr(session, groupName)
+            values.append(group[varName] if varName in group else None)
+    return values
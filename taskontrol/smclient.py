@@ -25,6 +25,9 @@ import os
 import sys
 import time
 import struct
+import queue
+import threading
+import numpy as np
 from . import rigsettings
 
 SERIAL_PORT_PATH = rigsettings.STATE_MACHINE_PORT
@@ -32,12 +35,33 @@ SERIAL_PORT_PATH = rigsettings.STATE_MACHINE_PORT
 
 SERIAL_BAUD = 115200  # Should be the same in statemachine.ino
 SERIAL_TIMEOUT = 0.1   # It used to be 0.1. Also, 0.0042 is around the threshold
+PUSH_STOP_TIMEOUT = 1.0  # Max time (sec) to wait for the server to leave push mode
+PUSH_ABORT_WAIT = 0.1  # Time (sec) to wait for data still being pushed before discarding it
+CONNECT_TIMEOUT = 10.0  # Max time (sec) to wait for the server when connecting
+CONNECT_FIRST_WAIT = 0.01  # Time (sec) to wait for the first reply to CONNECT (doubles each try)
+CONNECT_MAX_WAIT = 0.5  # Max time (sec) to wait between two tries when connecting
+PROBE_TIMEOUT = 2.0  # Max time (sec) to wait for each port when searching for the state machine
+PROGRAM_ACK_TIMEOUT = 0.5  # Time (sec) to wait for OK after a program has been sent
 
 # The following should match the statemachine code (statemachine.ino)
 MAXNINPUTS = 8
 MAXNOUTPUTS = 16
 MAXNEXTRATIMERS = 16
 
+# -- Events sent by GET_EVENTS_BINARY: time (ms), eventCode and nextState --
+# NOTE: eventCode is signed so that forced transitions (-1) can be represented.
+EVENTS_WIRE_DTYPE = np.dtype([('time', '<u4'), ('code', 'i1'), ('state', 'u1')])
+EVENTS_COUNT_FORMAT = '<H'  # Number of events sent before the events block
+
+# -- Minimum server version that supports each feature --
+SERVER_FEATURES = {
+    'binaryEvents': (0, 4),
+    'eventsPush': (0, 5),
+    'statusSnapshot': (0, 6),
+    'loadProgram': (0, 7),
+    'patchProgram': (0, 8),
+}
+
 # -- COMMANDS --
 opcode = {
     'OK'                 : 0xaa,
@@ -64,11 +88,207 @@ opcode = {
     'REPORT_EXTRA_TIMERS': 0x1c,
     'SET_SERIAL_OUTPUTS' : 0x1d,
     'REPORT_SERIAL_OUTPUTS': 0x1e,
+    'GET_EVENTS_BINARY'  : 0x1f,
+    'SET_EVENTS_PUSH'    : 0x20,
+    'EVENTS_PUSH'        : 0x21,
+    'GET_STATUS'         : 0x22,
+    'LOAD_PROGRAM'       : 0x23,
+    'PATCH_PROGRAM'      : 0x24,
     'ERROR'              : 0xff,
 }
 for k,v in opcode.items():
     opcode[k]=bytes([v])
 
+
+def events_to_matrix(eventsArray):
+    '''Convert events received in binary format to an array of size [nEvents,3]
+    with eventTime (sec), eventCode, nextState.'''
+    return np.column_stack((1e-3*eventsArray['time'],
+                            eventsArray['code'], eventsArray['state']))
+
+
+def frame_program_message(programOpcode, data):
+    '''Add opcode, size and checksum (sum of bytes modulo 2^16) to a block of data.'''
+    checksum = int(np.frombuffer(data, dtype='u1').sum()) & 0xffff
+    return programOpcode + struct.pack('<H', len(data)) + data + struct.pack('<H', checksum)
+
+
+def build_program(nInputs, stateMatrix, stateOutputs, serialOutputs, stateTimers,
+                  extraTimers=(), extraTriggers=()):
+    '''Pack a whole program (sizes, matrix, outputs and timers) as one LOAD_PROGRAM message.
+
+    Timers are in seconds. See LOAD_PROGRAM in PROTOCOL.txt for the format.
+    Returns: bytes (opcode, size, program and checksum)
+    '''
+    stateMatrix = np.asarray(stateMatrix, dtype=int)
+    stateOutputs = np.asarray(stateOutputs, dtype=int)
+    nStates = len(stateMatrix)
+    nExtraTimers = len(extraTimers)
+    nActions = 2*nInputs + 1 + nExtraTimers
+    nOutputs = stateOutputs.shape[1] if stateOutputs.ndim==2 else 0
+    if serialOutputs is None:
+        serialOutputs = np.zeros(nStates, dtype=int)
+    serialOutputs = np.asarray(serialOutputs, dtype=int)
+    stateTimers = np.asarray(stateTimers, dtype=float)
+    extraTimers = np.asarray(extraTimers, dtype=float)
+    if stateMatrix.shape!=(nStates, nActions):
+        raise ValueError('The states transition matrix does not have the '+\
+                         'correct number of columns.\n'+\
+                         'It should be {0} not {1}'.format(nActions, stateMatrix.shape[-1]))
+    if nStates>255 or nOutputs>MAXNOUTPUTS or nExtraTimers>MAXNEXTRATIMERS or \
+       nInputs>MAXNINPUTS:
+        raise ValueError('The program is larger than what the state machine supports.')
+    if len(stateOutputs)!=nStates or len(serialOutputs)!=nStates or \
+       len(stateTimers)!=nStates or len(extraTriggers)!=nExtraTimers:
+        raise ValueError('The sizes of the outputs or timers do not match the number of states.')
+    for oneArray in (stateMatrix, stateOutputs, serialOutputs, extraTriggers):
+        if np.any(np.asarray(oneArray)<0) or np.any(np.asarray(oneArray)>255):
+            raise ValueError('Values of the state matrix and outputs should be in the range 0-255.')
+    if np.any(stateTimers<0) or np.any(extraTimers<0):
+        raise ValueError('Value of timers should be positive.')
+    # FIXME: test if the value of timers is too large
+    program = b''.join([bytes([nInputs, nOutputs, nExtraTimers, nStates]),
+                        stateMatrix.astype('u1').tobytes(),
+                        stateOutputs.astype('u1').tobytes(),
+                        serialOutputs.astype('u1').tobytes(),
+                        (1e3*stateTimers).astype('<u4').tobytes(),
+                        (1e3*extraTimers).astype('<u4').tobytes(),
+                        np.asarray(extraTriggers, dtype='u1').tobytes()])
+    return frame_program_message(opcode['LOAD_PROGRAM'], program)
+
+
+def build_program_patch(stateIndices, stateMatrix, stateOutputs, serialOutputs, stateTimers,
+                        extraTimerIndices=(), extraTimers=(), extraTriggers=()):
+    '''Pack the states and extra timers that changed as one PATCH_PROGRAM message.
+
+    Each argument (except the indices) contains one item for each patched state
+    or extra timer. Timers are in seconds. See PATCH_PROGRAM in PROTOCOL.txt.
+    Returns: bytes (opcode, size, patch and checksum)
+    '''
+    nStates = len(stateIndices)
+    stateMatrix = np.asarray(stateMatrix, dtype='u1').reshape(nStates, -1)
+    stateOutputs = np.asarray(stateOutputs, dtype='u1').reshape(nStates, -1)
+    statesBlock = np.column_stack((np.asarray(stateIndices, dtype='u1'), stateMatrix, stateOutputs,
+                                   np.asarray(serialOutputs, dtype='u1'),
+                                   (1e3*np.asarray(stateTimers, dtype=float)).astype('<u4').
+                                   view('u1').reshape(nStates, 4)))
+    nTimers = len(extraTimerIndices)
+    timersBlock = np.column_stack((np.asarray(extraTimerIndices, dtype='u1'),
+                                   (1e3*np.asarray(extraTimers, dtype=float)).astype('<u4').
+                                   view('u1').reshape(nTimers, 4),
+                                   np.asarray(extraTriggers, dtype='u1')))
+    patch = b''.join([bytes([nStates]), statesBlock.astype('u1').tobytes(),
+                      bytes([nTimers]), timersBlock.astype('u1').tobytes()])
+    return frame_program_message(opcode['PATCH_PROGRAM'], patch)
+
+
+def set_timeout(ser, timeout):
+    '''Set the timeout of a serial port (in sec), for old and new versions of pyserial.'''
+    if rigsettings.OS=='ubuntu1404':
+        ser.setTimeout(timeout)
+    else:
+        ser.timeout = timeout
+
+
+def handshake(ser, timeout=CONNECT_TIMEOUT):
+    '''Send CONNECT until the server replies OK, waiting longer after each try.
+
+    The server ignores anything sent while it is booting, so CONNECT is sent again
+    every time the wait expires. Any unanswered CONNECT will be replied later with
+    extra OK bytes, which are ignored by get_version().
+    Returns: True if the server replied before the timeout.
+    '''
+    deadline = time.perf_counter() + timeout
+    waitTime = CONNECT_FIRST_WAIT
+    ser.flushInput()  # Discard anything sent before the connection
+    connected = False
+    while not connected and time.perf_counter() < deadline:
+        set_timeout(ser, min(waitTime, max(deadline-time.perf_counter(), 0)))
+        ser.write(opcode['CONNECT'])
+        connected = (ser.read(1)==opcode['OK'])
+        waitTime = min(2*waitTime, CONNECT_MAX_WAIT)
+    set_timeout(ser, SERIAL_TIMEOUT)
+    return connected
+
+
+def find_state_machine_port(candidates=None):
+    '''Find the serial port connected to a state machine server.
+
+    Each candidate port is opened and asked for the server version after a handshake.
+    Args:
+        candidates (list): serial ports to probe. By default /dev/ttyACM* and /dev/ttyUSB*.
+    Returns: the first port that replied with a valid version, or None.
+    '''
+    if candidates is None:
+        candidates = sorted(glob.glob('/dev/ttyACM*')) + sorted(glob.glob('/dev/ttyUSB*'))
+    for onePort in candidates:
+        try:
+            ser = serial.Serial(onePort, SERIAL_BAUD, timeout=SERIAL_TIMEOUT)
+        except serial.SerialException:
+            continue
+        try:
+            if handshake(ser, PROBE_TIMEOUT):
+                ser.write(opcode['GET_SERVER_VERSION'])
+                versionString = ser.readline().strip().lstrip(opcode['OK'])
+                if versionString.replace(b'.', b'').isdigit():
+                    return onePort
+        finally:
+            ser.close()
+    return None
+
+
+class EventsReader(threading.Thread):
+    '''
+    Thread that reads the packets pushed by the server when in push mode.
+
+    For each packet, it calls callback(serverTime, events) where serverTime is
+    in seconds and events is an array of size [nEvents,3] (see get_events).
+    Any other reply from the server (e.g., the OK after LOAD_PROGRAM) is put in
+    client.replies, for the method that sent the command (see read_reply).
+    The OK that follows SET_EVENTS_PUSH(0) only ends the thread if stopRequested is set
+    (which stop_events_push does, holding stopLock, after sending the command).
+
+    If a packet cannot be read (e.g., it is incomplete), the thread stops, the error
+    is put in client.replies and errorCallback(error) is called (if given).
+    '''
+    def __init__(self, client, callback, errorCallback=None):
+        super().__init__()
+        self.client = client
+        self.callback = callback
+        self.errorCallback = errorCallback
+        self.stopRequested = threading.Event()  # Set by stop_events_push()
+        self.stopLock = threading.Lock()
+        self.error = None  # Error that stopped the thread (if any)
+        self.daemon = True  # The program exits when only daemon threads are left.
+    def run(self):
+        try:
+            self._read_pushed()
+        except (IOError, struct.error) as error:
+            self.error = error
+            self.client.replies.put(opcode['ERROR']+str(error).encode()+b'\n')
+            if self.errorCallback is not None:
+                self.errorCallback(error)
+    def _read_pushed(self):
+        timeSize = struct.calcsize('<L')
+        while True:
+            header = self.client.ser.read(1)
+            if header==opcode['EVENTS_PUSH']:
+                timeBytes = self.client.ser.read(timeSize)
+                if len(timeBytes)!=timeSize:
+                    raise IOError('Timeout while waiting for the time of pushed events.')
+                serverTime = struct.unpack('<L', timeBytes)[0]
+                eventsArray = self.client.read_events_binary()
+                self.callback(1e-3*serverTime, events_to_matrix(eventsArray))
+            elif header==opcode['OK']:
+                with self.stopLock:
+                    if self.stopRequested.is_set():
+                        break  # The server confirmed push mode is disabled
+                self.client.replies.put(header)
+            elif header==opcode['ERROR']:
+                self.client.replies.put(header+self.client.ser.readline())
+            elif header:
+                self.client.replies.put(header)
+
 class StateMachineClient(object):
     def __init__(self,connectnow=True):
         '''
@@ -89,42 +309,61 @@ class StateMachineClient(object):
 
         self.port = SERIAL_PORT_PATH
         self.ser = None  # To be created on self.connect()
+        self.serverVersion = None  # Will be set by self.connect()
+        self.connectionTime = None  # Time (sec) it took to connect (set by self.connect())
+        self.binaryEvents = False  # Use GET_EVENTS_BINARY if the server supports it
+        self.eventsReader = None  # Thread reading events when in push mode
+        self.replies = queue.Queue()  # Replies to commands read by eventsReader (in push mode)
         if connectnow:
             self.connect()
     def send_reset(self):
         '''Old function necessary for Maple. Obsolete for Arduino'''
         pass
     def connect(self):
-        ###self.ser.flushInput()  # FIXME: Why would I need this?
-        portReady = False
-        fsmReady = False
-        while not portReady:  #os.path.exists(self.port):
+        '''Open the serial port and wait for the server to reply to CONNECT.
+
+        If the port is 'auto', all serial ports are probed to find the state machine.
+        '''
+        startTime = time.perf_counter()
+        deadline = startTime + CONNECT_TIMEOUT
+        if self.port=='auto':
+            self.port = find_state_machine_port()
+            if self.port is None:
+                raise IOError('No state machine was found on any serial port.')
+            print('Found state machine on {}'.format(self.port))
+        waitTime = CONNECT_FIRST_WAIT
+        while self.ser is None or not self.ser.isOpen():
             try:
                 self.ser = serial.Serial(self.port, SERIAL_BAUD,
                                          timeout=SERIAL_TIMEOUT)
-                portReady = True
             except serial.SerialException:
+                if time.perf_counter()+waitTime > deadline:
+                    raise IOError('Serial port {} is not available.'.format(self.port))
                 print('Waiting for Arduino to be ready...')
-                time.sleep(1)
-        if rigsettings.OS=='ubuntu1404':
-            self.ser.setTimeout(1.0)
-        else:
-            self.ser.timeout = 1.0
+                time.sleep(waitTime)
+                waitTime = min(2*waitTime, CONNECT_MAX_WAIT)
+        if rigsettings.OS!='ubuntu1404':
             self.ser.write_timeout = 0 #1.001
-        #self.ser.flushOutput()  # FIXME: Discard anything in output buffer?
-        #self.ser.flushInput()   # FIXME: Discard anything in input buffer?
-        time.sleep(0.4)  # FIXME: why does it need extra time? 0.1 does not work!
-        self.ser.write(opcode['CONNECT'])
-        while not fsmReady:
-            print('Establishing connection...')
-            sys.stdout.flush()
-            fsmReady = (self.ser.read(1)==opcode['OK'])
-        if rigsettings.OS=='ubuntu1404':
-            self.ser.setTimeout(SERIAL_TIMEOUT)
-        else:
-            self.ser.timeout = SERIAL_TIMEOUT
-        print('Connected!')
-        #self.ser.flushOutput()
+        print('Establishing connection...')
+        sys.stdout.flush()
+        if not handshake(self.ser, deadline-time.perf_counter()):
+            raise IOError('The state machine on {} did not reply to CONNECT.'.format(self.port))
+        self.update_server_features()
+        self.connectionTime = time.perf_counter()-startTime
+        print('Connected! ({:0.0f} ms)'.format(1e3*self.connectionTime))
+    def update_server_features(self):
+        '''Find which optional features of the protocol the server supports.'''
+        versionString = self.get_version()
+        try:
+            self.serverVersion = tuple(int(x) for x in versionString.decode().split('.'))
+        except ValueError:
+            print('Server version ({}) not recognized.'.format(versionString))
+            self.serverVersion = (0,)
+        self.binaryEvents = self.supports('binaryEvents')
+    def supports(self, feature):
+        '''Return True if the server version supports a protocol feature.'''
+        return self.serverVersion is not None and \
+            self.serverVersion >= SERVER_FEATURES[feature]
     def test_connection(self):
         self.ser.write(opcode['TEST_CONNECTION'])
         connectionStatus = self.ser.read()
@@ -139,7 +378,8 @@ class StateMachineClient(object):
         '''
         self.ser.write(opcode['GET_SERVER_VERSION'])
         versionString = self.ser.readline()
-        return versionString.strip()
+        # -- Ignore extra OK bytes (replies to repeated CONNECT during the handshake) --
+        return versionString.strip().lstrip(opcode['OK'])
     def set_sizes(self,nInputs,nOutputs,nExtraTimers):
         self.nInputs = nInputs
         self.nOutputs = nOutputs
@@ -265,6 +505,57 @@ class StateMachineClient(object):
     def report_serial_outputs(self):
         self.ser.write(opcode['REPORT_SERIAL_OUTPUTS'])
         return self.ser.readline()
+    def load_program(self, nInputs, stateMatrix, stateOutputs, serialOutputs, stateTimers,
+                     extraTimers=(), extraTriggers=(), message=None):
+        '''Send sizes, state matrix, outputs and timers in a single transaction.
+
+        This replaces calling set_sizes(), set_state_matrix(), set_state_outputs(),
+        set_serial_outputs(), set_state_timers(), set_extra_timers() and
+        set_extra_triggers(). Timers should be in seconds.
+        If message is given (the result of build_program() for the same arguments,
+        kept from an earlier upload), it is sent without building it again.
+        Returns: number of bytes sent.
+        '''
+        if message is None:
+            message = build_program(nInputs, stateMatrix, stateOutputs, serialOutputs,
+                                    stateTimers, extraTimers, extraTriggers)
+        self.nInputs = nInputs
+        self.nOutputs = len(stateOutputs[0]) if len(stateOutputs) else 0
+        self.nExtraTimers = len(extraTimers)
+        self.nActions = 2*self.nInputs + 1 + self.nExtraTimers
+        return self.send_program_message(message)
+    def patch_program(self, stateIndices, stateMatrix, stateOutputs, serialOutputs, stateTimers,
+                      extraTimerIndices=(), extraTimers=(), extraTriggers=()):
+        '''Replace only some states and extra timers of the last program sent.
+
+        Each argument (except the indices) contains one item for each patched
+        state or extra timer. Sizes must not change (use load_program instead).
+        Returns: number of bytes sent.
+        '''
+        for onerow in stateMatrix:
+            if len(onerow)!=self.nActions:
+                raise ValueError('The states transition matrix does not have the '+\
+                                 'correct number of columns.\n'+\
+                                 'It should be {0} not {1}'.format(self.nActions,
+                                                                   len(onerow)))
+        message = build_program_patch(stateIndices, stateMatrix, stateOutputs, serialOutputs,
+                                      stateTimers, extraTimerIndices, extraTimers, extraTriggers)
+        return self.send_program_message(message)
+    def send_program_message(self, message):
+        '''Send a LOAD_PROGRAM or PATCH_PROGRAM message and wait for the server to accept it.
+
+        This can be used in push mode (the reply is read by the events reader thread).
+        '''
+        if self.in_push_mode():
+            while not self.replies.empty():  # Discard replies nobody waited for
+                self.replies.get_nowait()
+        self.ser.write(message)
+        # -- Wait long enough for the whole message to go through the serial port --
+        reply = self.read_reply(PROGRAM_ACK_TIMEOUT + 10.0*len(message)/SERIAL_BAUD)
+        if reply!=opcode['OK']:
+            therest = reply[1:] if reply else b'(timeout)'
+            raise IOError('The state machine did not accept the program: {}'.format(therest))
+        return len(message)
     def get_events_raw_strings(self):
         '''Request list of events
         Returns: strings (NEEDS MORE DETAIL)
@@ -275,7 +566,49 @@ class StateMachineClient(object):
         for inde in range(nEvents):
             eventsList.append(self.ser.readline())
         return eventsList
+    def get_events_binary(self):
+        '''Request all pending events as one block of binary data.
+        Returns: structured array with fields 'time' (ms), 'code' and 'state'.
+        '''
+        self.ser.write(opcode['GET_EVENTS_BINARY'])
+        return self.read_events_binary()
+    def read_events_binary(self):
+        '''Read a block of events (count followed by packed events) from the server.'''
+        countSize = struct.calcsize(EVENTS_COUNT_FORMAT)
+        nEventsBytes = self.ser.read(countSize)
+        if len(nEventsBytes)!=countSize:
+            raise IOError('Timeout while waiting for the number of events.')
+        nEvents = struct.unpack(EVENTS_COUNT_FORMAT, nEventsBytes)[0]
+        nBytes = nEvents*EVENTS_WIRE_DTYPE.itemsize
+        eventsBytes = self.ser.read(nBytes)
+        if len(eventsBytes)!=nBytes:
+            raise IOError('Received {} bytes of events, '.format(len(eventsBytes)) +
+                          'expected {}.'.format(nBytes))
+        return np.frombuffer(eventsBytes, dtype=EVENTS_WIRE_DTYPE)
     def get_events(self):
+        '''Request list of events.
+        Returns: array of size [nEvents,3] with eventTime (sec), eventCode, nextState.
+        '''
+        if self.binaryEvents:
+            return events_to_matrix(self.get_events_binary())
+        else:
+            return self.get_events_ascii()
+    def get_status(self):
+        '''Request time, current state and pending events in a single transaction.
+        Returns: (serverTime, currentState, events)
+            serverTime is in seconds.
+            events is an array of size [nEvents,3] (see get_events).
+        '''
+        self.ser.write(opcode['GET_STATUS'])
+        statusFormat = '<LB'
+        statusBytes = self.ser.read(struct.calcsize(statusFormat))
+        if len(statusBytes)!=struct.calcsize(statusFormat):
+            raise IOError('Timeout while waiting for the status of the server.')
+        serverTime, currentState = struct.unpack(statusFormat, statusBytes)
+        eventsArray = self.read_events_binary()
+        return (1e-3*serverTime, currentState, events_to_matrix(eventsArray))
+    def get_events_ascii(self):
+        '''Request events as lines of text (for servers older than version 0.4).'''
         # FIXME: translation of the events strings to a matrix may be slow
         #        it needs to be tested carefully.
         eventsList = self.get_events_raw_strings()
@@ -285,6 +618,62 @@ class StateMachineClient(object):
             eventItems[0] = 1e-3*eventItems[0]
             eventsMat.append(eventItems)
         return eventsMat
+    def start_events_push(self, callback, errorCallback=None):
+        '''Ask the server to send events as soon as they happen (push mode).
+
+        Events are read by a separate thread, which calls callback(serverTime, events).
+        If the thread fails to read a packet, it calls errorCallback(error) and stops
+        (see abort_events_push).
+        While in push mode, only use methods that do not read from the server,
+        or that read their reply with read_reply() (e.g., load_program).
+        '''
+        if not self.supports('eventsPush'):
+            raise IOError('The state machine server does not support push mode.')
+        self.replies = queue.Queue()
+        self.eventsReader = EventsReader(self, callback, errorCallback)
+        self.ser.write(opcode['SET_EVENTS_PUSH']+bytes([1]))
+        self.eventsReader.start()
+    def stop_events_push(self):
+        '''Stop push mode and wait until the last pushed packet has been read.'''
+        if not self.in_push_mode():
+            self.abort_events_push()  # The events reader stopped because of an error
+            return
+        with self.eventsReader.stopLock:
+            self.ser.write(opcode['SET_EVENTS_PUSH']+bytes([0]))
+            self.eventsReader.stopRequested.set()
+        self.eventsReader.join(PUSH_STOP_TIMEOUT)
+        if self.eventsReader.is_alive():
+            print('WARNING: the server did not confirm that push mode was stopped.')
+    def abort_events_push(self):
+        '''Stop push mode after the events reader failed, discarding anything still pushed.
+
+        Events pushed since the error are lost. Events that happen later can be
+        requested as usual (e.g., with get_events).
+        '''
+        self.ser.write(opcode['SET_EVENTS_PUSH']+bytes([0]))
+        time.sleep(PUSH_ABORT_WAIT)
+        self.ser.flushInput()
+        self.eventsReader = None
+    def in_push_mode(self):
+        '''Return True if the events reader thread is reading from the server.'''
+        return self.eventsReader is not None and self.eventsReader.is_alive()
+    def read_reply(self, timeout=SERIAL_TIMEOUT):
+        '''Read the one-byte reply to a command (OK or ERROR followed by a line of text).
+
+        In push mode, the reply is taken from the events reader thread.
+        Returns: bytes (empty after timeout)
+        '''
+        if self.in_push_mode():
+            try:
+                return self.replies.get(timeout=timeout)
+            except queue.Empty:
+                return b''
+        set_timeout(self.ser, timeout)
+        reply = self.ser.read(1)
+        set_timeout(self.ser, SERIAL_TIMEOUT)
+        if reply==opcode['ERROR']:
+            reply += self.ser.readline()
+        return reply
     def get_current_state(self):
         self.ser.write(opcode['GET_CURRENT_STATE'])
         currentState = self.ser.read()
@@ -384,8 +773,6 @@ if __name__ == "__main__":
         #stateTimers = [0,0] # in microseconds
         stateOutputs = ['\x00','\xff']
 
-        import time
-        time.sleep(0.5)
         c.set_state_matrix(stateMatrix)
         #time.sleep(0.1)
         #print c.readlines()
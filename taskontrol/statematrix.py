@@ -5,13 +5,14 @@ Classes for assembling a state transition matrix, timers and outputs.
 
 NOTES:
 
-* The state matrix is represented by a python list (of lists), in which
-  each element (row) corresponds to the transitions from one state.
-* The state timers are represented as a list of floats.
+* The state matrix is represented by a numpy array (int16), in which
+  each row corresponds to the transitions from one state.
+* The state timers are represented as an array of floats.
   One element per state.
-* The outputs are represented as a list (of lists). Each element contains
-  the outputs for each state as a list of 0 (off), 1 (on) or another integer
+* The outputs are represented as an array (uint8). Each row contains
+  the outputs for each state as 0 (off), 1 (on) or another integer
   which indicates the output should not be changed from its previous value.
+* Arrays are preallocated and grow (doubling their size) as states are added.
 
 
 Input format:
@@ -33,6 +34,9 @@ self.eventsDict
 '''
 
 
+import copy
+from collections import OrderedDict
+import numpy as np
 from . import utils
 #from taskontrol.settings import rigsettings
 #reload(rigsettings)
@@ -44,6 +48,10 @@ __author__ = 'Santiago Jaramillo <sjara@uoregon.edu>'
 VERYLONGTIME  = 100    # Time period to stay in a state if nothing happens
 #VERYSHORTTIME = 0.0001 # Time period before jumping to next state "immediately" OBSOLETE, use 0.
 SAMEOUTPUT = 7
+INITIAL_NSTATES = 32  # Number of states preallocated (arrays grow as needed)
+STATE_MATRIX_CACHE_SIZE = 32  # Default number of matrices kept by StateMatrixCache
+STATE_SPEC_KEYS = ['name', 'statetimer', 'transitions', 'outputsOn', 'outputsOff',
+                   'trigger', 'serialOut']
 
 class StateMatrix(object):
     '''
@@ -76,10 +84,15 @@ class StateMatrix(object):
         self.inputsDict = inputs
         self.outputsDict = outputs
 
-        self.stateMatrix = []
-        self.stateTimers = []
-        self.stateOutputs = []
-        self.serialOutputs = []
+        # -- Arrays are created by _init_mat(), once the number of columns is known --
+        self.stateMatrix = None
+        self.stateTimers = None
+        self.stateOutputs = None
+        self.serialOutputs = None
+        self.definedStates = None  # True for states added with add_state()
+        # Data computed from this matrix when uploading it (see Dispatcher).
+        # It is replaced by an empty dict every time the matrix changes.
+        self.uploadCache = {}
 
         self.statesIndexToName = {}
         self.statesNameToIndex = {}
@@ -115,6 +128,8 @@ class StateMatrix(object):
     def append_to_file(self,h5file,currentTrial):
         '''Append states definitions to open HDF5 file
         It ignores currentTrial'''
+        if '/stateMatrix' in h5file:
+            del h5file['/stateMatrix']  # It may have been saved before more states were added
         statematGroup = h5file.create_group('/stateMatrix')
         utils.append_dict_to_HDF5(statematGroup,'eventsNames',self.eventsDict)
         utils.append_dict_to_HDF5(statematGroup,'outputsNames',self.outputsDict)
@@ -124,28 +139,66 @@ class StateMatrix(object):
         #      note that you have to add nInputEvents to the index of each timer.
         #utils.append_dict_to_HDF5(statematGroup,'extraTimersNames',self.extraTimersNameToIndex)
 
-    def _make_default_row(self,stateInd):
-        '''Create a transition row for a state.'''
-        nExtraTimers = len(self.extraTimersNames)
-        newrow = (self.nInputEvents+nExtraTimers)*[stateInd]    # Input events
-        return newrow
-
+    def append_trial_to_file(self,h5file,currentTrial):
+        '''Save states definitions (only if states were added since they were last saved).
+        In files open in SWMR mode (where objects cannot be created), states added after
+        the first trial are only saved by append_to_file.'''
+        statesNamesPath = '/stateMatrix/statesNames'
+        if statesNamesPath not in h5file:
+            self.append_to_file(h5file,currentTrial)
+        elif len(h5file[statesNamesPath])!=len(self.statesNameToIndex) and \
+             not getattr(h5file, 'swmr_mode', False):
+            self.append_to_file(h5file,currentTrial)
+
+    def file_snapshot(self,currentTrial=None):
+        '''Return a copy of the states definitions, which can be saved by another thread
+        (see SaveData) while states are added.'''
+        snapshot = copy.copy(self)
+        snapshot.eventsDict = dict(self.eventsDict)
+        snapshot.outputsDict = dict(self.outputsDict)
+        snapshot.statesNameToIndex = dict(self.statesNameToIndex)
+        return snapshot
 
     def _init_mat(self):
         '''
         Initialize state transition matrix with a row for the readystate.
         '''
-        if len(self.stateMatrix)>1:
+        if self._nextStateInd>1:
             raise Exception('You need to create all extra timers before creating any state.')
+        nCols = self.nInputEvents + len(self.extraTimersNames)
+        self.stateMatrix = np.empty((INITIAL_NSTATES, nCols), dtype=np.int16)
+        self.stateTimers = np.empty(INITIAL_NSTATES, dtype=float)
+        self.stateOutputs = np.empty((INITIAL_NSTATES, self.nOutputs), dtype=np.uint8)
+        self.serialOutputs = np.empty(INITIAL_NSTATES, dtype=np.uint8)
+        self.definedStates = np.zeros(INITIAL_NSTATES, dtype=bool)
         self.add_state(name=self.readyForNextTrialStateName,statetimer=VERYLONGTIME)
         # -- Setting outputs off here is not a good idea. Instead we do it in dispatcher --
         #self.add_state(name=self.readyForNextTrialStateName,statetimer=VERYLONGTIME,
         #               outputsOff=self.outputsDict.keys())
 
 
+    def _reserve(self, nStates):
+        '''Make sure the arrays have space for nStates (doubling their size if needed).'''
+        capacity = len(self.stateMatrix)
+        if nStates <= capacity:
+            return
+        while capacity < nStates:
+            capacity *= 2
+        for attr in ['stateMatrix', 'stateTimers', 'stateOutputs', 'serialOutputs',
+                     'definedStates']:
+            oldArray = getattr(self, attr)
+            newArray = np.zeros((capacity,)+oldArray.shape[1:], dtype=oldArray.dtype)
+            newArray[:len(oldArray)] = oldArray
+            setattr(self, attr, newArray)
+
+    def _invalidate_upload_cache(self):
+        '''Forget data computed for uploading the matrix (it may be shared with a snapshot).'''
+        self.uploadCache = {}
+
     def _force_transition(self,originStateID,destinationStateID):
         '''Set Tup transition from one state to another give state numbers
         instead of state names'''
+        self._invalidate_upload_cache()
         self.stateMatrix[originStateID][self.eventsDict['Tup']] = destinationStateID
 
 
@@ -159,7 +212,15 @@ class StateMatrix(object):
         '''Add state to the list of available states.'''
         #if self._nextStateInd==self.readyForNextTrialStateInd:
         #    self._nextStateInd += 1  # Skip readyForNextTrialState
-        self._update_state_dict(stateName,self._nextStateInd)
+        self._invalidate_upload_cache()
+        stateInd = self._nextStateInd
+        self._reserve(stateInd+1)
+        self._update_state_dict(stateName,stateInd)
+        self.stateMatrix[stateInd] = stateInd  # Stay in the same state for all events
+        self.stateTimers[stateInd] = VERYLONGTIME
+        self.stateOutputs[stateInd] = SAMEOUTPUT
+        self.serialOutputs[stateInd] = 0
+        self.definedStates[stateInd] = False  # Until the state is added with add_state()
         self._nextStateInd += 1
 
 
@@ -173,7 +234,7 @@ class StateMatrix(object):
                       state. A value of zero means no serial output.
         '''
 
-        nExtraTimers = len(self.extraTimersNames)
+        self._invalidate_upload_cache()
 
         # -- Find index for this state (create if necessary) --
         if name not in self.statesNameToIndex:
@@ -181,35 +242,95 @@ class StateMatrix(object):
         thisStateInd = self.statesNameToIndex[name]
 
         # -- Add target states from specified events --
-        newRow = self._make_default_row(thisStateInd)
+        self.stateMatrix[thisStateInd] = thisStateInd
         for (eventName,targetStateName) in transitions.items():
             if targetStateName not in self.statesNameToIndex:
                 self._append_state_to_list(targetStateName)
             targetStateInd = self.statesNameToIndex[targetStateName]
-            newRow[self.eventsDict[eventName]] = targetStateInd
-
-        # -- Add row to state transition matrix --
-        # FIXME: this way to do it seems very inefficient
-        while len(self.stateMatrix)<(thisStateInd+1):
-            self.stateMatrix.append([])
-            self.stateTimers.append([])
-            self.stateOutputs.append(self.nOutputs*[SAMEOUTPUT])
-            self.serialOutputs.append(0)
-        self.stateMatrix[thisStateInd] = newRow
+            self.stateMatrix[thisStateInd, self.eventsDict[eventName]] = targetStateInd
+
+        # -- Set timer and outputs for this state --
+        self.definedStates[thisStateInd] = True
         self.stateTimers[thisStateInd] = statetimer
         for oneOutput in outputsOn:
             outputInd = self.outputsDict[oneOutput]
-            self.stateOutputs[thisStateInd][outputInd] = 1
+            self.stateOutputs[thisStateInd, outputInd] = 1
         for oneOutput in outputsOff:
             outputInd = self.outputsDict[oneOutput]
-            self.stateOutputs[thisStateInd][outputInd] = 0
+            self.stateOutputs[thisStateInd, outputInd] = 0
         self.serialOutputs[thisStateInd] = serialOut
 
         # -- Add this state to the list of triggers for extra timers --
         for oneExtraTimer in trigger:
             extraTimerInd = self.extraTimersNames.index(oneExtraTimer)
             self.extraTimersTriggers[extraTimerInd] = thisStateInd
-        pass
+
+
+    def add_states(self, states):
+        '''Add many states to the transition matrix at once.
+
+        Args:
+            states: list of dicts, each with the arguments of add_state(), or
+                    a dict mapping the name of each state to a dict with the
+                    other arguments. For example:
+                    {'waitForPoke': {'statetimer':10, 'transitions':{'Cin':'reward'}},
+                     'reward': {'statetimer':0.1, 'outputsOn':['centerWater']}}
+
+        Transitions and outputs from all states are set with a single operation
+        on the arrays, instead of one state at a time.
+
+        Each state must have a name, and a name cannot appear more than once.
+        All states are checked before any is added.
+        '''
+        if isinstance(states, dict):
+            states = [dict(spec, name=name) for (name, spec) in states.items()]
+        namesSeen = set()
+        for (inds, spec) in enumerate(states):
+            unknownKeys = set(spec).difference(STATE_SPEC_KEYS)
+            if unknownKeys:
+                raise TypeError('Invalid arguments for state {0}: {1}'.format(inds,
+                                                                         sorted(unknownKeys)))
+            if not spec.get('name'):
+                raise ValueError('State {0} has no name.'.format(inds))
+            if spec['name'] in namesSeen:
+                raise ValueError('State {0} ({1}) is defined more than once.'.format(inds,
+                                                                                spec['name']))
+            namesSeen.add(spec['name'])
+        self._invalidate_upload_cache()
+        nNewStates = len(states)
+        stateInds = np.empty(nNewStates, dtype=int)
+        stateTimers = np.empty(nNewStates, dtype=float)
+        serialOuts = np.empty(nNewStates, dtype=int)
+        rowsTrans, colsTrans, targets = [], [], []
+        rowsOut, colsOut, valuesOut = [], [], []
+        for (inds, spec) in enumerate(states):
+            name = spec['name']
+            if name not in self.statesNameToIndex:
+                self._append_state_to_list(name)
+            stateInds[inds] = self.statesNameToIndex[name]
+            stateTimers[inds] = spec.get('statetimer', VERYLONGTIME)
+            serialOuts[inds] = spec.get('serialOut', 0)
+            for (eventName, targetStateName) in spec.get('transitions', {}).items():
+                if targetStateName not in self.statesNameToIndex:
+                    self._append_state_to_list(targetStateName)
+                rowsTrans.append(stateInds[inds])
+                colsTrans.append(self.eventsDict[eventName])
+                targets.append(self.statesNameToIndex[targetStateName])
+            for (outputsKey, outputValue) in [('outputsOn', 1), ('outputsOff', 0)]:
+                for oneOutput in spec.get(outputsKey, []):
+                    rowsOut.append(stateInds[inds])
+                    colsOut.append(self.outputsDict[oneOutput])
+                    valuesOut.append(outputValue)
+            for oneExtraTimer in spec.get('trigger', []):
+                extraTimerInd = self.extraTimersNames.index(oneExtraTimer)
+                self.extraTimersTriggers[extraTimerInd] = stateInds[inds]
+        # -- Set all rows at once --
+        self.stateMatrix[stateInds] = stateInds[:, np.newaxis]
+        self.stateMatrix[rowsTrans, colsTrans] = targets
+        self.stateOutputs[rowsOut, colsOut] = valuesOut
+        self.stateTimers[stateInds] = stateTimers
+        self.serialOutputs[stateInds] = serialOuts
+        self.definedStates[stateInds] = True
 
 
     def _add_extratimer(self, name, duration=0):
@@ -236,28 +357,74 @@ class StateMatrix(object):
         '''
         if name not in self.extraTimersNames:
             raise Exception('The state matrix has no extratimer called {0}.'.format(name))
+        self._invalidate_upload_cache()
         self.extraTimersDuration[self.extraTimersNames.index(name)] = duration
 
     def get_matrix(self):
+        '''Return the transition matrix as an array of size [nStates, nEvents].'''
         # -- Check if there are orphan states or calls to nowhere --
-        maxStateIDdefined = len(self.stateMatrix)-1
-        for (stateName,stateID) in self.statesNameToIndex.items():
-            if (stateID>maxStateIDdefined) or not len(self.stateMatrix[stateID]):
-                raise ValueError('State "{0}" was not defined.'.format(stateName))
-        return self.stateMatrix
+        nStates = self._nextStateInd
+        if not self.definedStates[:nStates].all():
+            stateID = np.flatnonzero(~self.definedStates[:nStates])[0]
+            raise ValueError('State "{0}" was not defined.'.format(self.statesIndexToName[stateID]))
+        return self.stateMatrix[:nStates]
 
     def reset_transitions(self):
-        #defaultTransitions = self._make_default_row(0) # Default row of the matrix
-        for stateind in self.statesIndexToName.keys():
-            self.stateMatrix[stateind] = self._make_default_row(stateind)
-            self.stateTimers[stateind] = VERYLONGTIME
-            self.stateOutputs[stateind] = self.nOutputs*[SAMEOUTPUT]
+        '''Set all states to stay in the same state, with default timers and outputs.'''
+        self._invalidate_upload_cache()
+        nStates = self._nextStateInd
+        self.stateMatrix[:nStates] = np.arange(nStates)[:, np.newaxis]
+        self.stateTimers[:nStates] = VERYLONGTIME
+        self.stateOutputs[:nStates] = SAMEOUTPUT
+        self.definedStates[:nStates] = True
+
+    def snapshot(self):
+        '''
+        Return a copy of states, transitions, outputs and timers (see restore()).
+        '''
+        nStates = self._nextStateInd
+        return {'nStates': nStates,
+                'statesNameToIndex': dict(self.statesNameToIndex),
+                'statesIndexToName': dict(self.statesIndexToName),
+                'stateMatrix': self.stateMatrix[:nStates].copy(),
+                'stateTimers': self.stateTimers[:nStates].copy(),
+                'stateOutputs': self.stateOutputs[:nStates].copy(),
+                'serialOutputs': self.serialOutputs[:nStates].copy(),
+                'definedStates': self.definedStates[:nStates].copy(),
+                'extraTimersDuration': list(self.extraTimersDuration),
+                'extraTimersTriggers': list(self.extraTimersTriggers),
+                'uploadCache': self.uploadCache}
+
+    def restore(self, snapshot):
+        '''
+        Set states, transitions, outputs and timers from a snapshot().
+
+        The snapshot must come from a matrix with the same inputs, outputs and extra timers.
+        '''
+        if snapshot['stateMatrix'].shape[1:] != self.stateMatrix.shape[1:] or \
+           snapshot['stateOutputs'].shape[1:] != self.stateOutputs.shape[1:]:
+            raise ValueError('The snapshot comes from a matrix with different inputs or outputs.')
+        nStates = snapshot['nStates']
+        self._reserve(nStates)
+        self._nextStateInd = nStates
+        self.statesNameToIndex = dict(snapshot['statesNameToIndex'])
+        self.statesIndexToName = dict(snapshot['statesIndexToName'])
+        self.stateMatrix[:nStates] = snapshot['stateMatrix']
+        self.stateTimers[:nStates] = snapshot['stateTimers']
+        self.stateOutputs[:nStates] = snapshot['stateOutputs']
+        self.serialOutputs[:nStates] = snapshot['serialOutputs']
+        self.definedStates[:nStates] = snapshot['definedStates']
+        self.extraTimersDuration = list(snapshot['extraTimersDuration'])
+        self.extraTimersTriggers = list(snapshot['extraTimersTriggers'])
+        self.uploadCache = snapshot['uploadCache']
 
     def get_outputs(self):
-        return self.stateOutputs
+        '''Return the outputs as an array of size [nStates, nOutputs].'''
+        return self.stateOutputs[:self._nextStateInd]
 
     def get_serial_outputs(self):
-        return self.serialOutputs
+        '''Return the serial output for each state as an array of size [nStates].'''
+        return self.serialOutputs[:self._nextStateInd]
 
     def get_ready_states(self):
         '''Return names of state that indicate the machine is
@@ -265,7 +432,8 @@ class StateMatrix(object):
         return [self.readyForNextTrialStateName]
 
     def get_state_timers(self):
-        return self.stateTimers
+        '''Return the timer for each state (in sec) as an array of size [nStates].'''
+        return self.stateTimers[:self._nextStateInd]
 
     def get_extra_timers(self):
         return self.extraTimersDuration
@@ -299,8 +467,8 @@ class StateMatrix(object):
         matstr += '\t'.join([revEventsDict[k][0:4] for k in sorted(revEventsDict.keys())])
         matstr += '\t\tTimers\tOutputs\tSerialOut'
         matstr += '\n'
-        for (index,onerow) in enumerate(self.stateMatrix):
-            if len(onerow):
+        for (index,onerow) in enumerate(self.stateMatrix[:self._nextStateInd]):
+            if self.definedStates[index]:
                 matstr += '{0} [{1}] \t'.format(self.statesIndexToName[index].ljust(16),index)
                 matstr += '\t'.join(str(e) for e in onerow)
                 matstr += '\t|\t{0:0.2f}'.format(self.stateTimers[index])
@@ -335,6 +503,73 @@ class StateMatrix(object):
                 outputStr += '-'
         return outputStr
 
+class StateMatrixCache(object):
+    '''
+    Keep the matrices built for each type of trial, so they are not rebuilt every trial.
+
+    Matrices are stored by a key (any hashable object, usually a tuple of the
+    trial parameters that define the structure of the matrix). When more than
+    'maxsize' matrices are stored, the least recently used one is discarded.
+
+    A common use is (inside prepare_next_trial):
+        smKey = (correctSide, punishmentOn)
+        if not self.smCache.load(smKey):
+            self.sm.reset_transitions()
+            self.sm.add_state(...)
+            self.smCache.save(smKey)
+        self.dispatcher.set_state_matrix(self.sm)
+    '''
+    def __init__(self, stateMatrix, maxsize=STATE_MATRIX_CACHE_SIZE):
+        '''
+        Args:
+            stateMatrix (StateMatrix): matrix to save and restore.
+            maxsize (int): max number of matrices to keep.
+        '''
+        self.stateMatrix = stateMatrix
+        self.maxsize = maxsize
+        self.snapshots = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __contains__(self, key):
+        return key in self.snapshots
+
+    def load(self, key):
+        '''
+        Restore the matrix saved with this key.
+        Returns True if the key was found, False otherwise (matrix is not changed).
+        '''
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            self.misses += 1
+            return False
+        self.snapshots.move_to_end(key)
+        self.stateMatrix.restore(snapshot)
+        self.hits += 1
+        return True
+
+    def save(self, key):
+        '''Save the current matrix with this key.'''
+        self.snapshots[key] = self.stateMatrix.snapshot()
+        self.snapshots.move_to_end(key)
+        while len(self.snapshots) > self.maxsize:
+            self.snapshots.popitem(last=False)
+
+    def build(self, key, buildfunc):
+        '''
+        Restore the matrix for this key, or create it by calling buildfunc(stateMatrix).
+        '''
+        if not self.load(key):
+            buildfunc(self.stateMatrix)
+            self.save(key)
+
+    def clear(self):
+        self.snapshots.clear()
+
+
 if __name__ == "__main__":
     CASE = 3
     if CASE==1:
@@ -4,6 +4,15 @@ Extra functions useful at different stages of the paradigm design.
 
 import numpy as np
 
+DATASET_CHUNK_ROWS = 256  # Rows per chunk of extendable datasets (see append_new_rows)
+
+# -- Layout of data files. Files without the layout attribute use the original layout --
+LAYOUT_ATTR = 'layoutVersion'
+COMPRESSION_ATTR = 'compression'
+COMPACT_LAYOUT = 2  # Narrow dtypes, compressed datasets and labels as compound datasets
+# -- Files where datasets grow every trial (see savedata.SaveData.start_journal) --
+EXTENDABLE_ATTR = 'extendableDatasets'
+
 
 def find_state_sequence(states, stateSequence):
     '''
@@ -48,16 +57,84 @@ def find_event(events, states, eventID, currentStateID):
     return eventInds
 
 
+def set_compact_layout(h5file, compression='gzip'):
+    '''Mark an open HDF5 file to be saved with the compact layout.
+
+    Containers check this (with is_compact_layout) when saving their data.
+    Args:
+        compression (str): 'gzip', 'lzf' or None.
+    '''
+    h5file.attrs[LAYOUT_ATTR] = COMPACT_LAYOUT
+    h5file.attrs[COMPRESSION_ATTR] = compression or ''
+
+
+def set_extendable_datasets(h5file):
+    '''Mark a file so that append_new_rows() creates extendable (chunked) datasets.'''
+    h5file.attrs[EXTENDABLE_ATTR] = True
+
+
+def has_extendable_datasets(h5object):
+    '''Return True if the file containing this group/dataset grows every trial.'''
+    return bool(h5object.file.attrs.get(EXTENDABLE_ATTR, False))
+
+
+def is_compact_layout(h5object):
+    '''Return True if the file containing this group/dataset uses the compact layout.'''
+    return h5object.file.attrs.get(LAYOUT_ATTR, 1) >= COMPACT_LAYOUT
+
+
+def dataset_options(h5object):
+    '''Return options (compression) for creating datasets in the file of this group.'''
+    if not is_compact_layout(h5object):
+        return {}
+    compression = h5object.file.attrs.get(COMPRESSION_ATTR, b'')
+    if isinstance(compression, bytes):
+        compression = compression.decode()
+    if not compression:
+        return {}
+    options = {'compression': compression, 'shuffle': True}
+    if compression == 'gzip':
+        options['compression_opts'] = 4
+    return options
+
+
+def smallest_int_dtype(values):
+    '''Return the smallest integer dtype that can store all values.'''
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.dtype(np.int8)
+    (minValue, maxValue) = (int(values.min()), int(values.max()))
+    if minValue >= 0:
+        return np.min_scalar_type(maxValue)
+    # -- Combining the types of min and max (e.g., int8 and uint8) could give a wider type --
+    for dtype in [np.int8, np.int16, np.int32]:
+        if np.iinfo(dtype).min <= minValue and maxValue <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
 def append_dict_to_HDF5(h5fileGroup, dictName, dictData, compression=None):
     '''Append a python dictionary to a location/group in an HDF5 file
     that is already open.
 
     It creates one scalar dataset for each key in the dictionary,
     and it only works for scalar values.
+    If the file uses the compact layout, the dictionary is stored instead as a
+    single dataset with fields 'label' and 'value' (one row per key).
 
     NOTE: An alternative would be use the special dtype 'enum'
     http://www.h5py.org/docs/topics/special.html
     '''
+    if is_compact_layout(h5fileGroup):
+        labels = [str(key).encode() for key in dictData]
+        values = np.array(list(dictData.values()))
+        if values.dtype.kind in 'iub':
+            labelsDtype = 'S{0}'.format(max([len(label) for label in labels]+[1]))
+            dictArray = np.empty(len(labels), dtype=[('label', labelsDtype),
+                                                     ('value', values.dtype)])
+            dictArray['label'] = labels
+            dictArray['value'] = values
+            return h5fileGroup.create_dataset(dictName, data=dictArray)
     dictGroup = h5fileGroup.create_group(dictName)
     for key, val in dictData.items():
         # if isinstance(val, np.array): dtype = val.dtype
@@ -68,14 +145,179 @@ def append_dict_to_HDF5(h5fileGroup, dictName, dictData, compression=None):
     return dictGroup
 
 
+def append_new_rows(h5fileGroup, dsetName, data, dtype=None, chunkrows=DATASET_CHUNK_ROWS):
+    '''Write the rows of data that are not yet stored in a dataset.
+
+    The dataset is created if it does not exist. In files marked with
+    set_extendable_datasets() (journal files), it is extendable along the first
+    dimension and chunked, and later calls only append the rows beyond the current
+    length of the dataset, so calling this function every trial with the whole
+    history writes each row only once. In other files, the dataset is contiguous
+    (and it is replaced if it needs more rows). The dtype is only used when
+    creating the dataset. Appending integers outside the range of an integer
+    dataset raises ValueError (instead of storing values that wrap around).
+
+    Returns:
+        dset (h5py.Dataset): the dataset, and a boolean that is True if it was created.
+    '''
+    data = np.asarray(data)
+    extendable = has_extendable_datasets(h5fileGroup)
+    if dsetName in h5fileGroup and not extendable and len(data) > len(h5fileGroup[dsetName]):
+        del h5fileGroup[dsetName]
+    if dsetName not in h5fileGroup:
+        if extendable:
+            dset = h5fileGroup.create_dataset(dsetName, data=data, dtype=dtype,
+                                              maxshape=(None,)+data.shape[1:],
+                                              chunks=(chunkrows,)+data.shape[1:],
+                                              **dataset_options(h5fileGroup))
+        else:
+            dset = h5fileGroup.create_dataset(dsetName, data=data, dtype=dtype,
+                                              **dataset_options(h5fileGroup))
+        return (dset, True)
+    dset = h5fileGroup[dsetName]
+    nStored = dset.shape[0]
+    if len(data) > nStored:
+        newData = data[nStored:]
+        if dset.dtype.kind in 'iu' and newData.dtype.kind in 'iub':
+            limits = np.iinfo(dset.dtype)
+            if newData.min() < limits.min or newData.max() > limits.max:
+                raise ValueError("Values of '{}' do not fit in its dataset ({}).".format(
+                    dsetName, dset.dtype))
+        dset.resize(len(data), axis=0)
+        dset[nStored:] = newData
+    return (dset, False)
+
+
 def dict_from_HDF5(dictGroup):
+    '''Read a dictionary saved with append_dict_to_HDF5 (with any layout).
+    The dictionary maps labels to values and also values to labels.'''
     newDict = {}
+    if hasattr(dictGroup, 'dtype'):  # Compact layout: one dataset with labels and values
+        for row in dictGroup[()]:
+            key = row['label'].decode()
+            newDict[key] = row['value']
+            newDict[row['value']] = key
+        return newDict
     for key, val in dictGroup.items():
         newDict[key] = val[()]
         newDict[val[()]] = key
     return newDict
 
 
+class GrowableArray(object):
+    """
+    Numpy array that grows as items are appended to it.
+
+    Items are stored along the first dimension of a preallocated buffer, and
+    the capacity is doubled when the buffer is full, so appending is amortized O(1).
+    Indexing and the attribute 'data' return views (not copies) of the stored items.
+    """
+    def __init__(self, dtype=float, itemshape=(), capacity=1024):
+        """
+        Args:
+            dtype (numpy.dtype): data type of the items (it can be a structured dtype).
+            itemshape (tuple): shape of each item.
+            capacity (int): initial number of items allocated.
+        """
+        self._buffer = np.empty((max(capacity, 1),)+tuple(itemshape), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    @property
+    def data(self):
+        """View of the valid items."""
+        return self._buffer[:self._size]
+
+    @property
+    def dtype(self):
+        return self._buffer.dtype
+
+    def reserve(self, newSize):
+        """Make sure the buffer can hold at least newSize items."""
+        capacity = len(self._buffer)
+        if newSize > capacity:
+            newCapacity = max(2*capacity, newSize)
+            newBuffer = np.empty((newCapacity,)+self._buffer.shape[1:], dtype=self.dtype)
+            newBuffer[:self._size] = self._buffer[:self._size]
+            self._buffer = newBuffer
+
+    def append(self, item):
+        """Add one item at the end of the array."""
+        self.reserve(self._size+1)
+        self._buffer[self._size] = item
+        self._size += 1
+
+    def extend(self, items):
+        """Add many items (an array or a sequence) at the end of the array."""
+        nItems = len(items)
+        self.reserve(self._size+nItems)
+        self._buffer[self._size:self._size+nItems] = items
+        self._size += nItems
+
+    def clear(self):
+        """Remove all items (but keep the allocated memory)."""
+        self._size = 0
+
+    def astype(self, dtype):
+        """Return a new GrowableArray with the items converted to another dtype."""
+        newArray = GrowableArray(dtype=dtype, itemshape=self._buffer.shape[1:],
+                                 capacity=len(self._buffer))
+        newArray.extend(self.data)
+        return newArray
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies (in seconds) with logarithmically spaced bins.
+
+    Values below the first bin or above the last bin are counted in
+    counts[0] and counts[-1] respectively.
+    """
+    def __init__(self, minLatency=1e-4, maxLatency=1.0, nBins=40):
+        self.binEdges = np.logspace(np.log10(minLatency), np.log10(maxLatency), nBins+1)
+        self.counts = np.zeros(nBins+2, dtype=int)
+        self.nSamples = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, latency):
+        """Add one latency value (in seconds) to the histogram."""
+        self.counts[np.searchsorted(self.binEdges, latency, side='right')] += 1
+        self.nSamples += 1
+        self.total += latency
+        self.maximum = max(self.maximum, latency)
+
+    def reset(self):
+        self.counts[:] = 0
+        self.nSamples = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def mean(self):
+        return self.total/self.nSamples if self.nSamples else np.nan
+
+    def percentile(self, pct):
+        """Estimate a percentile (0-100) from the bins (returns the upper edge of the bin)."""
+        if not self.nSamples:
+            return np.nan
+        binInd = np.searchsorted(np.cumsum(self.counts), pct/100*self.nSamples)
+        upperEdges = np.r_[self.binEdges, np.inf]
+        return min(upperEdges[binInd], self.maximum)
+
+    def __str__(self):
+        return 'n={} mean={:0.2f}ms median<={:0.2f}ms p95<={:0.2f}ms max={:0.2f}ms'.format(
+            self.nSamples, 1e3*self.mean(), 1e3*self.percentile(50),
+            1e3*self.percentile(95), 1e3*self.maximum)
+
+
 class EnumContainer(dict):
     """
     Container for enumerated variables.
@@ -90,15 +332,44 @@ class EnumContainer(dict):
     def append_to_file(self, h5file, currentTrial):
         """
         Append data in container to an open HDF5 file.
+        If the file already has data from some trials (see append_trial_to_file),
+        only the rest of the trials are added.
         """
         if currentTrial < 1:
             raise UserWarning('WARNING: No trials have been completed or ' +
                               'currentTrial not updated.')
+        return self.append_trial_to_file(h5file, currentTrial)
+
+    def append_trial_to_file(self, h5file, currentTrial):
+        """
+        Add data from trials (up to currentTrial-1) not yet stored in an open HDF5 file.
+        """
         resultsDataGroup = h5file.require_group('resultsData')
-        resultsLabelsGroup = h5file.require_group('resultsLabels')
+        compact = is_compact_layout(h5file)
+        dset = None
         for key, item in self.items():
-            dset = resultsDataGroup.create_dataset(key, data=item[:currentTrial])
+            dtype = None
+            values = np.asarray(item[:currentTrial])
+            if compact and key in self.labels and values.dtype.kind in 'iub':
+                # -- Large enough for all labels and for the values stored so far --
+                dataRange = [values.min(), values.max()] if values.size else []
+                dtype = smallest_int_dtype(list(self.labels[key].values()) + dataRange)
+            (dset, created) = append_new_rows(resultsDataGroup, key, values, dtype=dtype)
+        # -- Labels are saved with the first trial, so files being written can be read --
+        resultsLabelsGroup = h5file.require_group('resultsLabels')
         for key, item in self.labels.items():
             # FIXME: Make sure items of self.labels are dictionaries
-            dset = append_dict_to_HDF5(resultsLabelsGroup, key, item)
+            if key not in resultsLabelsGroup:
+                append_dict_to_HDF5(resultsLabelsGroup, key, item)
         return dset
+
+    def file_snapshot(self, currentTrial):
+        """
+        Return a copy of the data (up to currentTrial-1) and labels, which can be saved
+        by another thread (see savedata.SaveData) while new trials are added.
+        """
+        snapshot = EnumContainer()
+        for key, item in self.items():
+            snapshot[key] = np.array(item[:currentTrial])
+        snapshot.labels = {key: dict(item) for key, item in self.labels.items()}
+        return snapshot
@@ -0,0 +1,76 @@
+"""
+Fixtures shared by the tests.
+
+Widgets are created without a display (Qt offscreen platform).
+Sessions are saved with savedata.SaveData, as a paradigm would save them.
+"""
+
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+import pytest
+from qtpy import QtWidgets
+from taskontrol import dispatcher
+from taskontrol import paramgui
+from taskontrol import savedata
+from taskontrol import statematrix
+from taskontrol import utils
+
+OUTCOME_LABELS = {'miss': 0, 'hit': 1}
+
+
+@pytest.fixture(scope='session')
+def qapp():
+    app = QtWidgets.QApplication.instance()
+    if app is None:
+        app = QtWidgets.QApplication([])
+    return app
+
+
+def session_containers(nTrials):
+    """
+    Return the containers of a session with nTrials trials (all ended).
+
+    Each trial has three events: entering 'waitForPoke', a center poke entering
+    'reward', and the end of the reward timer entering 'readyForNextTrial'.
+    """
+    params = paramgui.Container()
+    params['rewardSize'] = paramgui.NumericParam('Reward size', value=0.5, units='ml',
+                                                 group='Reward')
+    params['side'] = paramgui.MenuParam('Side', ['left', 'right'], value=0, group='Reward')
+    stateMatrix = statematrix.StateMatrix(inputs={'C': 0}, outputs={'water': 0})
+    stateMatrix.add_state(name='waitForPoke', statetimer=1, transitions={'Cin': 'reward'})
+    stateMatrix.add_state(name='reward', statetimer=0.1, outputsOn=['water'],
+                          transitions={'Tup': 'readyForNextTrial'})
+    results = utils.EnumContainer()
+    results.labels['outcome'] = dict(OUTCOME_LABELS)
+    results['outcome'] = np.empty(nTrials, dtype=int)
+    eventsLog = dispatcher.EventsLog()
+    eventsLog.extend([[0.0, -1, 0]])
+    indexLastEventEachTrial = []
+    for trial in range(nTrials):
+        params['rewardSize'].set_value(0.5+0.1*trial)
+        params['side'].set_value(trial % 2)
+        params.update_history()
+        results['outcome'][trial] = trial % 2
+        eventsLog.extend([[trial+0.1, -1, 1], [trial+0.2, 0, 2], [trial+0.3, 2, 0]])
+        indexLastEventEachTrial.append(len(eventsLog)-1)
+    events = dispatcher.EventsSnapshot(eventsLog, indexLastEventEachTrial)
+    return [params, results, events, stateMatrix]
+
+
+@pytest.fixture
+def make_session(tmp_path, qapp):
+    """
+    Return a function that saves a session (see session_containers) and returns its path.
+    The path (relative to tmp_path) follows the names created by SaveData.
+    """
+    def save_session(relativePath='subject001/subject001_paradigm_20240102a.h5', nTrials=5,
+                     compact=False):
+        filename = tmp_path / relativePath
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        saveData = savedata.SaveData(str(tmp_path), compact=compact)
+        saveData.to_file(session_containers(nTrials), nTrials, filename=str(filename))
+        return str(filename)
+    return save_session
@@ -0,0 +1,76 @@
+import os
+import pytest
+from taskontrol import catalog
+
+
+@pytest.fixture
+def sessions(make_session):
+    """Save three sessions and return their paths relative to the data directory."""
+    make_session('subject001/subject001_paradigm_20240102a.h5', nTrials=3)
+    make_session('subject001/subject001_paradigm_20240103a.h5', nTrials=6)
+    make_session('experimenter1/subject002/subject002_other_20240103b.h5', nTrials=2)
+    return ['subject001/subject001_paradigm_20240102a.h5',
+            'subject001/subject001_paradigm_20240103a.h5',
+            'experimenter1/subject002/subject002_other_20240103b.h5']
+
+
+@pytest.fixture
+def cat(tmp_path):
+    with catalog.Catalog(str(tmp_path)) as cat:
+        yield cat
+
+
+def test_parse_filename():
+    assert catalog.parse_filename('/data/a_b_c_20240102b.h5') == \
+        {'subject': 'a', 'paradigm': 'b_c', 'date': '20240102', 'suffix': 'b'}
+    assert catalog.parse_filename('notes.h5') == {}
+
+
+def test_find_data_files(tmp_path, sessions):
+    (tmp_path / 'subject001' / 'journal.h5.part').touch()
+    assert catalog.find_data_files(str(tmp_path)) == sorted(sessions)
+
+
+def test_rebuild_and_find(cat, sessions):
+    assert cat.rebuild(nProcesses=2) == {}
+    assert len(cat) == 3
+    assert cat.find(subject='subject001') == sessions[:2]
+    assert cat.find(paradigm='paradigm', minTrials=4) == sessions[1:2]
+    assert cat.find(dateRange=('20240103', '20240103')) == sessions[1:]
+    assert cat.find(experimenter='experimenter1', columns=('subject', 'nTrials')) == \
+        [('subject002', 2)]
+    with pytest.raises(ValueError):
+        cat.find(columns=('unknownColumn',))
+
+
+def test_parameters(cat, sessions):
+    cat.update(sessions[1])
+    (firstValue, lastValue, minValue, maxValue) = cat.parameters(sessions[1])['rewardSize']
+    assert (firstValue, lastValue) == pytest.approx((0.5, 1.0))
+    assert (minValue, maxValue) == pytest.approx((0.5, 1.0))
+    cat.update(sessions[0])
+    assert cat.find_by_parameter('rewardSize', maxValue=0.8) == sessions[:1]
+    assert cat.find_by_parameter('rewardSize', minValue=0.5) == sessions[:2]
+
+
+def test_update_only_changed_files(tmp_path, cat, sessions, make_session):
+    cat.rebuild(nProcesses=1)
+    assert all(cat.is_current(filename) for filename in sessions)
+    fullpath = os.path.join(str(tmp_path), sessions[0])
+    os.remove(fullpath)  # Otherwise SaveData asks before overwriting it
+    make_session(sessions[0], nTrials=4)
+    os.utime(fullpath, (0, 0))  # Make sure the modification time changes
+    assert not cat.is_current(fullpath)
+    cat.rebuild(nProcesses=1)
+    assert cat.find(minTrials=4, paradigm='paradigm') == sessions[:2]
+
+
+def test_removed_and_unreadable_files(tmp_path, cat, sessions):
+    cat.rebuild(nProcesses=1)
+    os.remove(os.path.join(str(tmp_path), sessions[0]))
+    (tmp_path / 'subject001' / 'subject001_paradigm_20240104a.h5').write_bytes(b'not hdf5')
+    errors = cat.rebuild(nProcesses=1)
+    assert list(errors) == ['subject001/subject001_paradigm_20240104a.h5']
+    assert cat.find() == sessions[1:]
+    cat.remove(sessions[1])
+    assert cat.find() == [sessions[2]]
@@ -0,0 +1,75 @@
+import json
+import os
+import numpy as np
+import pytest
+from taskontrol import export
+
+pa = pytest.importorskip('pyarrow')
+
+
+@pytest.fixture
+def datadir(tmp_path, make_session):
+    make_session('subject001/subject001_paradigm_20240102a.h5', nTrials=3)
+    make_session('subject002/subject002_paradigm_20240103a.h5', nTrials=4, compact=True)
+    return str(tmp_path)
+
+
+def test_output_filenames(tmp_path):
+    outputs = export.output_filenames(str(tmp_path), 'subject001/subject001_p_20240102a.h5')
+    assert outputs['trials'] == os.path.join(str(tmp_path), 'trials', 'subject=subject001',
+                                             'date=20240102', 'subject001_p_20240102a.parquet')
+    outputs = export.output_filenames(str(tmp_path), 'notes.h5')
+    assert 'subject={0}'.format(export.UNKNOWN_PARTITION) in outputs['events']
+
+
+def test_session_tables(datadir):
+    tables = export.session_tables(os.path.join(datadir, 'subject002',
+                                                'subject002_paradigm_20240103a.h5'))
+    trials = tables['trials'].to_pydict()
+    assert trials['trial'] == [0, 1, 2, 3]
+    assert trials['outcome'] == [0, 1, 0, 1]
+    assert np.allclose(trials['rewardSize'], [0.5, 0.6, 0.7, 0.8])
+    assert tables['trials'].schema.field('side').type == pa.int64()  # Same for any layout
+    assert set(trials['session']) == {'subject002_paradigm_20240103a'}
+    metadata = tables['trials'].schema.metadata
+    assert json.loads(metadata[b'resultsLabels'])['outcome'] == {'miss': 0, 'hit': 1}
+    events = tables['events'].to_pydict()
+    # -- The initial event belongs to the first trial (as in Dispatcher.events_one_trial) --
+    assert events['trial'] == [0, 0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3]
+    assert events['nextState'][:4] == [0, 1, 2, 0]
+
+
+def test_export_sessions(datadir, tmp_path):
+    outdir = str(tmp_path / 'exported')
+    assert export.export_sessions(datadir, outdir, nProcesses=1) == (2, {})
+    # -- Sessions already exported are skipped (unless forced) --
+    assert export.export_sessions(datadir, outdir, nProcesses=1) == (0, {})
+    assert export.export_sessions(datadir, outdir, nProcesses=1, force=True) == (2, {})
+    trials = export.dataset(outdir, 'trials').to_table().to_pydict()
+    assert sorted(zip(trials['subject'], trials['trial'])) == \
+        [('subject001', ind) for ind in range(3)] + [('subject002', ind) for ind in range(4)]
+    events = export.dataset(outdir, 'events').to_table(
+        filter=pa.dataset.field('subject') == 'subject001')
+    assert events.num_rows == 10
+
+
+def test_export_session_is_redone_when_data_changes(datadir, tmp_path):
+    outdir = str(tmp_path / 'exported')
+    datafile = os.path.join(datadir, 'subject001', 'subject001_paradigm_20240102a.h5')
+    assert export.export_session(datafile, outdir)
+    assert export.is_exported(datafile, outdir)
+    assert not export.export_session(datafile, outdir)
+    os.utime(datafile, None)
+    for outputFile in export.output_filenames(outdir, datafile).values():
+        os.utime(outputFile, (0, 0))
+    assert not export.is_exported(datafile, outdir)
+
+
+def test_export_errors(tmp_path):
+    datadir = tmp_path / 'data'
+    datadir.mkdir()
+    (datadir / 'subject001_paradigm_20240102a.h5').write_bytes(b'not hdf5')
+    (nExported, errors) = export.export_sessions(str(datadir), str(tmp_path / 'exported'),
+                                                 nProcesses=1)
+    assert nExported == 0
+    assert list(errors) == ['subject001_paradigm_20240102a.h5']
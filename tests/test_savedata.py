@@ -0,0 +1,116 @@
+import os
+import h5py
+import numpy as np
+import pytest
+from taskontrol import catalog
+from taskontrol import savedata
+from taskontrol import utils
+from conftest import session_containers
+
+SESSION_NAMES = {'subject': 'subject001', 'paradigm': 'paradigm', 'date': '20240102'}
+
+
+@pytest.fixture
+def saveData(tmp_path, qapp):
+    saveData = savedata.SaveData(str(tmp_path))
+    yield saveData
+    saveData.finish_pending()
+    if saveData.journalFile is not None:
+        saveData.stop_journal()
+
+
+def expected_filename(datadir, experimenter=''):
+    return os.path.join(str(datadir), experimenter, 'subject001',
+                        'subject001_paradigm_20240102a.h5')
+
+
+def check_session(filename, nTrials):
+    with h5py.File(filename, 'r') as h5file:
+        assert list(h5file['events/indexLastEventEachTrial'][:]) == [3*(ind+1)
+                                                                    for ind in range(nTrials)]
+        assert np.allclose(h5file['resultsData/rewardSize'][:], 0.5+0.1*np.arange(nTrials))
+        assert list(h5file['resultsData/outcome'][:]) == [ind % 2 for ind in range(nTrials)]
+        assert utils.dict_from_HDF5(h5file['resultsLabels/side'])['right'] == 1
+        assert 'hostname' in h5file['sessionData']
+
+
+@pytest.mark.parametrize('experimenter', ['', 'experimenter1'])
+def test_to_file(tmp_path, saveData, experimenter):
+    saveData.to_file(session_containers(4), 4, experimenter=experimenter, **SESSION_NAMES)
+    filename = expected_filename(tmp_path, experimenter)
+    assert saveData.filename == filename
+    check_session(filename, 4)
+
+
+def test_to_file_saves_only_ended_trials(tmp_path, saveData):
+    saveData.to_file(session_containers(4), 3, **SESSION_NAMES)
+    with h5py.File(expected_filename(tmp_path), 'r') as h5file:
+        assert len(h5file['resultsData/rewardSize']) == 3
+
+
+def test_compact_layout(tmp_path, qapp):
+    saveData = savedata.SaveData(str(tmp_path), compact=True, compression='lzf')
+    saveData.to_file(session_containers(4), 4, **SESSION_NAMES)
+    filename = expected_filename(tmp_path)
+    check_session(filename, 4)
+    with h5py.File(filename, 'r') as h5file:
+        assert utils.is_compact_layout(h5file)
+        assert h5file['resultsData/side'].dtype == np.uint8
+        assert h5file['events/eventCode'].dtype == np.int16
+        assert h5file['events/eventTime'].compression == 'lzf'
+
+
+def test_background_worker(tmp_path, qapp):
+    saveData = savedata.SaveData(str(tmp_path), background=True)
+    containers = session_containers(4)
+    saveData.to_file(containers, 4, **SESSION_NAMES)
+    # -- Changes after to_file() returns are not saved --
+    containers[1]['outcome'][:] = 7
+    saveData.finish_pending(timeout=10)
+    assert saveData.filename == expected_filename(tmp_path)
+    check_session(saveData.filename, 4)
+
+
+@pytest.mark.parametrize('swmr', [False, True])
+def test_journal(tmp_path, qapp, swmr):
+    saveData = savedata.SaveData(str(tmp_path), swmr=swmr)
+    containers = session_containers(4)
+    saveData.start_journal(containers, **SESSION_NAMES)
+    journalFilename = expected_filename(tmp_path) + savedata.JOURNAL_SUFFIX
+    assert saveData.journalFilename == journalFilename
+    for trial in range(1, 4):
+        saveData.journal_trial(trial)
+    with h5py.File(journalFilename, 'r', libver='latest', swmr=True) as h5file:
+        assert len(h5file['resultsData/rewardSize']) == 3
+        assert len(h5file['events/indexLastEventEachTrial']) == 4  # All trials ended
+    saveData.to_file(containers, 4, **SESSION_NAMES)
+    assert not os.path.exists(journalFilename)
+    assert saveData.journalFile is None
+    check_session(expected_filename(tmp_path), 4)
+
+
+def test_journal_flush_interval(tmp_path, saveData):
+    saveData.flushInterval = 3600
+    saveData.start_journal(session_containers(4), **SESSION_NAMES)
+    saveData.journal_trial(1)
+    saveData.journal_trial(2)
+    assert len(saveData.journalFile['resultsData/rewardSize']) == 1
+    saveData.journal_trial(2, force=True)
+    assert len(saveData.journalFile['resultsData/rewardSize']) == 2
+
+
+def test_update_catalog(tmp_path, qapp):
+    saveData = savedata.SaveData(str(tmp_path), updatedb=True)
+    saveData.to_file(session_containers(4), 4, **SESSION_NAMES)
+    with catalog.Catalog(str(tmp_path)) as cat:
+        assert cat.find(subject='subject001') == [os.path.relpath(expected_filename(tmp_path),
+                                                                  str(tmp_path))]
+
+
+def test_containers_without_trials_are_reported(tmp_path, saveData):
+    messages = []
+    saveData.logMessage.connect(messages.append)
+    containers = session_containers(0)
+    saveData.to_file(containers[1:], 0, **SESSION_NAMES)
+    assert saveData.filename is None
+    assert any('No trials' in message for message in messages)
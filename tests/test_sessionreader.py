@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from taskontrol import savedata
+from taskontrol import sessionreader
+from conftest import session_containers
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_session_reader(make_session, compact):
+    filename = make_session(nTrials=5, compact=compact)
+    with sessionreader.SessionReader(filename) as session:
+        assert session.layoutVersion == (2 if compact else 1)
+        assert session.nTrials == 5
+        assert np.allclose(session.resultsData['rewardSize'], 0.5+0.1*np.arange(5))
+        assert list(session.resultsData['side']) == [0, 1, 0, 1, 0]
+        assert session.resultsLabels['side']['right'] == 1
+        assert session.resultsLabels['outcome'][0] == 'miss'
+        assert session.stateMatrix['statesNames']['reward'] == 2
+        assert isinstance(session.sessionData['hostname'], str)
+        assert session.resultsData.attrs('rewardSize')['Units'] == 'ml'
+        assert 'side' in session.resultsData and 'missing' not in session.resultsData
+
+
+def test_uncompressed_datasets_are_memory_mapped(make_session):
+    filename = make_session()
+    with sessionreader.SessionReader(filename) as session:
+        rewardSize = session.resultsData['rewardSize']
+    assert isinstance(rewardSize, np.memmap)
+    assert rewardSize[-1] == pytest.approx(0.9)  # Still valid after closing the file
+    with sessionreader.SessionReader(filename, memmap=False) as session:
+        assert not isinstance(session.resultsData['rewardSize'], np.memmap)
+
+
+def test_events_one_trial(make_session):
+    filename = make_session(nTrials=3)
+    with sessionreader.SessionReader(filename) as session:
+        assert session.trial_events_range(0) == (1, 4)
+        assert session.trial_events_range(2) == (7, 10)
+        events = session.events_one_trial(1)
+        assert np.allclose(events['eventTime'], [1.1, 1.2, 1.3])
+        assert list(events['nextState']) == [1, 2, 0]
+        # -- The same events are returned when the whole field is already loaded --
+        session.events['eventCode']
+        assert list(session.events_one_trial(1, fields=['eventCode'])['eventCode']) == [-1, 0, 2]
+
+
+def test_read_journal_while_saving(tmp_path, qapp):
+    saveData = savedata.SaveData(str(tmp_path), swmr=True)
+    containers = session_containers(4)
+    saveData.start_journal(containers, subject='subject001', paradigm='paradigm',
+                           date='20240102')
+    saveData.journal_trial(1)
+    session = sessionreader.SessionReader(saveData.journalFilename, swmr=True)
+    try:
+        assert len(session.resultsData['rewardSize']) == 1
+        saveData.journal_trial(3)
+        assert len(session.resultsData['rewardSize']) == 1  # Until refreshed
+        session.refresh()
+        assert len(session.resultsData['rewardSize']) == 3
+    finally:
+        session.close()
+        saveData.stop_journal()
+
+
+def test_read_variable(make_session):
+    filenames = [make_session('s1/s1_paradigm_20240102a.h5', nTrials=2),
+                 make_session('s2/s2_paradigm_20240102a.h5', nTrials=3)]
+    values = sessionreader.read_variable(filenames, 'outcome')
+    assert [list(oneValue) for oneValue in values] == [[0, 1], [0, 1, 0]]
+    assert sessionreader.read_variable(filenames, 'missing') == [None, None]
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+from taskontrol import statematrix
+
+INPUTS = {'C': 0, 'L': 1}
+OUTPUTS = {'water': 0, 'light': 1}
+
+
+def new_matrix(**kwargs):
+    return statematrix.StateMatrix(inputs=INPUTS, outputs=OUTPUTS, **kwargs)
+
+
+def add_two_states(stateMatrix):
+    stateMatrix.add_state(name='wait', statetimer=2, transitions={'Cin': 'reward'},
+                          outputsOn=['light'])
+    stateMatrix.add_state(name='reward', statetimer=0.1, outputsOn=['water'],
+                          outputsOff=['light'], transitions={'Tup': 'readyForNextTrial'})
+
+
+def test_add_state():
+    stateMatrix = new_matrix()
+    add_two_states(stateMatrix)
+    states = stateMatrix.get_states_dict()
+    events = stateMatrix.eventsDict
+    matrix = stateMatrix.get_matrix()
+    assert matrix.shape == (3, len(INPUTS)*2+1)
+    assert matrix[states['wait'], events['Cin']] == states['reward']
+    assert matrix[states['wait'], events['Lin']] == states['wait']
+    assert matrix[states['reward'], events['Tup']] == states['readyForNextTrial']
+    assert list(stateMatrix.get_state_timers()[1:]) == [2, 0.1]
+    assert list(stateMatrix.get_outputs()[states['reward']]) == [1, 0]
+    assert stateMatrix.get_outputs()[states['wait'], OUTPUTS['water']] == statematrix.SAMEOUTPUT
+
+
+def test_undefined_state_is_an_error():
+    stateMatrix = new_matrix()
+    stateMatrix.add_state(name='wait', transitions={'Cin': 'nowhere'})
+    with pytest.raises(ValueError, match='nowhere'):
+        stateMatrix.get_matrix()
+
+
+def test_matrix_grows_beyond_initial_size():
+    stateMatrix = new_matrix()
+    nStates = statematrix.INITIAL_NSTATES+5
+    for ind in range(1, nStates):
+        stateMatrix.add_state(name='s{0}'.format(ind), statetimer=ind,
+                              transitions={'Tup': 's{0}'.format(ind % (nStates-1) + 1)})
+    assert stateMatrix.get_matrix().shape[0] == nStates
+    assert stateMatrix.get_state_timers()[-1] == nStates-1
+
+
+def test_add_states_is_the_same_as_add_state():
+    oneByOne = new_matrix(extratimers=['timeout'])
+    add_two_states(oneByOne)
+    oneByOne.add_state(name='readyForNextTrial', trigger=['timeout'], serialOut=3)
+    together = new_matrix(extratimers=['timeout'])
+    together.add_states({'wait': {'statetimer': 2, 'transitions': {'Cin': 'reward'},
+                                  'outputsOn': ['light']},
+                         'reward': {'statetimer': 0.1, 'outputsOn': ['water'],
+                                    'outputsOff': ['light'],
+                                    'transitions': {'Tup': 'readyForNextTrial'}},
+                         'readyForNextTrial': {'trigger': ['timeout'], 'serialOut': 3}})
+    assert oneByOne.get_states_dict() == together.get_states_dict()
+    for method in ['get_matrix', 'get_outputs', 'get_state_timers', 'get_serial_outputs']:
+        assert np.array_equal(getattr(oneByOne, method)(), getattr(together, method)())
+    assert oneByOne.get_extra_triggers() == together.get_extra_triggers()
+
+
+@pytest.mark.parametrize('states, error, message', [
+    ([{'name': 'a'}, {'statetimer': 1}], ValueError, 'State 1 has no name'),
+    ([{'name': 'a'}, {'name': 'a'}], ValueError, r'State 1 \(a\)'),
+    ([{'name': 'a', 'timer': 1}], TypeError, 'state 0'),
+])
+def test_add_states_checks_all_states_first(states, error, message):
+    stateMatrix = new_matrix()
+    with pytest.raises(error, match=message):
+        stateMatrix.add_states(states)
+    assert list(stateMatrix.get_states_dict()) == ['readyForNextTrial']
+
+
+def test_changes_invalidate_upload_cache():
+    stateMatrix = new_matrix()
+    stateMatrix.uploadCache['program'] = 'uploaded'
+    add_two_states(stateMatrix)
+    assert stateMatrix.uploadCache == {}
+
+
+def test_snapshot_and_restore():
+    stateMatrix = new_matrix()
+    add_two_states(stateMatrix)
+    snapshot = stateMatrix.snapshot()
+    matrixBefore = stateMatrix.get_matrix().copy()
+    stateMatrix.add_state(name='wait', statetimer=5, transitions={'Lin': 'extra'})
+    stateMatrix.add_state(name='extra')
+    stateMatrix.restore(snapshot)
+    assert np.array_equal(stateMatrix.get_matrix(), matrixBefore)
+    assert 'extra' not in stateMatrix.get_states_dict()
+    with pytest.raises(ValueError):
+        statematrix.StateMatrix(inputs={'C': 0}, outputs=OUTPUTS).restore(snapshot)
+
+
+def test_reset_transitions():
+    stateMatrix = new_matrix()
+    add_two_states(stateMatrix)
+    stateMatrix.reset_transitions()
+    nStates = len(stateMatrix.get_states_dict())
+    assert np.array_equal(stateMatrix.get_matrix(),
+                          np.tile(np.arange(nStates)[:, np.newaxis], (1, 5)))
+    assert (stateMatrix.get_outputs() == statematrix.SAMEOUTPUT).all()
+
+
+def test_state_matrix_cache():
+    stateMatrix = new_matrix()
+    cache = statematrix.StateMatrixCache(stateMatrix, maxsize=2)
+    builds = []
+
+    def build(timer):
+        def buildfunc(stateMatrix):
+            builds.append(timer)
+            stateMatrix.reset_transitions()
+            stateMatrix.add_state(name='wait', statetimer=timer)
+        return buildfunc
+
+    for timer in [1, 2, 1, 3, 2]:
+        cache.build(timer, build(timer))
+        assert stateMatrix.get_state_timers()[stateMatrix.get_states_dict()['wait']] == timer
+    # -- Key 2 was discarded (least recently used) when key 3 was added --
+    assert builds == [1, 2, 3, 2]
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert len(cache) == 2 and 1 not in cache
+    cache.clear()
+    assert len(cache) == 0
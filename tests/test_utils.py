@@ -0,0 +1,120 @@
+import h5py
+import numpy as np
+import pytest
+from taskontrol import utils
+
+
+@pytest.fixture
+def h5file(tmp_path):
+    with h5py.File(tmp_path / 'data.h5', 'w') as h5file:
+        yield h5file
+
+
+def test_find_transition():
+    states = np.array([0, 1, 2, 1, 2, 3])
+    assert list(utils.find_transition(states, 1, 2)) == [2, 4]
+
+
+def test_find_event():
+    events = np.array([5, 6, 5, 5])
+    states = np.array([1, 2, 1, 1])
+    # -- Events are matched with the state before each transition --
+    assert list(utils.find_event(events, states, 5, 1)) == [3]
+
+
+def test_find_state_sequence():
+    states = np.array([0, 1, 2, 0, 1, 2])
+    assert list(np.flatnonzero(utils.find_state_sequence(states, [1, 2]))) == [1, 4]
+
+
+@pytest.mark.parametrize('values, dtype', [([0, 3], np.uint8), ([-1, 3], np.int8),
+                                           ([0, 300], np.uint16), ([], np.int8)])
+def test_smallest_int_dtype(values, dtype):
+    assert utils.smallest_int_dtype(values) == np.dtype(dtype)
+
+
+def test_growable_array_grows_and_keeps_items():
+    growable = utils.GrowableArray(dtype=int, capacity=2)
+    for item in range(5):
+        growable.append(item)
+    growable.extend([5, 6])
+    assert len(growable) == 7
+    assert list(growable.data) == list(range(7))
+    assert growable[-1] == 6
+    growable.clear()
+    assert len(growable) == 0
+
+
+def test_growable_array_structured_dtype_and_astype():
+    growable = utils.GrowableArray(dtype=[('a', int), ('b', float)], capacity=1)
+    growable.extend(np.array([(1, 0.5), (2, 1.5)], dtype=growable.dtype))
+    assert list(growable.data['b']) == [0.5, 1.5]
+    floats = utils.GrowableArray(dtype=int).astype(float)
+    floats.append(0.25)
+    assert floats.dtype == np.float64 and floats[0] == 0.25
+
+
+def test_latency_histogram():
+    histogram = utils.LatencyHistogram()
+    assert np.isnan(histogram.mean())
+    for latency in [0.001, 0.002, 0.003, 0.1]:
+        histogram.add(latency)
+    assert histogram.nSamples == 4
+    assert histogram.mean() == pytest.approx(0.0265)
+    assert 0.002 <= histogram.percentile(50) <= 0.003
+    assert histogram.percentile(100) == 0.1
+    histogram.reset()
+    assert histogram.nSamples == 0 and histogram.counts.sum() == 0
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_dict_to_HDF5_and_back(h5file, compact):
+    if compact:
+        utils.set_compact_layout(h5file)
+    utils.append_dict_to_HDF5(h5file, 'labels', {'left': 0, 'right': 1})
+    labels = utils.dict_from_HDF5(h5file['labels'])
+    assert labels['left'] == 0 and labels['right'] == 1
+    assert labels[1] == 'right'
+    assert isinstance(h5file['labels'], h5py.Dataset) == compact
+
+
+def test_append_new_rows_replaces_contiguous_datasets(h5file):
+    group = h5file.create_group('resultsData')
+    (dset, created) = utils.append_new_rows(group, 'x', np.arange(3))
+    assert created and dset.chunks is None
+    (dset, created) = utils.append_new_rows(group, 'x', np.arange(5))
+    assert created
+    assert list(group['x'][:]) == list(range(5))
+
+
+def test_append_new_rows_extends_journal_datasets(h5file):
+    utils.set_extendable_datasets(h5file)
+    group = h5file.create_group('resultsData')
+    utils.append_new_rows(group, 'x', np.arange(3))
+    (dset, created) = utils.append_new_rows(group, 'x', np.arange(5))
+    assert not created and dset.maxshape == (None,)
+    assert list(dset[:]) == list(range(5))
+
+
+def test_append_new_rows_rejects_values_that_do_not_fit(h5file):
+    utils.set_extendable_datasets(h5file)
+    utils.append_new_rows(h5file, 'x', np.array([0, 1]), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        utils.append_new_rows(h5file, 'x', np.array([0, 1, 300]))
+    assert len(h5file['x']) == 2
+
+
+def test_enum_container_compact_dtype_covers_data(h5file):
+    utils.set_compact_layout(h5file)
+    results = utils.EnumContainer()
+    results.labels['choice'] = {'left': 0, 'right': 1}
+    results['choice'] = np.array([0, 1, 300, -1])
+    results.append_to_file(h5file, 4)
+    assert list(h5file['resultsData/choice'][:]) == [0, 1, 300, -1]
+    assert h5file['resultsData/choice'].dtype == np.int16
+    assert utils.dict_from_HDF5(h5file['resultsLabels/choice'])['right'] == 1
+
+
+def test_enum_container_requires_trials(h5file):
+    with pytest.raises(UserWarning):
+        utils.EnumContainer().append_to_file(h5file, 0)